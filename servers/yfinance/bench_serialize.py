@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+DataFrame → JSON 変換のマイクロベンチマーク
+
+旧実装（iterrows + セルごとの _safe_val / stmt.loc ループ）と
+server.py の列指向シリアライザを合成データで比較する。
+
+    python bench_serialize.py --rows 20000 --repeat 5
+"""
+
+import argparse
+import json
+import time
+from typing import Any, Callable, List
+
+import numpy as np
+import pandas as pd
+
+import server
+
+
+# ---------------------------------------------------------------------------
+# 旧実装（比較用にそのまま残す）
+# ---------------------------------------------------------------------------
+
+def legacy_safe_val(val: Any) -> Any:
+    try:
+        import pandas as pd
+        import numpy as np
+        if pd.isna(val):
+            return None
+    except Exception:
+        pass
+    try:
+        import numpy as np
+        if isinstance(val, (np.integer,)):
+            return int(val)
+        if isinstance(val, (np.floating,)):
+            return float(val)
+    except Exception:
+        pass
+    return val
+
+
+def legacy_df_to_records(df) -> List[dict]:
+    if df is None or df.empty:
+        return []
+    records = []
+    for idx, row in df.iterrows():
+        record = {"date": str(idx)}
+        for col in df.columns:
+            record[str(col)] = legacy_safe_val(row[col])
+        records.append(record)
+    return records
+
+
+def legacy_stmt_to_dict(stmt) -> dict:
+    data = {}
+    for col in stmt.columns:
+        data[str(col)[:10]] = {str(idx): legacy_safe_val(stmt.loc[idx, col]) for idx in stmt.index}
+    return data
+
+
+# ---------------------------------------------------------------------------
+# 合成データ
+# ---------------------------------------------------------------------------
+
+def make_history(rows: int, nan_ratio: float = 0.01, seed: int = 0) -> pd.DataFrame:
+    """yf.Ticker.history() と同じ列構成の日足 DataFrame を生成する。"""
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end="2024-12-31", periods=rows, tz="America/New_York", name="Date")
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, rows)))
+    df = pd.DataFrame({
+        "Open": close * (1 + rng.normal(0, 0.002, rows)),
+        "High": close * 1.01,
+        "Low": close * 0.99,
+        "Close": close,
+        "Volume": rng.integers(1_000_000, 50_000_000, rows),
+        "Dividends": np.zeros(rows),
+        "Stock Splits": np.zeros(rows),
+    }, index=index)
+    mask = rng.random(rows) < nan_ratio
+    df.loc[mask, "Open"] = np.nan
+    return df
+
+
+def make_statement(items: int = 40, periods: int = 5, seed: int = 0) -> pd.DataFrame:
+    """yf.Ticker.income_stmt と同じ形（行=項目、列=期末日）の DataFrame を生成する。"""
+    rng = np.random.default_rng(seed)
+    values = rng.normal(1e9, 5e8, (items, periods))
+    values[rng.random((items, periods)) < 0.1] = np.nan
+    columns = pd.date_range(end="2024-09-30", periods=periods, freq="YE")[::-1]
+    return pd.DataFrame(values, index=[f"Item {i}" for i in range(items)], columns=columns)
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+
+def bench(fn: Callable[[], Any], repeat: int) -> float:
+    """repeat 回実行した最速値（秒）を返す。"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(label: str, legacy: Callable[[], Any], current: Callable[[], Any], repeat: int) -> None:
+    t_legacy = bench(legacy, repeat)
+    t_current = bench(current, repeat)
+    print(f"{label:<28} legacy {t_legacy * 1e3:9.2f} ms   current {t_current * 1e3:9.2f} ms   x{t_legacy / t_current:6.1f}")
+
+
+def report_formats(hist: pd.DataFrame, info: dict, repeat: int) -> None:
+    """price history / valuation の出力フォーマットごとの変換時間と応答サイズ。"""
+    meta = {"ticker": "AAPL", "period": "max", "interval": "1d", "cached": False}
+    cases = [
+        ("history json (indent=2)", lambda: server._dumps({**meta, "records": server._df_to_records(hist)}, server.HistoryFormat.JSON)),
+        ("history compact", lambda: server._dumps({**meta, "records": server._df_to_records(hist)}, server.HistoryFormat.COMPACT)),
+        ("history columns", lambda: server._dumps({**meta, "columns": server._df_to_columns(hist)}, server.HistoryFormat.COLUMNS, indent=None)),
+        ("history csv", lambda: server._df_to_csv(hist)),
+        ("valuation json (all)", lambda: server._dumps(server._info_to_valuation(info), server.ResponseFormat.JSON)),
+        ("valuation compact (3 fields)", lambda: server._dumps(
+            server._info_to_valuation(info, ["currentPrice", "trailingPE", "marketCap"]), server.ResponseFormat.COMPACT)),
+    ]
+    baseline: dict = {}
+    for label, fn in cases:
+        kind = label.split()[0]
+        t, size = bench(fn, repeat), len(fn().encode("utf-8"))
+        t0, size0 = baseline.setdefault(kind, (t, size))
+        print(f"{label:<30} {t * 1e3:9.2f} ms {size / 1024:10.1f} KB   time x{t0 / t:5.1f}  size x{size0 / size:5.1f}")
+
+
+def make_info(seed: int = 0) -> dict:
+    """yf.Ticker.info 相当の dict（longBusinessSummary など長い文字列を含む）。"""
+    rng = np.random.default_rng(seed)
+    info = {k: float(rng.normal(100, 10)) for k in server._VALUATION_FIELDS}
+    info.update({"shortName": "Apple Inc.", "longName": "Apple Inc.", "symbol": "AAPL", "sector": "Technology",
+                 "longBusinessSummary": "Apple Inc. designs, manufactures, and markets smartphones. " * 30})
+    return info
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="ヒストリーの行数（period=max の日足相当は 1 万行超）")
+    parser.add_argument("--repeat", type=int, default=5, help="各計測の繰り返し回数（最速値を採用）")
+    args = parser.parse_args()
+
+    hist = make_history(args.rows)
+    stmt = make_statement()
+
+    # 値の互換性チェック（日付は旧実装が str(Timestamp)、新実装が ISO 日付）
+    old, new = legacy_df_to_records(hist), server._df_to_records(hist)
+    assert [{k: v for k, v in r.items() if k != "date"} for r in old] == [{k: v for k, v in r.items() if k != "date"} for r in new]
+    assert [r["date"][:10] for r in old] == [r["date"] for r in new]
+    assert legacy_stmt_to_dict(stmt) == server._stmt_to_dict(stmt)
+
+    print(f"history: {args.rows} rows x {hist.shape[1]} cols, statement: {stmt.shape[0]} x {stmt.shape[1]}")
+    report("history -> records", lambda: legacy_df_to_records(hist), lambda: server._df_to_records(hist), args.repeat)
+    report(
+        "history -> records -> json",
+        lambda: json.dumps(legacy_df_to_records(hist)),
+        lambda: json.dumps(server._df_to_records(hist)),
+        args.repeat,
+    )
+    report("history -> columns", lambda: legacy_df_to_records(hist), lambda: server._df_to_columns(hist), args.repeat)
+    report("statement -> dict", lambda: legacy_stmt_to_dict(stmt), lambda: server._stmt_to_dict(stmt), args.repeat)
+
+    print()
+    report_formats(hist, make_info(), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+起動時間（time-to-first-response）のベンチマーク
+
+server.py を MCP クライアントと同じように stdio のサブプロセスとして起動し、JSON-RPC で
+initialize → tools/list → 最初の tools/call を順に送って、起動からそれぞれの応答までの時間を測る。
+最初の tools/call には上流に出ないツール（ユニバース未設定の yfinance_screen_universe）を使うので、
+numpy / pandas / yfinance の遅延読み込みにかかる時間だけが乗る。Yahoo にはアクセスしない。
+
+    python bench_startup.py --repeat 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (表示名, 環境変数の上書き)
+CONFIGS = [
+    ("warm imports after 0.5s (default)", {}),
+    ("warm imports immediately", {"YFINANCE_MCP_WARM_IMPORTS_DELAY": "0"}),
+    ("no warm-up (load on first call)", {"YFINANCE_MCP_WARM_IMPORTS_DELAY": "-1"}),
+]
+
+
+class StdioClient:
+    """改行区切り JSON-RPC で server.py と話す最小限のクライアント。"""
+
+    def __init__(self, env: dict):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "server.py")],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, cwd=HERE,
+        )
+
+    def send(self, message: dict) -> None:
+        self.proc.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.proc.stdin.flush()
+
+    def request(self, id_: int, method: str, params: Optional[dict] = None) -> dict:
+        self.send({"jsonrpc": "2.0", "id": id_, "method": method, "params": params or {}})
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise RuntimeError(f"server exited before answering {method}")
+            message = json.loads(line)
+            if message.get("id") == id_:
+                if "error" in message:
+                    raise RuntimeError(f"{method}: {message['error']}")
+                return message["result"]
+
+    def close(self) -> None:
+        self.proc.stdin.close()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def measure(overrides: dict, idle: float) -> List[float]:
+    """起動から initialize / tools/list / 最初の tools/call の応答までの秒数。"""
+    env = {k: v for k, v in os.environ.items() if not k.startswith("YFINANCE_MCP_")}
+    env.update({"YFINANCE_MCP_SCREENER_PREWARM": "", "YFINANCE_MCP_STORE": "0", **overrides})
+    start = time.perf_counter()
+    client = StdioClient(env)
+    try:
+        client.request(1, "initialize", {
+            "protocolVersion": "2025-06-18",
+            "capabilities": {},
+            "clientInfo": {"name": "bench_startup", "version": "0"},
+        })
+        t_init = time.perf_counter() - start
+        client.send({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        tools = client.request(2, "tools/list")["tools"]
+        t_list = time.perf_counter() - start
+        assert tools, "no tools listed"
+        if idle > 0:
+            time.sleep(idle)  # ハンドシェイク後にユーザーが最初の指示を出すまでの間
+        client.request(3, "tools/call", {"name": "yfinance_screen_universe", "arguments": {"params": {}}})
+        t_call = time.perf_counter() - start
+    finally:
+        client.close()
+    return [t_init, t_list, t_call]
+
+
+def heavy_import_time() -> float:
+    """numpy / pandas / yfinance をまとめて import するだけの時間（遅延読み込みで handshake から外した分）。"""
+    code = "import time; t = time.perf_counter(); import numpy, pandas, yfinance; print(time.perf_counter() - t)"
+    return float(subprocess.check_output([sys.executable, "-c", code], cwd=HERE).decode().strip())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="各設定の起動回数（中央値を表示）")
+    parser.add_argument("--idle", type=float, default=1.0, help="tools/list の応答から最初の tools/call を送るまでの秒数")
+    args = parser.parse_args()
+
+    print(f"numpy + pandas + yfinance import: {statistics.median(heavy_import_time() for _ in range(args.repeat)) * 1e3:8.0f} ms")
+    print(f"first tools/call sent {args.idle:g}s after tools/list (times from process spawn, median of {args.repeat})")
+    print()
+    print(f"{'config':<36} {'initialize':>11} {'tools/list':>11} {'first call':>11} {'call wait':>10}")
+    for label, overrides in CONFIGS:
+        runs = [measure(overrides, args.idle) for _ in range(args.repeat)]
+        t_init, t_list, t_call = (statistics.median(r[i] for r in runs) for i in range(3))
+        wait = statistics.median(r[2] - r[1] - args.idle for r in runs)
+        print(f"{label:<36} {t_init * 1e3:8.0f} ms {t_list * 1e3:8.0f} ms {t_call * 1e3:8.0f} ms {wait * 1e3:7.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+MCP ツールのオフラインベンチマーク
+
+yf.Ticker / yf.Screener / yf.download と一括クォートを決定的なローカルの偽データに差し替え、
+全ツールを mcp.call_tool 経由で同時実行数を変えて呼び出す。ツールごとの p50/p99 レイテンシ・
+秒間呼び出し数・ピークメモリ（tracemalloc）と、出力フォーマットごとの時間・応答サイズを表示する。
+Yahoo には一切アクセスしない（ローカルストアは一時ディレクトリに作る）。
+
+    python bench_tools.py --calls 200 --concurrency 1,8,32 --latency 0.02
+    python bench_tools.py --cold --tools yfinance_get_price_history,yfinance_compare_tickers
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+# ---------------------------------------------------------------------------
+# 偽データ
+# ---------------------------------------------------------------------------
+
+class FakeYahoo:
+    """yfinance の代わりに決定的なデータを返す。値は銘柄名から作るシードで決まる。
+
+    rows は 1 回の価格ヒストリーの足の本数、statement_items は財務諸表の項目数、
+    news_items は 1 銘柄あたりの記事数。上流呼び出しのたびに latency 秒（jitter は
+    対数正規の揺らぎの大きさ）だけスレッドを止める。
+    """
+
+    def __init__(self, rows: int, statement_items: int, news_items: int, latency: float, jitter: float, seed: int = 0):
+        self.rows = rows
+        self.statement_items = statement_items
+        self.news_items = news_items
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * self._rng.lognormvariate(0.0, self.jitter) if self.jitter > 0 else self.latency
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def seed_of(symbol: str) -> int:
+        return zlib.crc32(symbol.encode("utf-8"))
+
+    def history(self, symbol: str, interval: str = "1d", start: Any = None) -> pd.DataFrame:
+        import server
+
+        rng = np.random.default_rng(self.seed_of(symbol))
+        minutes = server._INTRADAY_MINUTES.get(interval)
+        end = pd.Timestamp.now(tz="America/New_York").floor("D")
+        if minutes:
+            index = pd.date_range(end=end + pd.Timedelta(hours=16), periods=self.rows, freq=f"{minutes}min", name="Datetime")
+        else:
+            index = pd.bdate_range(end=end.tz_localize(None), periods=self.rows, tz="America/New_York", name="Date")
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, self.rows)))
+        df = pd.DataFrame({
+            "Open": close * (1 + rng.normal(0, 0.002, self.rows)),
+            "High": close * 1.01,
+            "Low": close * 0.99,
+            "Close": close,
+            "Volume": rng.integers(1_000_000, 50_000_000, self.rows),
+            "Dividends": np.zeros(self.rows),
+            "Stock Splits": np.zeros(self.rows),
+        }, index=index)
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start, tz=df.index.tz)]
+        return df
+
+    def info(self, symbol: str) -> dict:
+        import server
+
+        rng = np.random.default_rng(self.seed_of(symbol))
+        info = {k: float(rng.normal(100, 10)) for k in server._VALUATION_FIELDS}
+        info.update({
+            "symbol": symbol, "shortName": f"{symbol} Inc.", "longName": f"{symbol} Incorporated",
+            "sector": "Technology", "industry": "Software", "currency": "USD",
+            "recommendationKey": "buy", "numberOfAnalystOpinions": 30,
+            "targetMeanPrice": 120.0, "targetHighPrice": 150.0, "targetLowPrice": 90.0, "targetMedianPrice": 118.0,
+            "longBusinessSummary": f"{symbol} designs, manufactures, and markets products. " * 30,
+        })
+        return info
+
+    def quote(self, symbol: str) -> dict:
+        import server
+
+        info = self.info(symbol)
+        quote = {src: info.get(dst) for src, dst in server._QUOTE_TO_INFO.items()}
+        quote.update({k: info[k] for k in ("symbol", "shortName", "marketCap", "trailingPE", "forwardPE", "priceToBook") if k in info})
+        return quote
+
+    def statement(self, symbol: str, periods: int) -> pd.DataFrame:
+        rng = np.random.default_rng(self.seed_of(symbol) + periods)
+        values = rng.normal(1e9, 5e8, (self.statement_items, periods))
+        columns = pd.date_range(end="2024-09-30", periods=periods, freq="QE" if periods > 4 else "YE")[::-1]
+        return pd.DataFrame(values, index=[f"Item {i}" for i in range(self.statement_items)], columns=columns)
+
+    def news(self, symbol: str) -> List[dict]:
+        now = int(time.time())
+        return [{
+            "id": f"{symbol}-{i}",
+            "content": {
+                "title": f"{symbol} headline {i}",
+                "pubDate": now - i * 600,
+                "summary": "Lorem ipsum dolor sit amet. " * 8,
+                "provider": {"displayName": "Fake Wire"},
+                "canonicalUrl": {"url": f"https://example.com/{symbol}/{i}"},
+            },
+        } for i in range(self.news_items)]
+
+
+def install(fake: FakeYahoo, patch: Callable[[Any, str, Any], None] = setattr) -> None:
+    """server が参照する yfinance の入口と一括クォートを fake に差し替える。
+
+    patch は差し替えに使う関数（テストでは元に戻せる monkeypatch.setattr を渡す）。
+    """
+    import server
+
+    class Ticker:
+        def __init__(self, symbol: str, session=None):
+            self.symbol = symbol.upper()
+
+        @property
+        def info(self):
+            fake.wait()
+            return fake.info(self.symbol)
+
+        @property
+        def news(self):
+            fake.wait()
+            return fake.news(self.symbol)
+
+        def history(self, period=None, interval="1d", start=None, **_):
+            fake.wait()
+            return fake.history(self.symbol, interval, start)
+
+        def __getattr__(self, name):
+            if name in ("income_stmt", "balance_sheet", "cashflow"):
+                fake.wait()
+                return fake.statement(self.symbol, 4)
+            if name in ("quarterly_income_stmt", "quarterly_balance_sheet", "quarterly_cashflow"):
+                fake.wait()
+                return fake.statement(self.symbol, 5)
+            raise AttributeError(name)
+
+    class Screener:
+        def __init__(self, session=None):
+            self.size = 25
+            self.query = None
+
+        def set_predefined_body(self, query_type):
+            self.query = query_type
+
+        @property
+        def response(self):
+            fake.wait()
+            return {"quotes": [fake.quote(f"S{i:03d}") for i in range(self.size)]}
+
+    def download(symbols, period=None, interval="1d", **_):
+        fake.wait()
+        frames = {sym: fake.history(sym, interval)[["Open", "High", "Low", "Close", "Volume"]] for sym in symbols}
+        return pd.concat(frames, axis=1).swaplevel(axis=1).sort_index(axis=1)
+
+    def download_quotes(symbols):
+        fake.wait()
+        return {sym.upper(): fake.quote(sym.upper()) for sym in symbols}
+
+    patch(server.yf, "Ticker", Ticker)
+    patch(server.yf, "Screener", Screener)
+    patch(server.yf, "download", download)
+    patch(server, "_download_quotes", download_quotes)
+
+
+# ---------------------------------------------------------------------------
+# シナリオ（ツール名 → i 回目の呼び出しの引数）
+# ---------------------------------------------------------------------------
+
+def scenarios(tickers: List[str]) -> Dict[str, Callable[[int], dict]]:
+    def one(i: int) -> str:
+        return tickers[i % len(tickers)]
+
+    def group(i: int, n: int) -> List[str]:
+        return [tickers[(i + k) % len(tickers)] for k in range(min(n, len(tickers)))]
+
+    return {
+        "yfinance_get_valuation": lambda i: {"ticker": one(i)},
+        "yfinance_get_price_history": lambda i: {"ticker": one(i), "period": "5y"},
+        "yfinance_get_price_history_batch": lambda i: {"tickers": group(i, 10)},
+        "yfinance_compute_indicators": lambda i: {"ticker": one(i)},
+        "yfinance_correlation_matrix": lambda i: {"tickers": group(i, 10)},
+        "yfinance_portfolio_risk": lambda i: {
+            "holdings": [{"ticker": t, "weight": 1.0} for t in group(i, 5)], "n_paths": 20_000, "seed": i,
+        },
+        "yfinance_get_income_statement": lambda i: {"ticker": one(i)},
+        "yfinance_get_balance_sheet": lambda i: {"ticker": one(i)},
+        "yfinance_get_cash_flow": lambda i: {"ticker": one(i), "quarterly": True},
+        "yfinance_get_financials": lambda i: {"ticker": one(i)},
+        "yfinance_get_analyst_consensus": lambda i: {"ticker": one(i)},
+        "yfinance_get_news": lambda i: {"ticker": one(i)},
+        "yfinance_get_news_multi": lambda i: {"tickers": group(i, 5)},
+        "yfinance_screen_stocks": lambda i: {"query_type": ("most_actives", "day_gainers", "day_losers")[i % 3]},
+        "yfinance_screen_universe": lambda i: {"filter": "pe < 100", "limit": 20},
+        "yfinance_compare_tickers": lambda i: {"tickers": group(i, 5)},
+    }
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+
+def response_text(result: Any) -> str:
+    """call_tool の戻り値（コンテンツ列、または (コンテンツ列, 構造化結果)）から本文を取り出す。"""
+    if isinstance(result, tuple):
+        result = result[0]
+    return "".join(getattr(block, "text", "") for block in result)
+
+
+async def run_level(name: str, make_args: Callable[[int], dict], calls: int, concurrency: int) -> dict:
+    """name を calls 回、同時に最大 concurrency 件で呼び出す。"""
+    import server
+
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors: List[str] = []
+    size = 0
+
+    async def one(i: int) -> None:
+        nonlocal size
+        async with sem:
+            start = time.perf_counter()
+            text = response_text(await server.mcp.call_tool(name, {"params": make_args(i)}))
+            latencies.append(time.perf_counter() - start)
+            size += len(text.encode("utf-8"))
+            if text.startswith("Error"):
+                errors.append(text)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    wall = time.perf_counter() - start
+    ms = np.array(latencies) * 1e3
+    return {
+        "p50": float(np.percentile(ms, 50)),
+        "p99": float(np.percentile(ms, 99)),
+        "rate": calls / wall,
+        "bytes": size / calls,
+        "errors": errors,
+    }
+
+
+async def peak_memory(name: str, make_args: Callable[[int], dict], calls: int, concurrency: int) -> int:
+    """tracemalloc を有効にして同じ負荷を掛けたときのピーク割り当て量（バイト）。"""
+    tracemalloc.start()
+    try:
+        await run_level(name, make_args, calls, concurrency)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def report_tools(names: List[str], table: dict, calls: int, levels: List[int], memory: bool) -> None:
+    print(f"{'tool':<34} {'conc':>4} {'p50 ms':>9} {'p99 ms':>9} {'calls/s':>9} {'KB/call':>8} {'err':>4}")
+    for name in names:
+        for level in levels:
+            r = await run_level(name, table[name], calls, level)
+            print(f"{name:<34} {level:>4} {r['p50']:9.2f} {r['p99']:9.2f} {r['rate']:9.1f} {r['bytes'] / 1024:8.1f} {len(r['errors']):>4}")
+            if r["errors"]:
+                print(f"    {r['errors'][0][:160]}")
+        if memory:
+            peak = await peak_memory(name, table[name], calls, max(levels))
+            print(f"{'':<34} peak {peak / 2 ** 20:8.1f} MB (tracemalloc, conc={max(levels)})")
+
+
+async def report_formats(ticker: str, calls: int) -> None:
+    """同じデータを出力フォーマットだけ変えて返したときの時間と応答サイズ。"""
+    import server
+
+    cases = [("yfinance_get_price_history", {"ticker": ticker, "period": "max", "response_format": fmt.value}) for fmt in server.HistoryFormat]
+    cases += [("yfinance_get_valuation", {"ticker": ticker, "response_format": fmt.value}) for fmt in server.ResponseFormat]
+    cases += [("yfinance_get_financials", {"ticker": ticker, "response_format": fmt.value}) for fmt in server.ResponseFormat]
+    print(f"{'tool':<34} {'format':<9} {'p50 ms':>9} {'KB':>9}")
+    for name, args in cases:
+        r = await run_level(name, lambda i, args=args: args, calls, 1)
+        print(f"{name:<34} {args['response_format']:<9} {r['p50']:9.2f} {r['bytes'] / 1024:9.1f}")
+
+
+def report_phases(names: List[str]) -> None:
+    """サーバー内蔵メトリクスによる 1 呼び出しあたりの内訳（平均 ms）。"""
+    import server
+
+    tools = server._metrics_snapshot()["tools"]
+    phases = server._PHASES
+    print(f"{'tool':<34} " + " ".join(f"{p:>9}" for p in phases))
+    for name in names:
+        stats = tools.get(name)
+        if not stats:
+            continue
+        avg = [stats["phases"][p]["sum_sec"] / max(stats["phases"][p]["count"], 1) * 1e3 for p in phases]
+        print(f"{name:<34} " + " ".join(f"{v:9.2f}" for v in avg))
+
+
+def configure_env(args: argparse.Namespace, store_dir: str, tickers: List[str]) -> None:
+    """server の import 前に環境変数を設定する（レート制限なし、定期ジョブなし、--cold ならキャッシュ無効）。"""
+    os.environ.update({
+        "YFINANCE_MCP_STORE_DIR": store_dir,
+        "YFINANCE_MCP_UPSTREAM_RATE": str(args.rate),
+        "YFINANCE_MCP_SCREENER_PREWARM": "",
+        "YFINANCE_MCP_WATCHLIST": "",
+        "YFINANCE_MCP_METRICS_PORT": "0",
+        "YFINANCE_MCP_UNIVERSE": ",".join(tickers),
+    })
+    if args.cold:
+        for name in ("INFO_TTL", "INFO_STALE", "STATEMENT_TTL", "STATEMENT_STALE", "QUOTE_TTL", "INTRADAY_TTL", "NEWS_TTL", "SCREENER_TTL"):
+            os.environ[f"YFINANCE_MCP_{name}"] = "0"
+        os.environ["YFINANCE_MCP_STORE"] = "0"
+
+
+async def run(args: argparse.Namespace) -> None:
+    import server
+
+    fake = FakeYahoo(args.rows, args.statement_items, args.news_items, args.latency, args.jitter)
+    install(fake)
+    await server._refresh_universe()  # screen_universe 用のスナップショット
+
+    table = scenarios([f"T{i:03d}" for i in range(args.tickers)])
+    names = [n for n in args.tools.split(",") if n] if args.tools else list(table)
+    unknown = [n for n in names if n not in table]
+    if unknown:
+        raise SystemExit(f"unknown tools: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    mode = "cold (caches off)" if args.cold else "warm (caches on)"
+    print(f"rows={args.rows} latency={args.latency * 1e3:.0f}ms jitter={args.jitter} tickers={args.tickers} calls={args.calls} {mode}")
+    print()
+    await report_tools(names, table, args.calls, levels, not args.no_memory)
+    print()
+    await report_formats("T000", max(args.calls // 10, 5))
+    print()
+    report_phases(names)
+    print()
+    print(f"upstream calls: {fake.calls}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=100, help="ツール・同時実行数ごとの呼び出し回数")
+    parser.add_argument("--concurrency", default="1,8,32", help="同時実行数（カンマ区切り）")
+    parser.add_argument("--tools", default="", help="対象ツール（カンマ区切り、省略時は全ツール）")
+    parser.add_argument("--tickers", type=int, default=20, help="呼び出しに使う銘柄数（少ないほどキャッシュが効く）")
+    parser.add_argument("--rows", type=int, default=1500, help="偽の価格ヒストリー 1 回分の足の本数")
+    parser.add_argument("--statement-items", type=int, default=40, help="偽の財務諸表の項目数")
+    parser.add_argument("--news-items", type=int, default=20, help="偽のニュースの 1 銘柄あたりの記事数")
+    parser.add_argument("--latency", type=float, default=0.02, help="上流呼び出し 1 回あたりの注入遅延（秒）")
+    parser.add_argument("--jitter", type=float, default=0.3, help="注入遅延の揺らぎ（対数正規の σ、0 で固定）")
+    parser.add_argument("--rate", type=float, default=0.0, help="上流ゲートのレート（件/秒、0 で無制限）")
+    parser.add_argument("--cold", action="store_true", help="キャッシュとローカルストアを無効化して毎回上流に出す")
+    parser.add_argument("--no-memory", action="store_true", help="tracemalloc によるピークメモリ計測を省く")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="yfinance_mcp_bench_") as store_dir:
+        configure_env(args, store_dir, [f"T{i:03d}" for i in range(args.tickers)])
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,16 +6,242 @@ yfinance MCP Server
 ニュース、銘柄スクリーニングなどの金融データを提供するMCPサーバー。
 """
 
+import ast
 import asyncio
+import bisect
+import contextvars
+import functools
+import hashlib
+import heapq
+import importlib
 import json
-from typing import Optional, List, Any
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Optional, List, Any, Awaitable, Callable, Tuple
 from enum import Enum
+from statistics import NormalDist
 
-import yfinance as yf
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, field_validator, model_validator
 from mcp.server.fastmcp import FastMCP
+from mcp.server.lowlevel.server import request_ctx
 
-mcp = FastMCP("yfinance_mcp")
+
+class _LazyModule:
+    """最初の属性アクセスで import するモジュールの代理。
+
+    読み込んだらこのモジュールのグローバル変数 alias を実体に置き換えるので、以後の参照に代理のコストはかからない。
+    numpy / pandas / yfinance の読み込みは 1 秒近くかかるため、initialize / list_tools には読み込まずに応答する。
+    """
+
+    def __init__(self, name: str, alias: str):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_alias", alias)
+
+    def _load(self):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value: Any) -> None:
+        setattr(self._load(), attr, value)
+
+    def __repr__(self) -> str:
+        return f"<lazy module {self._name!r}>"
+
+
+np = _LazyModule("numpy", "np")
+pd = _LazyModule("pandas", "pd")
+yf = _LazyModule("yfinance", "yf")
+
+_heavy_ready = False
+_heavy_task: Optional["asyncio.Future"] = None
+
+
+def _load_heavy_modules() -> None:
+    global _heavy_ready
+    for proxy in (np, pd, yf):
+        if isinstance(proxy, _LazyModule):
+            proxy._load()
+    _heavy_ready = True
+
+
+def _start_heavy_import() -> None:
+    """numpy / pandas / yfinance の読み込みをワーカースレッドで始める（実行中なら何もしない）。"""
+    global _heavy_task
+    if _heavy_ready:
+        return
+    if _heavy_task is None or _heavy_task.get_loop() is not asyncio.get_running_loop():
+        _heavy_task = asyncio.ensure_future(asyncio.to_thread(_load_heavy_modules))
+
+
+async def _ensure_heavy_modules() -> None:
+    """重いモジュールが読み込み済みになるまで待つ（読み込みはスレッドで行い、イベントループは止めない）。"""
+    if _heavy_ready:
+        return
+    _start_heavy_import()
+    await asyncio.shield(_heavy_task)
+
+
+@asynccontextmanager
+async def _lifespan(server):
+    """サーバー起動中だけ登録済みのバックグラウンドジョブを動かす（メトリクスの HTTP 公開もここで開始）。
+
+    重いモジュールは IMPORT_WARM_DELAY 秒後（ハンドシェイクの応答を先に返してから）裏で読み込み始める。
+    """
+    _on_startup()
+    try:
+        yield {}
+    finally:
+        await _stop_background_jobs()
+
+
+def _on_startup() -> None:
+    _start_metrics_server()
+    if IMPORT_WARM_DELAY >= 0:
+        asyncio.get_running_loop().call_later(IMPORT_WARM_DELAY, _start_heavy_import)
+    _start_background_jobs()
+
+
+mcp = FastMCP("yfinance_mcp", lifespan=_lifespan)
+
+
+# ---------------------------------------------------------------------------
+# Config
+# ---------------------------------------------------------------------------
+
+def _env_float(name: str, default: float) -> float:
+    """環境変数を float として読む（未設定・不正値はデフォルト）。"""
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    """環境変数を int として読む（未設定・不正値はデフォルト）。"""
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# info キャッシュ: TTL 秒経過までは fresh、さらに STALE 秒までは古い値を返しつつ裏で再取得
+INFO_CACHE_TTL = _env_float("YFINANCE_MCP_INFO_TTL", 300.0)
+INFO_CACHE_STALE = _env_float("YFINANCE_MCP_INFO_STALE", 900.0)
+INFO_CACHE_MAXSIZE = _env_int("YFINANCE_MCP_INFO_MAXSIZE", 512)
+
+# 財務諸表キャッシュ: 3 表 × 年次/四半期を銘柄単位でまとめて保持（決算発表までほぼ変わらない）
+STATEMENT_CACHE_TTL = _env_float("YFINANCE_MCP_STATEMENT_TTL", 3600.0)
+STATEMENT_CACHE_STALE = _env_float("YFINANCE_MCP_STATEMENT_STALE", 86400.0)
+STATEMENT_CACHE_MAXSIZE = _env_int("YFINANCE_MCP_STATEMENT_MAXSIZE", 128)
+
+# 複数銘柄一括取得: v7 quote の有効期間と 1 リクエストあたりの銘柄数
+QUOTE_CACHE_TTL = _env_float("YFINANCE_MCP_QUOTE_TTL", 60.0)
+BATCH_CHUNK_SIZE = _env_int("YFINANCE_MCP_BATCH_CHUNK", 50)
+
+# 上流（Yahoo）呼び出し: 専用スレッド数、トークンバケット（毎秒 RATE 件・最大 BURST 件、RATE=0 で無制限）、
+# ホストごとの同時実行数
+UPSTREAM_WORKERS = _env_int("YFINANCE_MCP_UPSTREAM_WORKERS", 8)
+UPSTREAM_RATE = _env_float("YFINANCE_MCP_UPSTREAM_RATE", 5.0)
+UPSTREAM_BURST = _env_int("YFINANCE_MCP_UPSTREAM_BURST", 10)
+UPSTREAM_PER_HOST = _env_int("YFINANCE_MCP_UPSTREAM_PER_HOST", 4)
+# 上流への HTTP セッションでホストごとに保持する keep-alive 接続の数（yf.download の内部スレッド分も含めて足りるように）
+UPSTREAM_POOL_SIZE = _env_int("YFINANCE_MCP_UPSTREAM_POOL", max(UPSTREAM_WORKERS, 1) * max(UPSTREAM_PER_HOST, 1))
+
+# ヘッジ（2 本目の並行取得）: 直近の取得時間の PERCENTILE 分位を超えたら発行。サンプル不足時は DEFAULT 秒
+HEDGE_PERCENTILE = _env_float("YFINANCE_MCP_HEDGE_PERCENTILE", 95.0)
+HEDGE_MIN_DELAY = _env_float("YFINANCE_MCP_HEDGE_MIN_DELAY", 0.5)
+HEDGE_DEFAULT_DELAY = _env_float("YFINANCE_MCP_HEDGE_DEFAULT_DELAY", 2.0)
+
+# モンテカルロ VaR: 1 チャンクのパス数、プロセスプールを使うパス数の下限、プロセス数（0 で CPU 数）
+RISK_MC_CHUNK = _env_int("YFINANCE_MCP_RISK_MC_CHUNK", 50_000)
+RISK_PROCESS_THRESHOLD = _env_int("YFINANCE_MCP_RISK_PROCESS_THRESHOLD", 500_000)
+RISK_PROCESSES = _env_int("YFINANCE_MCP_RISK_PROCESSES", 0)
+
+# 日中足: 取得済みの細かい足を保持する秒数と、まとめて取得する基準の足（空文字で要求された足をそのまま取得）
+INTRADAY_CACHE_TTL = _env_float("YFINANCE_MCP_INTRADAY_TTL", 60.0)
+INTRADAY_BASE = os.environ.get("YFINANCE_MCP_INTRADAY_BASE", "5m")
+
+# ニュース: 銘柄ごとの記事（記事 ID で重複排除）を上流から取り直さずに返す秒数
+NEWS_CACHE_TTL = _env_float("YFINANCE_MCP_NEWS_TTL", 120.0)
+
+# スクリーナー結果キャッシュ: query_type ごとに最大件数で取得して保持し、よく使うクエリは裏で定期更新
+SCREENER_CACHE_TTL = _env_float("YFINANCE_MCP_SCREENER_TTL", 180.0)
+SCREENER_PREWARM = [q for q in re.split(r"[,\s]+", os.environ.get("YFINANCE_MCP_SCREENER_PREWARM", "most_actives,day_gainers,day_losers")) if q]
+
+def _load_symbols(name: str) -> List[str]:
+    """環境変数 name（カンマ/空白区切り）と name_FILE（1 行 1 銘柄、# 以降はコメント）から銘柄一覧を読む。"""
+    symbols = re.split(r"[,\s]+", os.environ.get(name, ""))
+    path = os.environ.get(f"{name}_FILE")
+    if path:
+        with open(os.path.expanduser(path), encoding="utf-8") as f:
+            symbols += [line.split("#")[0].strip() for line in f]
+    return list(dict.fromkeys(sym.upper() for sym in symbols if sym))
+
+
+# ユニバーススナップショット: 対象銘柄と更新間隔
+UNIVERSE = _load_symbols("YFINANCE_MCP_UNIVERSE")
+UNIVERSE_REFRESH = _env_float("YFINANCE_MCP_UNIVERSE_REFRESH", 900.0)
+UNIVERSE_INFO_REFRESH = _env_float("YFINANCE_MCP_UNIVERSE_INFO_REFRESH", 86400.0)
+
+# 上流応答の記録・再生（負荷試験やオフラインでの再現用）。RECORD に zip のパスを指定すると上流取得の結果と
+# 所要時間を追記し、REPLAY を指定すると上流に出ずに記録から応答する（REPLAY_LATENCY は記録時の所要時間に
+# 掛ける倍率、0 で待たない）。どちらかを指定したときはローカルストアを既定で無効にする（取得キーを揃えるため）
+RECORD_PATH = os.environ.get("YFINANCE_MCP_RECORD", "")
+REPLAY_PATH = os.environ.get("YFINANCE_MCP_REPLAY", "")
+REPLAY_LATENCY = _env_float("YFINANCE_MCP_REPLAY_LATENCY", 1.0)
+
+# 価格ヒストリーのローカルストア（日足以上）。REFRESH 秒以内に取得済みなら上流に問い合わせない
+STORE_ENABLED = os.environ.get("YFINANCE_MCP_STORE", "0" if RECORD_PATH or REPLAY_PATH else "1") != "0"
+STORE_DIR = os.environ.get("YFINANCE_MCP_STORE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "yfinance_mcp", "bars")
+STORE_REFRESH = _env_float("YFINANCE_MCP_STORE_REFRESH", 300.0)
+
+# 複数プロセスで共有する SQLite キャッシュ（空で無効）。info・財務諸表・クォートなどを各キャッシュと同じ
+# 有効期間（TTL + STALE）で保持し、圧縮後の合計が MAX_MB を超えたら古いものから削除する
+SQLITE_PATH = os.environ.get("YFINANCE_MCP_SQLITE_PATH", "")
+SQLITE_MAX_MB = _env_float("YFINANCE_MCP_SQLITE_MAX_MB", 256.0)
+
+# 起動後に numpy / pandas / yfinance を裏で読み込み始めるまでの秒数（負の値で無効。最初のツール呼び出し時に読み込む）
+IMPORT_WARM_DELAY = _env_float("YFINANCE_MCP_WARM_IMPORTS_DELAY", 0.5)
+
+# メトリクスを Prometheus テキスト形式で公開する HTTP ポート（0 で無効）と待ち受けアドレス
+METRICS_PORT = _env_int("YFINANCE_MCP_METRICS_PORT", 0)
+METRICS_HOST = os.environ.get("YFINANCE_MCP_METRICS_HOST", "127.0.0.1")
+
+# ウォッチリスト: 起動時に読み込み、info・直近の足・財務諸表をキャッシュが切れる前に種別ごとの間隔
+# （±JITTER の揺らぎ付き、0 以下でその種別は無効）で裏から取り直す。RATE は先読みが使う上流リクエスト数/秒。
+# 先読みする足（WATCH_HISTORY）は period / interval の列挙型で検証するので Enums の後で読む
+WATCHLIST = _load_symbols("YFINANCE_MCP_WATCHLIST")
+WATCH_INFO_INTERVAL = _env_float("YFINANCE_MCP_WATCH_INFO_INTERVAL", INFO_CACHE_TTL * 0.8)
+WATCH_HISTORY_INTERVAL = _env_float("YFINANCE_MCP_WATCH_HISTORY_INTERVAL", STORE_REFRESH * 0.8)
+WATCH_STATEMENTS_INTERVAL = _env_float("YFINANCE_MCP_WATCH_STATEMENTS_INTERVAL", STATEMENT_CACHE_TTL * 0.8)
+WATCH_JITTER = min(max(_env_float("YFINANCE_MCP_WATCH_JITTER", 0.1), 0.0), 0.5)
+WATCH_RATE = _env_float("YFINANCE_MCP_WATCH_RATE", 1.0)
+
+# HTTP トランスポート（--transport streamable-http / sse）で多数のセッションを受けるときの同時実行数の上限
+# （プロセス全体とセッションごと、0 で無制限）、停止時に実行中の応答を待つ秒数、DNS リバインディング対策で
+# 受け付ける Host ヘッダー（空なら 127.0.0.1 / localhost で待ち受けるときだけ検査する。"*" で検査しない）
+MAX_CONCURRENCY = _env_int("YFINANCE_MCP_MAX_CONCURRENCY", 64)
+SESSION_CONCURRENCY = _env_int("YFINANCE_MCP_SESSION_CONCURRENCY", 8)
+SHUTDOWN_TIMEOUT = _env_float("YFINANCE_MCP_SHUTDOWN_TIMEOUT", 30.0)
+ALLOWED_HOSTS = [h for h in re.split(r"[,\s]+", os.environ.get("YFINANCE_MCP_ALLOWED_HOSTS", "")) if h]
 
 
 # ---------------------------------------------------------------------------
@@ -52,118 +278,3063 @@ class IntervalEnum(str, Enum):
     THREE_MONTHS = "3mo"
 
 
+def _parse_watch_history(value: str) -> List[Tuple[str, str]]:
+    """"period:interval" のカンマ/空白区切りを読む。列挙型にない指定は起動時に警告して除く
+    （そのまま残すと先読みが毎回失敗し続ける）。"""
+    periods = {p.value for p in PeriodEnum}
+    intervals = {i.value for i in IntervalEnum}
+    specs = []
+    for spec in re.split(r"[,\s]+", value):
+        if not spec:
+            continue
+        period, _, interval = spec.partition(":")
+        if period in periods and interval in intervals:
+            specs.append((period, interval))
+        else:
+            print(f"warning: ignoring invalid YFINANCE_MCP_WATCH_HISTORY entry {spec!r} (expected period:interval)", file=sys.stderr)
+    return list(dict.fromkeys(specs))
+
+
+WATCH_HISTORY = _parse_watch_history(os.environ.get("YFINANCE_MCP_WATCH_HISTORY", "1y:1d"))
+
+
+class IndicatorEnum(str, Enum):
+    SMA = "sma"
+    EMA = "ema"
+    RSI = "rsi"
+    MACD = "macd"
+    BOLLINGER = "bollinger"
+    ATR = "atr"
+    VOLATILITY = "volatility"
+    DRAWDOWN = "drawdown"
+
+
+class ShrinkageEnum(str, Enum):
+    NONE = "none"
+    LEDOIT_WOLF = "ledoit_wolf"
+
+
+class VarMethodEnum(str, Enum):
+    HISTORICAL = "historical"
+    PARAMETRIC = "parametric"
+    MONTE_CARLO = "monte_carlo"
+
+
+class StatementEnum(str, Enum):
+    INCOME = "income"
+    BALANCE_SHEET = "balance_sheet"
+    CASH_FLOW = "cash_flow"
+
+
+class DownsampleEnum(str, Enum):
+    OHLC = "ohlc"
+    LTTB = "lttb"
+
+
 class ResponseFormat(str, Enum):
     MARKDOWN = "markdown"
     JSON = "json"
+    COMPACT = "compact"  # インデントなし・短縮キーの JSON
+
+
+class HistoryFormat(str, Enum):
+    MARKDOWN = "markdown"
+    JSON = "json"
+    COMPACT = "compact"
+    COLUMNS = "columns"  # 列指向 JSON（キー名を行ごとに繰り返さない）
+    CSV = "csv"
 
 
 # ---------------------------------------------------------------------------
 # Input Models
 # ---------------------------------------------------------------------------
 
+def _check_fields(fields: Optional[List[str]], allowed: List[str]) -> Optional[List[str]]:
+    """fields 射影の検証。未知の項目名があれば ValueError。重複は除いて順序を保つ。"""
+    if fields is None:
+        return None
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f"未知の項目: {', '.join(unknown)}（指定可能: {', '.join(allowed)}）")
+    return list(dict.fromkeys(fields))
+
+
 class TickerInput(BaseModel):
     model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
     ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T', 'MSFT'）", min_length=1, max_length=20)
-    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown' または 'json'")
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class ValuationInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T', 'MSFT'）", min_length=1, max_length=20)
+    fields: Optional[List[str]] = Field(
+        default=None,
+        description="返す項目名のリスト（例: ['currentPrice','trailingPE','marketCap']）。省略時は全項目",
+        min_length=1,
+    )
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+    @field_validator("fields")
+    @classmethod
+    def _valid_fields(cls, v):
+        return _check_fields(v, _VALUATION_FIELDS)
+
+
+class PriceHistoryInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
+    period: PeriodEnum = Field(default=PeriodEnum.ONE_YEAR, description="取得期間: '1d','5d','1mo','3mo','6mo','1y','2y','5y','10y','ytd','max'")
+    interval: IntervalEnum = Field(default=IntervalEnum.ONE_DAY, description="足の間隔: '1d','1wk','1mo' など")
+    max_points: Optional[int] = Field(
+        default=None,
+        description="返す足の最大本数。超える場合は期間全体を保ったまま間引く（例: period='max' で 500）。省略時は全件",
+        ge=10,
+        le=5000,
+    )
+    downsample: DownsampleEnum = Field(
+        default=DownsampleEnum.OHLC,
+        description="間引き方法: 'ohlc'（連続する足を始値/高値/安値/終値/出来高合計に集約）、'lttb'（終値の形状を保つ足を選択）",
+    )
+    response_format: HistoryFormat = Field(
+        default=HistoryFormat.MARKDOWN,
+        description="出力フォーマット: 'markdown'、'json'（レコード配列）、'compact'（短縮キー）、'columns'（列指向 JSON）、'csv'",
+    )
+
+
+class IndicatorInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
+    period: PeriodEnum = Field(default=PeriodEnum.ONE_YEAR, description="計算に使う期間: '1mo','6mo','1y','5y','max' など（指標の窓より十分長くする）")
+    interval: IntervalEnum = Field(default=IntervalEnum.ONE_DAY, description="足の間隔: '1d','1wk','1mo' など")
+    indicators: List[IndicatorEnum] = Field(
+        default_factory=lambda: list(IndicatorEnum),
+        description="計算する指標: 'sma','ema','rsi','macd','bollinger','atr','volatility','drawdown'（省略時は全て）",
+        min_length=1,
+    )
+    window: int = Field(default=20, description="SMA/EMA/ボリンジャーバンド/ボラティリティの窓（本数）", ge=2, le=250)
+    rsi_window: int = Field(default=14, description="RSI の窓（本数）", ge=2, le=100)
+    atr_window: int = Field(default=14, description="ATR の窓（本数）", ge=2, le=100)
+    macd_fast: int = Field(default=12, description="MACD 短期 EMA の期間", ge=2, le=100)
+    macd_slow: int = Field(default=26, description="MACD 長期 EMA の期間", ge=3, le=200)
+    macd_signal: int = Field(default=9, description="MACD シグナルの期間", ge=2, le=100)
+    bollinger_std: float = Field(default=2.0, description="ボリンジャーバンドの標準偏差の倍率", gt=0, le=5)
+    tail: int = Field(default=1, description="返す直近の本数。1 で最新値のみ、最大 500", ge=1, le=500)
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+    @model_validator(mode="after")
+    def _macd_order(self):
+        if self.macd_fast >= self.macd_slow:  # 逆にすると MACD の符号が反転するだけで、エラーにならない
+            raise ValueError(f"macd_fast（{self.macd_fast}）は macd_slow（{self.macd_slow}）より小さくすること")
+        return self
+
+
+class CorrelationInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    tickers: List[str] = Field(..., description="ティッカーシンボルのリスト（2〜200銘柄）", min_length=2, max_length=200)
+    benchmark: Optional[str] = Field(default="^GSPC", description="ベータ計算の基準指数（例: '^GSPC', '^N225'）。空文字でベータを計算しない", max_length=20)
+    period: PeriodEnum = Field(default=PeriodEnum.ONE_YEAR, description="取得期間: '3mo','6mo','1y','2y','5y' など")
+    interval: IntervalEnum = Field(default=IntervalEnum.ONE_DAY, description="リターンの間隔: '1d','1wk','1mo' など")
+    shrinkage: ShrinkageEnum = Field(default=ShrinkageEnum.NONE, description="共分散の縮小推定: 'none' または 'ledoit_wolf'（銘柄数が多くサンプルが少ない場合に推奨）")
+    include_covariance: bool = Field(default=False, description="True で共分散行列も返す")
+    decimals: int = Field(default=4, description="行列の値の小数点以下桁数", ge=1, le=8)
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class Holding(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
+    weight: float = Field(..., description="保有比率（金額・株数ベースの比率でも可。合計で正規化する。負値は空売り）", ge=-100, le=100)
+
+
+class PortfolioRiskInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    holdings: List[Holding] = Field(..., description="保有銘柄と比率のリスト（例: [{'ticker':'AAPL','weight':0.6},{'ticker':'MSFT','weight':0.4}]）", min_length=1, max_length=100)
+    portfolio_value: Optional[float] = Field(default=None, description="ポートフォリオ評価額。指定すると VaR/CVaR を金額でも返す", gt=0)
+    confidence: float = Field(default=0.99, description="信頼水準（例: 0.95, 0.99）", ge=0.8, le=0.9999)
+    horizon: int = Field(default=1, description="保有期間（interval の足の本数。日足なら営業日数）", ge=1, le=250)
+    period: PeriodEnum = Field(default=PeriodEnum.TWO_YEARS, description="推定に使うヒストリーの期間")
+    interval: IntervalEnum = Field(default=IntervalEnum.ONE_DAY, description="リターンの間隔: '1d','1wk' など")
+    methods: List[VarMethodEnum] = Field(
+        default_factory=lambda: list(VarMethodEnum),
+        description="計算手法: 'historical','parametric','monte_carlo'（省略時は全て）",
+        min_length=1,
+    )
+    n_paths: int = Field(default=100_000, description="モンテカルロのパス数（1,000〜5,000,000）", ge=1_000, le=5_000_000)
+    seed: Optional[int] = Field(default=None, description="乱数シード。同じシードなら同じ結果を再現する（省略時は自動生成して結果に含める）", ge=0)
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class UniverseScreenInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    filter: Optional[str] = Field(
+        default=None,
+        description=(
+            "絞り込み式（Python 風）。例: \"pe < 15 and roe > 0.15\", "
+            "\"sector in ['Technology','Healthcare'] and market_cap > 1e10\", \"dividend_yield >= 0.03 and not isnull(pb)\"。"
+            "使える列は yfinance://universe リソースを参照"
+        ),
+        max_length=1000,
+    )
+    sort: Optional[str] = Field(default="market_cap", description="並べ替えの列または式（例: 'market_cap', 'roe / pe'）。欠損値は常に末尾", max_length=200)
+    descending: bool = Field(default=True, description="True で降順")
+    limit: int = Field(default=25, description="返す銘柄数 (1〜500)", ge=1, le=500)
+    columns: Optional[List[str]] = Field(default=None, description="返す列（省略時は主要列 + 式で使った列）", min_length=1)
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+    @field_validator("columns")
+    @classmethod
+    def _valid_columns(cls, v):
+        return _check_fields(v, list(_UNIVERSE_COLUMNS))
+
+
+class FinancialsInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
+    quarterly: bool = Field(default=False, description="True で四半期データ、False で年次データ")
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class CombinedFinancialsInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
+    quarterly: bool = Field(default=False, description="True で四半期データ、False で年次データ")
+    statements: List[StatementEnum] = Field(
+        default_factory=lambda: list(StatementEnum),
+        description="返す財務諸表: 'income','balance_sheet','cash_flow'（省略時は全て）",
+        min_length=1,
+    )
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class NewsInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
+    count: int = Field(default=10, description="取得するニュース件数 (1〜50)", ge=1, le=50)
+    since: Optional[str] = Field(default=None, description="この日時より後に公開された記事だけを返す（ISO 8601 または UNIX 秒。例: '2025-01-15T09:00:00Z'）")
+    cursor: Optional[str] = Field(
+        default=None,
+        description="前回の応答の next_cursor（不透明な文字列）。指定するとそれ以降にサーバーが新たに取得した記事だけを取得順に返す（ポーリング用）",
+        max_length=64,
+    )
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class MultiNewsInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    tickers: List[str] = Field(..., description="ティッカーシンボルのリスト（例: ['AAPL','MSFT','NVDA']）", min_length=1, max_length=50)
+    count: int = Field(default=20, description="返す記事の総数（公開日時の新しい順、1〜200）", ge=1, le=200)
+    since: Optional[str] = Field(default=None, description="この日時より後に公開された記事だけを返す（ISO 8601 または UNIX 秒）")
+    cursor: Optional[str] = Field(
+        default=None,
+        description="前回の応答の next_cursor（不透明な文字列）。指定するとそれ以降に新たに取得した記事だけを取得順に返す",
+        max_length=64,
+    )
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class ScreenerInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    query_type: str = Field(
+        ...,
+        description=(
+            "スクリーニングクエリ種別。例: 'most_actives', 'day_gainers', 'day_losers', "
+            "'growth_technology_stocks', 'undervalued_growth_stocks', 'aggressive_small_caps', "
+            "'small_cap_gainers', 'undervalued_large_caps', 'most_shorted_stocks'"
+        )
+    )
+    count: int = Field(default=25, description="取得する銘柄数 (1〜100)", ge=1, le=100)
+    fields: Optional[List[str]] = Field(
+        default=None,
+        description="返すクォート項目名のリスト（例: ['symbol','regularMarketPrice','marketCap','forwardPE']）。省略時は主要 7 項目",
+        min_length=1,
+        max_length=50,
+    )
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+class MultiTickerInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    tickers: List[str] = Field(..., description="ティッカーシンボルのリスト（例: ['AAPL','MSFT','GOOG']）", min_length=1, max_length=20)
+    use_batch: bool = Field(
+        default=False,
+        description=(
+            "True で未キャッシュ銘柄を一括クォートでまとめて取得（高速だが ROE・セクター・ベータ・配当利回りなど一部指標は "
+            "info 取得済みの銘柄のみ。クォートの銘柄は配当利回りの代わりに実績利回り trailingAnnualDividendYield を返す）。"
+            "False（デフォルト）で銘柄ごとに info を取得"
+        ),
+    )
+    timeout_per_ticker: float = Field(default=8.0, description="1銘柄あたりの取得期限（秒）。超過した銘柄は timeout として返す", ge=0.5, le=60)
+    total_timeout: float = Field(default=20.0, description="全体の取得期限（秒）。超過時は取得済みの銘柄だけで結果を返す", ge=1, le=120)
+    hedge: bool = Field(default=True, description="True で取得が遅い銘柄に 2 本目のリクエストを並行発行し、早い方を採用する")
+    fields: Optional[List[str]] = Field(
+        default=None,
+        description="返す項目名のリスト（例: ['currentPrice','trailingPE','marketCap']）。ticker/status は常に含む。省略時は全項目",
+        min_length=1,
+    )
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+    @field_validator("fields")
+    @classmethod
+    def _valid_fields(cls, v):
+        return _check_fields(v, _VALUATION_FIELDS)
+
+
+class BatchPriceHistoryInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
+    tickers: List[str] = Field(..., description="ティッカーシンボルのリスト（例: ['AAPL','MSFT','7203.T']）", min_length=1, max_length=100)
+    period: PeriodEnum = Field(default=PeriodEnum.ONE_YEAR, description="取得期間: '1d','5d','1mo','3mo','6mo','1y','2y','5y','10y','ytd','max'")
+    interval: IntervalEnum = Field(default=IntervalEnum.ONE_DAY, description="足の間隔: '1d','1wk','1mo' など")
+    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown'、'json'、'compact'（インデントなし・短縮キーの JSON）")
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+# 所要時間ヒストグラムのバケット上限（秒）。最後に +Inf が続く
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# ツール呼び出しの内訳。upstream は上流待ち（並行取得の重なりは 1 回分）、convert は DataFrame の変換・計算、
+# render は JSON/Markdown/CSV の生成、other は残り（ツール本体での整形やストアの読み書きなど）。
+# queued は同時実行数の上限による実行前の待ちで、total には含めない
+_PHASES = ("total", "upstream", "convert", "render", "other", "queued")
+
+
+class _Histogram:
+    """固定バケットの所要時間ヒストグラム（バケットごとの件数は非累積で持ち、出力時に累積する）。"""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(_LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """バケット内を線形補間した分位の推定値（+Inf バケットに入る場合は最大の上限）。"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(_LATENCY_BUCKETS):
+                    return _LATENCY_BUCKETS[-1]
+                lo = _LATENCY_BUCKETS[i - 1] if i else 0.0
+                return lo + (_LATENCY_BUCKETS[i] - lo) * (rank - seen) / n
+            seen += n
+        return _LATENCY_BUCKETS[-1]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_sec": round(self.sum, 4),
+            **{f"p{int(q * 100)}_sec": _round_opt(self.quantile(q)) for q in (0.5, 0.95, 0.99)},
+        }
+
+
+def _round_opt(value: Optional[float], digits: int = 4) -> Optional[float]:
+    return None if value is None else round(value, digits)
+
+
+class _CallMetrics:
+    """実行中のツール呼び出し 1 回分の計測値（contextvar 経由で下位の処理から加算する）。"""
+
+    __slots__ = ("phases", "upstream", "active")
+
+    def __init__(self):
+        self.phases = {"convert": 0.0, "render": 0.0}
+        self.upstream: List[Tuple[float, float]] = []  # 上流を待っていた区間 (開始, 終了)
+        self.active = False  # convert/render の計測中（入れ子の呼び出しを二重に数えない）
+
+
+_CURRENT_CALL: "contextvars.ContextVar[Optional[_CallMetrics]]" = contextvars.ContextVar("yfinance_mcp_call", default=None)
+
+# (ツール名, 内訳) → _Histogram、ツール名 → {"calls", "errors"}
+_TOOL_LATENCY: dict = {}
+_TOOL_CALLS: dict = {}
+# 取得種別 → {"calls", "errors", "joined"} / (取得種別, "queue"|"fetch") → _Histogram
+_UPSTREAM_CALLS: dict = {}
+_UPSTREAM_HIST: dict = {}
+# (取得種別, 失敗の理由) → 件数。理由は _UPSTREAM_ERROR_REASONS のいずれか（Yahoo の流量制限と認証切れを区別する）
+_UPSTREAM_ERRORS: dict = {}
+_UPSTREAM_ERROR_REASONS = ("rate_limited", "auth", "other")
+# その他のイベント数（ローカルストアの応答種別など）
+_COUNTERS: dict = {}
+
+
+def _count(name: str, n: int = 1) -> None:
+    _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+
+def _observe(table: dict, key: Any, value: float) -> None:
+    hist = table.get(key)
+    if hist is None:
+        hist = table[key] = _Histogram()
+    hist.observe(value)
+
+
+def _union_length(intervals: List[Tuple[float, float]]) -> float:
+    """区間の和集合の長さ（並行して待った上流取得を重ねて数えない）。"""
+    total, end = 0.0, float("-inf")
+    for lo, hi in sorted(intervals):
+        if hi > end:
+            total += hi - max(lo, end)
+            end = hi
+    return total
+
+
+def _record_upstream_wait(start: float, end: float) -> None:
+    call = _CURRENT_CALL.get()
+    if call is not None:
+        call.upstream.append((start, end))
+
+
+def _phase(name: str):
+    """同期関数の実行時間をツール呼び出しの name 内訳に加算するデコレータ（ツール外からの呼び出しは素通し）。"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            call = _CURRENT_CALL.get()
+            if call is None or call.active:
+                return fn(*args, **kwargs)
+            call.active = True
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                call.phases[name] += time.perf_counter() - start
+                call.active = False
+        return wrapper
+    return decorate
+
+
+class _CallSlots:
+    """ツール呼び出しの同時実行数の制限（プロセス全体とセッションごと）。
+
+    先にセッションの枠を取ってから全体の枠を待つので、1 つのセッションが大量に並列で呼び出しても
+    全体の枠は per_session 個までしか占有されず、他のセッションの呼び出しが先に進める。
+    セッションの枠はセッションのオブジェクトが破棄されれば消える。
+    """
+
+    def __init__(self, total: int, per_session: int):
+        self.total = total
+        self.per_session = per_session
+        self._loop = None
+        self._global: Optional[asyncio.Semaphore] = None
+        self._sessions: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self.waiting = 0
+        self.running = 0
+
+    def _semaphores(self, session: Any) -> List[asyncio.Semaphore]:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:  # セマフォはイベントループに紐づくので作り直す
+            self._loop = loop
+            self._global = asyncio.Semaphore(self.total) if self.total > 0 else None
+            self._sessions = weakref.WeakKeyDictionary()
+        sems = []
+        if self.per_session > 0 and session is not None:
+            sem = self._sessions.get(session)
+            if sem is None:
+                sem = self._sessions[session] = asyncio.Semaphore(self.per_session)
+            sems.append(sem)
+        if self._global is not None:
+            sems.append(self._global)
+        return sems
+
+    @asynccontextmanager
+    async def acquire(self, session: Any):
+        sems = self._semaphores(session)
+        held: List[asyncio.Semaphore] = []
+        self.waiting += 1
+        try:
+            for sem in sems:
+                await sem.acquire()
+                held.append(sem)
+        except BaseException:
+            for sem in held:
+                sem.release()
+            raise
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            for sem in reversed(held):
+                sem.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.total,
+            "session_concurrency": self.per_session,
+            "sessions": len(self._sessions),
+            "waiting": self.waiting,
+            "running": self.running,
+        }
+
+
+_CALL_SLOTS = _CallSlots(MAX_CONCURRENCY, SESSION_CONCURRENCY)
+
+
+def _current_session() -> Any:
+    """実行中のリクエストの MCP セッション（リクエストの外では None）。"""
+    ctx = request_ctx.get(None)
+    return ctx.session if ctx is not None else None
+
+
+def _instrumented(fn):
+    """ツール関数の所要時間を内訳付きで記録するデコレータ（@mcp.tool の直下に付ける）。
+
+    functools.wraps でシグネチャと docstring を保つので、FastMCP の入力スキーマは変わらない。
+    "Error" で始まる応答と例外はエラーとして数える。重いモジュールの読み込み待ちは計測に含めない。
+    実行前に _CALL_SLOTS の枠を取り、その待ち時間は queued として total とは別に記録する。
+    """
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        await _ensure_heavy_modules()
+        queued = time.perf_counter()
+        async with _CALL_SLOTS.acquire(_current_session()):
+            call = _CallMetrics()
+            token = _CURRENT_CALL.set(call)
+            start = time.perf_counter()
+            result = None
+            try:
+                result = await fn(*args, **kwargs)
+                return result
+            finally:
+                total = time.perf_counter() - start
+                _CURRENT_CALL.reset(token)
+                upstream = _union_length(call.upstream)
+                phases = {"total": total, "upstream": upstream, **call.phases, "queued": start - queued}
+                phases["other"] = max(total - upstream - call.phases["convert"] - call.phases["render"], 0.0)
+                for phase, value in phases.items():
+                    _observe(_TOOL_LATENCY, (name, phase), value)
+                stats = _TOOL_CALLS.setdefault(name, {"calls": 0, "errors": 0})
+                stats["calls"] += 1
+                if not isinstance(result, str) or result.startswith("Error"):
+                    stats["errors"] += 1
+
+    return wrapper
+
+
+def _cache_stats() -> dict:
+    """キャッシュごとの件数とヒット率（stale で返した分もヒットに含める）。"""
+    caches = {
+        "info": _INFO_CACHE, "statements": _STATEMENT_CACHE, "quote": _QUOTE_CACHE,
+        "batch_history": _BATCH_HISTORY_CACHE, "intraday": _INTRADAY_CACHE, "news": _NEWS_FEEDS,
+        "screener": _SCREENER_CACHE,
+    }
+    out = {}
+    for name, cache in caches.items():
+        lookups = cache.hits + cache.stale_hits + cache.misses
+        out[name] = {
+            "entries": len(cache),
+            "hits": cache.hits,
+            "stale_hits": cache.stale_hits,
+            "misses": cache.misses,
+            "hit_ratio": round((cache.hits + cache.stale_hits) / lookups, 4) if lookups else None,
+        }
+    return out
+
+
+def _metrics_snapshot() -> dict:
+    tools = {}
+    for name, stats in sorted(_TOOL_CALLS.items()):
+        tools[name] = {
+            **stats,
+            "phases": {phase: _TOOL_LATENCY[(name, phase)].summary() for phase in _PHASES if (name, phase) in _TOOL_LATENCY},
+        }
+    upstream = {}
+    for kind, stats in sorted(_UPSTREAM_CALLS.items()):
+        upstream[kind] = {
+            **stats,
+            "errors_by_reason": {reason: _UPSTREAM_ERRORS.get((kind, reason), 0) for reason in _UPSTREAM_ERROR_REASONS},
+            **{stage: _UPSTREAM_HIST[(kind, stage)].summary() for stage in ("queue", "fetch") if (kind, stage) in _UPSTREAM_HIST},
+        }
+    return {
+        "tools": tools,
+        "concurrency": _CALL_SLOTS.stats(),
+        "upstream": {"kinds": upstream, "gate": _UPSTREAM.stats()},
+        "caches": _cache_stats(),
+        "shared_cache": _SHARED.stats() if _SHARED is not None else None,
+        "archive": _ARCHIVE.stats() if _ARCHIVE is not None else None,
+        "counters": dict(_COUNTERS),
+    }
+
+
+def _prom_labels(**labels: Any) -> str:
+    escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"') for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+
+def _prom_histogram(lines: List[str], metric: str, hist: _Histogram, **labels: Any) -> None:
+    cumulative = 0
+    for le, n in zip(_LATENCY_BUCKETS + ("+Inf",), hist.counts):
+        cumulative += n
+        lines.append(f"{metric}_bucket{_prom_labels(**labels, le=le)} {cumulative}")
+    lines.append(f"{metric}_sum{_prom_labels(**labels)} {hist.sum:.6f}")
+    lines.append(f"{metric}_count{_prom_labels(**labels)} {hist.count}")
+
+
+def _prometheus_text() -> str:
+    """メトリクスを Prometheus のテキスト形式（0.0.4）で返す。"""
+    lines = ["# TYPE yfinance_mcp_tool_duration_seconds histogram"]
+    for (tool, phase), hist in sorted(_TOOL_LATENCY.items()):
+        _prom_histogram(lines, "yfinance_mcp_tool_duration_seconds", hist, tool=tool, phase=phase)
+    lines.append("# TYPE yfinance_mcp_tool_calls_total counter")
+    lines.append("# TYPE yfinance_mcp_tool_errors_total counter")
+    for tool, stats in sorted(_TOOL_CALLS.items()):
+        lines.append(f"yfinance_mcp_tool_calls_total{_prom_labels(tool=tool)} {stats['calls']}")
+        lines.append(f"yfinance_mcp_tool_errors_total{_prom_labels(tool=tool)} {stats['errors']}")
+    slots = _CALL_SLOTS.stats()
+    lines += [
+        "# TYPE yfinance_mcp_tool_waiting gauge",
+        f"yfinance_mcp_tool_waiting {slots['waiting']}",
+        "# TYPE yfinance_mcp_tool_running gauge",
+        f"yfinance_mcp_tool_running {slots['running']}",
+        "# TYPE yfinance_mcp_sessions gauge",
+        f"yfinance_mcp_sessions {slots['sessions']}",
+    ]
+
+    lines.append("# TYPE yfinance_mcp_upstream_duration_seconds histogram")
+    for (kind, stage), hist in sorted(_UPSTREAM_HIST.items()):
+        _prom_histogram(lines, "yfinance_mcp_upstream_duration_seconds", hist, kind=kind, stage=stage)
+    for field in ("calls", "errors", "joined"):
+        lines.append(f"# TYPE yfinance_mcp_upstream_{field}_total counter")
+        for kind, stats in sorted(_UPSTREAM_CALLS.items()):
+            lines.append(f"yfinance_mcp_upstream_{field}_total{_prom_labels(kind=kind)} {stats[field]}")
+    lines.append("# TYPE yfinance_mcp_upstream_failures_total counter")
+    for kind in sorted(_UPSTREAM_CALLS):
+        for reason in _UPSTREAM_ERROR_REASONS:
+            value = _UPSTREAM_ERRORS.get((kind, reason), 0)
+            lines.append(f"yfinance_mcp_upstream_failures_total{_prom_labels(kind=kind, reason=reason)} {value}")
+    gate = _UPSTREAM.stats()
+    lines += [
+        "# TYPE yfinance_mcp_upstream_throttle_wait_seconds_total counter",
+        f"yfinance_mcp_upstream_throttle_wait_seconds_total {gate['throttle_wait_sec']}",
+        "# TYPE yfinance_mcp_upstream_waiting gauge",
+        f"yfinance_mcp_upstream_waiting {gate['waiting']}",
+        "# TYPE yfinance_mcp_upstream_running gauge",
+        f"yfinance_mcp_upstream_running {gate['running']}",
+    ]
+
+    caches = _cache_stats()
+    lines.append("# TYPE yfinance_mcp_cache_lookups_total counter")
+    for name, stats in caches.items():
+        for result in ("hits", "stale_hits", "misses"):
+            lines.append(f"yfinance_mcp_cache_lookups_total{_prom_labels(cache=name, result=result)} {stats[result]}")
+    lines.append("# TYPE yfinance_mcp_cache_entries gauge")
+    for name, stats in caches.items():
+        lines.append(f"yfinance_mcp_cache_entries{_prom_labels(cache=name)} {stats['entries']}")
+    for name, value in sorted(_COUNTERS.items()):
+        lines.append(f"# TYPE yfinance_mcp_{name}_total counter")
+        lines.append(f"yfinance_mcp_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+_METRICS_SERVER = None
+
+
+def _start_metrics_server() -> None:
+    """METRICS_PORT が指定されていれば /metrics を返す HTTP サーバーを別スレッドで起動する（プロセスで 1 回）。"""
+    global _METRICS_SERVER
+    if METRICS_PORT <= 0 or _METRICS_SERVER is not None:
+        return
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # 使うときだけ読み込む（起動時間の短縮）
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = _prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # stdio トランスポートの邪魔をしない
+
+    _METRICS_SERVER = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    _METRICS_SERVER.daemon_threads = True
+    threading.Thread(target=_METRICS_SERVER.serve_forever, name="yf-metrics", daemon=True).start()
+
+
+# ---------------------------------------------------------------------------
+# Upstream
+# ---------------------------------------------------------------------------
+
+# 取得種別ごとの接続先ホスト（ホスト単位で同時実行数を制限する）
+_DEFAULT_HOST = "query2.finance.yahoo.com"
+_KIND_HOSTS = {"quote": "query1.finance.yahoo.com", "screener": "query1.finance.yahoo.com"}
+
+
+class _LoopBound:
+    """実行中のイベントループごとに作り直す asyncio のプリミティブ（asyncio.run を繰り返しても使える）。"""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._loop = None
+        self._value = None
+
+    def get(self) -> Any:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._value = self._factory()
+        return self._value
+
+
+class _UpstreamGate:
+    """上流呼び出しの流量制御。
+
+    専用スレッドプールで実行し、実行前にトークンバケット（全体のリクエスト数/秒）と
+    ホスト別セマフォ（同時接続数）を通す。待機数・実行数を stats() で参照できる。
+    """
+
+    def __init__(self, workers: int, rate: float, burst: int, per_host: int):
+        self.workers = max(workers, 1)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.per_host = max(per_host, 1)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._loop = None
+        self._token_lock: Optional[asyncio.Lock] = None
+        self._host_sems: dict = {}
+        self._host_waiting: dict = {}
+        self._host_active: dict = {}
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.throttle_wait = 0.0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="yf-upstream")
+        return self._executor
+
+    def _bind(self) -> None:
+        """ロック・セマフォはイベントループに紐づくので、実行中のループが変わったら作り直す。"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._token_lock = asyncio.Lock()
+            self._host_sems = {}
+
+    async def _take_tokens(self, cost: int) -> None:
+        """cost 個のトークンを到着順に払い出す。
+
+        1 回に払い出すのはバーストまで（残高を負にして後続を待たせない）。バーストを超える一括取得は
+        呼び出し側がバースト以下に分割し、分割ごとに順に通す（_batch_history）。
+        """
+        if self.rate <= 0:
+            return
+        need = min(cost, self.burst)
+        async with self._token_lock:  # 到着順に払い出す
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= need:
+                    self._tokens -= need
+                    return
+                delay = (need - self._tokens) / self.rate
+                self.throttle_wait += delay
+                await asyncio.sleep(delay)
+
+    async def run(self, fn: Callable[[], Any], host: str = _DEFAULT_HOST, cost: int = 1) -> Any:
+        """fn を専用プールで実行する（レート・ホスト同時実行数の制限付き）。"""
+        self._bind()
+        sem = self._host_sems.get(host)
+        if sem is None:
+            sem = self._host_sems[host] = asyncio.Semaphore(self.per_host)
+        self.waiting += 1
+        self._host_waiting[host] = self._host_waiting.get(host, 0) + 1
+        queued = True
+        try:
+            await self._take_tokens(cost)
+            async with sem:
+                self.waiting -= 1
+                self._host_waiting[host] -= 1
+                queued = False
+                self.running += 1
+                self._host_active[host] = self._host_active.get(host, 0) + 1
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(self.executor, fn)
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.running -= 1
+                    self._host_active[host] -= 1
+                    self.completed += 1
+        finally:
+            if queued:
+                self.waiting -= 1
+                self._host_waiting[host] -= 1
+
+    def close(self) -> None:
+        """実行中の取得は待たずにスレッドプールを閉じる（未着手の取得は取り消す）。"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "rate_per_sec": self.rate,
+            "burst": self.burst,
+            "tokens": round(min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate), 2) if self.rate > 0 else None,
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "throttle_wait_sec": round(self.throttle_wait, 3),
+            "hosts": {
+                host: {"limit": self.per_host, "active": self._host_active.get(host, 0), "waiting": self._host_waiting.get(host, 0)}
+                for host in self._host_sems
+            },
+        }
+
+
+_UPSTREAM = _UpstreamGate(UPSTREAM_WORKERS, UPSTREAM_RATE, UPSTREAM_BURST, UPSTREAM_PER_HOST)
+
+
+# ---------------------------------------------------------------------------
+# HTTP Session
+# ---------------------------------------------------------------------------
+
+# crumb の期限切れなど、cookie と crumb を取り直せば通る失敗のメッセージ（小文字）
+_AUTH_ERRORS = ("invalid crumb", "invalid cookie", "unauthorized")
+
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
+_crumb_generation = 0
+
+
+def _http_session():
+    """上流呼び出しで共有する HTTP セッション（初回に作成）。
+
+    yfinance が使っている HTTP ライブラリ（curl_cffi 版なら curl_cffi、それ以外は requests）のセッションを
+    1 つだけ作り、yfinance の共有データ層（YfData）に登録する。keep-alive の接続と cookie・crumb を
+    全ツール・全スレッドで使い回すので、呼び出しごとの TLS ハンドシェイクと crumb の取得がなくなる。
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None:
+        return _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            import yfinance.data
+
+            if yfinance.data.requests.__name__.startswith("curl_cffi"):
+                from curl_cffi import requests as curl_requests
+
+                session = curl_requests.Session(impersonate="chrome")  # 接続はスレッドごとの curl ハンドルで再利用される
+            else:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                # 既定のプール（ホストごとに 10 接続）では並行取得のたびに接続が捨てられ、張り直しになる
+                adapter = HTTPAdapter(pool_connections=len(_KIND_HOSTS) + 2, pool_maxsize=max(UPSTREAM_POOL_SIZE, 1))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+            yfinance.data.YfData(session=session)
+            _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+
+def _ticker(symbol: str):
+    """共有セッションを使う yf.Ticker。"""
+    return yf.Ticker(symbol, session=_http_session())
+
+
+def _screener():
+    """共有セッションを使う yf.Screener。"""
+    return yf.Screener(session=_http_session())
+
+
+def _is_auth_error(e: Exception) -> bool:
+    response = getattr(e, "response", None)
+    if getattr(response, "status_code", None) == 401:
+        return True
+    text = str(e).lower()
+    return any(marker in text for marker in _AUTH_ERRORS)
+
+
+def _error_reason(e: Exception) -> str:
+    """上流の失敗を rate_limited（429 / YFRateLimitError）・auth（401/403・crumb 切れ）・other に分類する。"""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    text = str(e).lower()
+    if (
+        status == 429 or any(cls.__name__ == "YFRateLimitError" for cls in type(e).__mro__)
+        or "too many requests" in text or "rate limit" in text
+    ):
+        return "rate_limited"
+    if status == 403 or _is_auth_error(e):
+        return "auth"
+    return "other"
+
+
+def _reset_crumb(generation: int) -> None:
+    """yfinance が保持している cookie と crumb を捨てる（次のリクエストで取り直される）。
+
+    同じ期限切れを複数のスレッドが同時に見ても、取り直しは最初の 1 回だけにする。cookie・crumb は
+    YfData の内部属性なので、想定した属性がない yfinance では共有セッションを作り直して YfData に
+    登録し直す（新しいセッションには cookie がないので、次のリクエストで取り直される）。
+    """
+    global _crumb_generation, _HTTP_SESSION
+    from yfinance import cache
+    from yfinance.data import YfData
+
+    session = _http_session()
+    data = YfData(session=session)
+    with _HTTP_SESSION_LOCK:
+        if generation != _crumb_generation:
+            return
+        _crumb_generation += 1
+        lock = getattr(data, "_cookie_lock", None)
+        if lock is not None and hasattr(data, "_cookie") and hasattr(data, "_crumb"):
+            with lock:
+                data._cookie = None
+                data._crumb = None
+                session.cookies.clear()
+            rebuild = False
+        else:
+            _HTTP_SESSION = None  # 実行中の呼び出しが使っているかもしれないので古いセッションは閉じない
+            rebuild = True
+        try:
+            cache.get_cookie_cache().store("basic", None)  # ディスクに保存された cookie も再利用させない
+        except Exception:
+            pass
+    if rebuild:
+        _http_session()
+    _count("crumb_resets")
+
+
+def _call_with_crumb_retry(fn: Callable[[], Any]) -> Any:
+    """fn を実行し、crumb / cookie の期限切れで失敗したら取り直して 1 回だけ再試行する（ブロッキング）。"""
+    generation = _crumb_generation
+    try:
+        return fn()
+    except Exception as e:
+        if not _is_auth_error(e):
+            raise
+        _reset_crumb(generation)
+    return fn()
+
+
+# ---------------------------------------------------------------------------
+# Record / Replay
+# ---------------------------------------------------------------------------
+
+class _UpstreamArchive:
+    """上流取得の結果を zip に記録し、あとで上流に出ずに再生する。
+
+    記録では取得ごとに 1 エントリ（結果または例外と所要時間の pickle）を追記する。エントリ名は
+    "種別/取得キーの SHA-1-通し番号.pkl" で、ファイルは書き込みのたびに閉じるので途中で止めても壊れない。
+    再生では同じ取得キーに記録順で応答し（使い切ったら最後の応答を繰り返す）、記録時の所要時間 ×
+    latency_scale だけワーカースレッドで待つ。記録にないキーは LookupError にする。
+    """
+
+    def __init__(self, path: str, replay: bool, latency_scale: float = 1.0):
+        self.path = os.path.expanduser(path)
+        self.replay = replay
+        self.latency_scale = max(latency_scale, 0.0)
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._names: dict = {}  # 取得キーのダイジェスト → [エントリ名]（通し番号順）
+        self._seq: dict = {}  # 取得キーのダイジェスト → 次に記録・再生する番号
+        self._zip: Optional[zipfile.ZipFile] = None
+        if replay:
+            self._zip = zipfile.ZipFile(self.path)
+        elif not os.path.exists(self.path):
+            # 再生時に pickle を復元するので、新しく記録するファイルは所有者だけが読み書きできる 0600 で作る
+            os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600))
+        if replay or os.path.getsize(self.path) > 0:
+            with zipfile.ZipFile(self.path) as zf:
+                for name in sorted(zf.namelist()):
+                    digest = name.rsplit("/", 1)[-1].rsplit("-", 1)[0]
+                    self._names.setdefault(digest, []).append(name)
+            if not replay:  # 既存の記録に追記するときは通し番号を続きから振る
+                self._seq = {digest: len(names) for digest, names in self._names.items()}
+
+    @staticmethod
+    def _digest(kind: str, key: tuple) -> str:
+        return hashlib.sha1(repr((kind, key)).encode("utf-8")).hexdigest()[:20]
+
+    def call(self, kind: str, key: tuple, fn: Callable[[], Any]) -> Any:
+        """記録モードなら fn を実行して結果を記録し、再生モードなら記録から応答する（ブロッキング）。"""
+        if self.replay:
+            return self._replay(kind, key)
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            self._record(kind, key, {"error": e}, time.perf_counter() - start)
+            raise
+        self._record(kind, key, {"result": result}, time.perf_counter() - start)
+        return result
+
+    def _record(self, kind: str, key: tuple, outcome: dict, latency: float) -> None:
+        entry = {"kind": kind, "key": key, "latency": latency, **outcome}
+        try:
+            payload = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            if "error" not in outcome:
+                return
+            error = outcome["error"]  # pickle できない例外は型名とメッセージだけ残す
+            entry["error"] = RuntimeError(f"{type(error).__name__}: {error}")
+            payload = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = self._digest(kind, key)
+        with self._lock:
+            seq = self._seq.get(digest, 0)
+            self._seq[digest] = seq + 1
+            with zipfile.ZipFile(self.path, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(f"{kind}/{digest}-{seq:05d}.pkl", payload)
+            self.recorded += 1
+
+    def _replay(self, kind: str, key: tuple) -> Any:
+        digest = self._digest(kind, key)
+        with self._lock:
+            names = self._names.get(digest)
+            if not names:
+                self.misses += 1
+                raise LookupError(f"no recorded upstream response for {kind} {key!r}")
+            seq = self._seq.get(digest, 0)
+            self._seq[digest] = seq + 1
+            payload = self._zip.read(names[min(seq, len(names) - 1)])
+            self.replayed += 1
+        entry = pickle.loads(payload)
+        if self.latency_scale > 0:
+            time.sleep(entry["latency"] * self.latency_scale)
+        if "error" in entry:
+            raise entry["error"]
+        return entry["result"]
+
+    def close(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "mode": "replay" if self.replay else "record",
+            "keys": len(self._names) if self.replay else len(self._seq),
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses,
+            **({"latency_scale": self.latency_scale} if self.replay else {}),
+        }
+
+
+# リスク計算のプロセスプール（spawn）のワーカーもこのモジュールを読み込み直すが、_mc_tail を呼ぶだけなので
+# 記録ファイルや SQLite は開かない（親が追記中の zip を開いて BadZipFile になるのを避ける）
+_IN_POOL_WORKER = multiprocessing.current_process().name != "MainProcess"
+
+_ARCHIVE: Optional[_UpstreamArchive] = (
+    None if _IN_POOL_WORKER
+    else _UpstreamArchive(REPLAY_PATH, replay=True, latency_scale=REPLAY_LATENCY) if REPLAY_PATH
+    else _UpstreamArchive(RECORD_PATH, replay=False) if RECORD_PATH
+    else None
+)
+
+
+# ---------------------------------------------------------------------------
+# Cache
+# ---------------------------------------------------------------------------
+
+class _TTLCache:
+    """TTL と最大件数（LRU）で制限されたインメモリキャッシュ。
+
+    格納から ttl 秒以内は fresh、さらに stale 秒以内は stale として値を返す
+    （呼び出し側がバックグラウンドで再取得する）。それを過ぎたエントリは破棄する。
+    イベントループ上からのみ操作する前提でロックは持たない。
+    shared に種別名を与えると、set した値を共有キャッシュ（_SHARED）にも書き込む。
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale: float = 0.0, shared: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale = stale
+        self.shared = shared
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key: Any) -> Tuple[Any, Optional[str]]:
+        """(値, 状態) を返す。状態は 'fresh' / 'stale' / None（ミス）。"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        stored_at, value = entry
+        age = time.monotonic() - stored_at
+        if age < self.ttl:
+            state = "fresh"
+            self.hits += 1
+        elif age < self.ttl + self.stale:
+            state = "stale"
+            self.stale_hits += 1
+        else:
+            del self._data[key]
+            self.misses += 1
+            return None, None
+        self._data.move_to_end(key)
+        return value, state
+
+    def set(self, key: Any, value: Any, age: Optional[float] = None) -> None:
+        """値を格納する。age は共有キャッシュから読んだ値の経過秒数（指定時は共有キャッシュに書き戻さない）。"""
+        self._data[key] = (time.monotonic() - (age or 0.0), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        if age is None and self.shared and _SHARED is not None:
+            _SHARED.submit(self.shared, repr(key), value, self.ttl + self.stale)
+
+    def invalidate(self, key: Any = None) -> None:
+        """key を削除する。key 省略時は全件削除。"""
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _SharedCache:
+    """複数のサーバープロセスで共有する SQLite（WAL モード）のキャッシュ層。
+
+    値は pickle を zlib 圧縮して (種別, キー) ごとに 1 行で保存し、期限（expires_at）を過ぎた行は
+    読まない。書き込みは専用の 1 スレッドに順に流してイベントループを止めず、_SHARED_EVICT_EVERY 件
+    ごとに期限切れの行と、合計サイズが max_bytes を超えた分を古い順に削除する。読み書きの失敗は
+    キャッシュミスとして扱う（上流から取り直すだけ）。
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.writes = 0
+        self.errors = 0
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yf-sqlite")
+
+    def _conn(self) -> sqlite3.Connection:
+        """スレッドごとの接続（初回に WAL を有効化してテーブルを作る）。
+
+        payload は読み込み時に pickle で復元するので、ファイルは所有者だけが読み書きできる 0600 で作る
+        （-wal / -shm は SQLite が本体と同じパーミッションで作る）。既存のファイルの権限は変えない。
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (kind TEXT NOT NULL, key TEXT NOT NULL, stored_at REAL NOT NULL,"
+                " expires_at REAL NOT NULL, size INTEGER NOT NULL, payload BLOB NOT NULL, PRIMARY KEY (kind, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_stored_at ON cache (stored_at)")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, kind: str, keys: List[str]) -> dict:
+        """{キー: (値, 経過秒数)} を返す（期限切れ・未保存のキーは含めない）。"""
+        now = time.time()
+        out = {}
+        conn = self._conn()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(
+                f"SELECT key, stored_at, payload FROM cache WHERE kind = ? AND expires_at > ? AND key IN ({','.join('?' * len(chunk))})",
+                (kind, now, *chunk),
+            ).fetchall()
+            for key, stored_at, payload in rows:
+                try:
+                    out[key] = (pickle.loads(zlib.decompress(payload)), max(now - stored_at, 0.0))
+                except Exception:
+                    self.errors += 1  # 別バージョンの pandas で書かれた行など。ミスとして扱う
+        return out
+
+    def put(self, kind: str, key: str, value: Any, lifetime: float) -> None:
+        payload = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 3)
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO cache (kind, key, stored_at, expires_at, size, payload) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, key, now, now + lifetime, len(payload), payload),
+        )
+        self.writes += 1
+        if self.writes % _SHARED_EVICT_EVERY == 0:
+            self.evict()
+
+    def _put_quietly(self, kind: str, key: str, value: Any, lifetime: float) -> None:
+        try:
+            self.put(kind, key, value, lifetime)
+        except Exception:
+            self.errors += 1
+
+    def submit(self, kind: str, key: str, value: Any, lifetime: float) -> None:
+        """書き込みスレッドに put を依頼する（完了を待たない）。"""
+        if lifetime > 0:
+            self._writer.submit(self._put_quietly, kind, key, value, lifetime)
+
+    def close(self) -> None:
+        """依頼済みの書き込みを最後まで流してから書き込みスレッドを止める。"""
+        self._writer.shutdown(wait=True)
+
+    def evict(self) -> None:
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0] - self.max_bytes * 0.9
+        if excess <= 0:
+            return
+        victims = []
+        for kind, key, size in conn.execute("SELECT kind, key, size FROM cache ORDER BY stored_at"):
+            victims.append((kind, key))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM cache WHERE kind = ? AND key = ?", victims)
+
+    def stats(self) -> dict:
+        try:
+            rows = self._conn().execute("SELECT kind, COUNT(*), SUM(size) FROM cache GROUP BY kind").fetchall()
+        except Exception as e:
+            return {"path": self.path, "error": f"{type(e).__name__}: {e}"}
+        return {
+            "path": self.path,
+            "max_bytes": self.max_bytes,
+            "bytes": sum(size for _, _, size in rows),
+            "kinds": {kind: {"entries": n, "bytes": size} for kind, n, size in rows},
+            "writes": self.writes,
+            "errors": self.errors,
+        }
+
+
+# 共有キャッシュの掃除（期限切れ・容量超過の削除）を行う書き込み件数の間隔
+_SHARED_EVICT_EVERY = 100
+_SHARED: Optional[_SharedCache] = (
+    _SharedCache(SQLITE_PATH, int(SQLITE_MAX_MB * 2 ** 20)) if SQLITE_PATH and not _IN_POOL_WORKER else None
+)
+
+
+async def _cache_get_many(cache: _TTLCache, keys: List[Any]) -> dict:
+    """keys を cache から引き、無いものは共有キャッシュから補う。{キー: (値, 'fresh'|'stale')} を返す（ミスは含めない）。
+
+    共有キャッシュで見つかった値は経過時間を保ったまま cache に載せる。
+    """
+    found = {}
+    missing = []
+    for key in keys:
+        value, state = cache.get(key)
+        if state:
+            found[key] = (value, state)
+        else:
+            missing.append(key)
+    if not missing or not cache.shared or _SHARED is None:
+        return found
+    texts = {repr(key): key for key in missing}
+    try:
+        rows = await asyncio.to_thread(_SHARED.get_many, cache.shared, list(texts))
+    except Exception:
+        _SHARED.errors += 1
+        return found
+    _count("shared_cache_hits", len(rows))
+    _count("shared_cache_misses", len(missing) - len(rows))
+    for text, (value, age) in rows.items():
+        key = texts[text]
+        cache.set(key, value, age=age)
+        found[key] = (value, "fresh" if age < cache.ttl else "stale")
+    return found
+
+
+async def _cache_get(cache: _TTLCache, key: Any) -> Tuple[Any, Optional[str]]:
+    """cache.get と同じ (値, 状態) を返す。ミス時は共有キャッシュも引く。"""
+    value, state = cache.get(key)
+    if state or not cache.shared or _SHARED is None:
+        return value, state
+    return (await _cache_get_many(cache, [key])).get(key, (None, None))
+
+
+_INFO_CACHE = _TTLCache(INFO_CACHE_MAXSIZE, INFO_CACHE_TTL, INFO_CACHE_STALE, shared="info")
+
+# stale エントリの再取得タスク（重複起動防止と GC 回避のため参照を保持）
+_REFRESHING: dict = {}
+
+
+async def _cached(
+    cache: _TTLCache,
+    key: Any,
+    fetch: Callable[[], Awaitable[Any]],
+    cacheable: Callable[[Any], bool] = bool,
+) -> Tuple[Any, bool]:
+    """cache を引き、ミス時は fetch() の結果を格納して返す。
+
+    Returns:
+        (値, キャッシュから返したか)
+    """
+    value, state = await _cache_get(cache, key)
+    if state == "fresh":
+        return value, True
+    if state == "stale":
+        refresh_key = (id(cache), key)
+        if refresh_key not in _REFRESHING:
+            async def _refresh():
+                try:
+                    fresh = await fetch()
+                    if cacheable(fresh):
+                        cache.set(key, fresh)
+                except Exception:
+                    pass  # 古い値を使い続け、次回アクセスで再試行する
+                finally:
+                    _REFRESHING.pop(refresh_key, None)
+
+            _REFRESHING[refresh_key] = asyncio.create_task(_refresh())
+        return value, True
+    value = await fetch()
+    if cacheable(value):
+        cache.set(key, value)
+    return value, False
+
+
+# 実行中の上流取得（キー → Task）。同一キーの同時呼び出しはこの Task を共有する
+_INFLIGHT: dict = {}
+
+# 取得種別ごとの直近の所要時間（秒）。ヘッジの発行タイミングに使う
+_UPSTREAM_LATENCY: dict = {}
+
+
+async def _timed_upstream(fn: Callable[[], Any], kind: str, cost: int = 1, key: Optional[tuple] = None) -> Any:
+    """上流取得を実行し、所要時間を種別ごとに記録する（ゲート・スレッドプールの待ちと取得そのものを分ける）。
+
+    key は取得キー。記録・再生が有効なら key ごとに _ARCHIVE を通す。
+    """
+    started: List[float] = []
+
+    def call():
+        started.append(time.perf_counter())
+        if _ARCHIVE is not None and key is not None:
+            return _ARCHIVE.call(kind, key, lambda: _call_with_crumb_retry(fn))
+        return _call_with_crumb_retry(fn)
+
+    stats = _UPSTREAM_CALLS.setdefault(kind, {"calls": 0, "errors": 0, "joined": 0})
+    stats["calls"] += 1
+    start = time.perf_counter()
+    try:
+        result = await _UPSTREAM.run(call, _KIND_HOSTS.get(kind, _DEFAULT_HOST), cost)
+    except Exception as e:
+        stats["errors"] += 1
+        reason = (kind, _error_reason(e))
+        _UPSTREAM_ERRORS[reason] = _UPSTREAM_ERRORS.get(reason, 0) + 1
+        raise
+    finally:
+        end = time.perf_counter()
+        _record_upstream_wait(start, end)
+        if started:
+            _observe(_UPSTREAM_HIST, (kind, "queue"), started[0] - start)
+            _observe(_UPSTREAM_HIST, (kind, "fetch"), end - started[0])
+    _UPSTREAM_LATENCY.setdefault(kind, deque(maxlen=256)).append(end - start)
+    return result
+
+
+def _hedge_delay(kind: str) -> float:
+    """ヘッジを発行するまでの待ち時間（直近の所要時間の HEDGE_PERCENTILE 分位）。"""
+    samples = sorted(_UPSTREAM_LATENCY.get(kind, ()))
+    if len(samples) < 20:
+        return HEDGE_DEFAULT_DELAY
+    pos = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+    return max(HEDGE_MIN_DELAY, samples[pos])
+
+
+def _flight_done(key: tuple, task: "asyncio.Future") -> None:
+    _INFLIGHT.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # 待機者が全員キャンセルされても警告を出さない
+
+
+async def _fetch_upstream(
+    fn: Callable[[], Any],
+    kind: str,
+    ticker: str,
+    period: Optional[str] = None,
+    interval: Optional[str] = None,
+    quarterly: Optional[bool] = None,
+    extra: Any = None,
+    cost: int = 1,
+) -> Any:
+    """ブロッキングな上流取得 fn を _UPSTREAM 経由で実行する（single-flight）。
+
+    (ticker, kind, period, interval, quarterly, extra) が同じ呼び出しが実行中なら
+    新たにスレッドを起こさず、その結果を待つ。呼び出し元がキャンセルされても
+    共有中の取得は継続する。cost は消費するトークン数（内部で複数リクエストを
+    発行する一括取得用。ゲートはバーストを超える分を数えないので、それより大きな取得は分割して呼ぶ）。
+    """
+    key = (ticker, kind, period, interval, quarterly, extra)
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_timed_upstream(fn, kind, cost, key))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _flight_done(key, t))
+    else:
+        _UPSTREAM_CALLS.setdefault(kind, {"calls": 0, "errors": 0, "joined": 0})["joined"] += 1
+    start = time.perf_counter()
+    try:
+        return await asyncio.shield(task)
+    finally:
+        _record_upstream_wait(start, time.perf_counter())
+
+
+async def _get_info(ticker: str) -> Tuple[dict, bool]:
+    """yf.Ticker(ticker).info を共有キャッシュ経由で取得する。(info, キャッシュ由来か) を返す。"""
+    return await _cached(_INFO_CACHE, ticker, lambda: _fetch_upstream(lambda: _ticker(ticker).info, "info", ticker))
+
+
+async def _get_info_hedged(ticker: str, hedge: bool = True) -> Tuple[dict, bool]:
+    """_get_info に加え、_hedge_delay('info') を過ぎても終わらなければ 2 本目を並行発行する。
+
+    2 本目は single-flight を通さずに上流へ出し、先に成功した方を返す（両方失敗したら
+    1 本目の例外を送出）。採用されなかった方は待たずに捨てる。
+    """
+    primary = asyncio.ensure_future(_get_info(ticker))
+    if not hedge:
+        return await primary
+
+    async def _second() -> Tuple[dict, bool]:
+        info = await _timed_upstream(lambda: _ticker(ticker).info, "info", key=(ticker, "info", None, None, None, None))
+        if info:
+            _INFO_CACHE.set(ticker, info)
+        return info, False
+
+    pending = {primary}
+    try:  # 呼び出し側の期限で途中キャンセルされても、どちらの取得も finally で取り消す
+        done, pending = await asyncio.wait(pending, timeout=_hedge_delay("info"))
+        if done:
+            return primary.result()
+        pending = {primary, asyncio.ensure_future(_second())}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception():
+                    return task.result()
+        return primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _cache_note(cached: bool) -> List[str]:
+    """Markdown 出力末尾に付けるキャッシュ利用の注記。"""
+    return ["", "_（キャッシュ済みデータ）_"] if cached else []
+
+
+# ---------------------------------------------------------------------------
+# Background Jobs
+# ---------------------------------------------------------------------------
+
+# 名前 → 1 回分の処理（次回までの待ち秒数を返す coroutine 関数）
+_BACKGROUND_JOBS: dict = {}
+_JOB_TASKS: dict = {}
+_JOB_STATUS: dict = {}
+_JOB_RETRY_DELAY = 60.0
+_job_users = 0
+
+
+def _background_job(name: str):
+    """バックグラウンドジョブとして登録するデコレータ。"""
+    def register(fn: Callable[[], Awaitable[float]]):
+        _BACKGROUND_JOBS[name] = fn
+        return fn
+    return register
+
+
+async def _run_job(name: str, fn: Callable[[], Awaitable[float]]) -> None:
+    status = _JOB_STATUS.setdefault(name, {"runs": 0, "errors": 0, "last_run": None, "last_error": None})
+    await asyncio.sleep(max(IMPORT_WARM_DELAY, 0.0))  # ハンドシェイクの応答を先に返す
+    while True:
+        try:
+            delay = await fn()
+            status["last_error"] = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            status["errors"] += 1
+            status["last_error"] = f"{type(e).__name__}: {e}"
+            delay = _JOB_RETRY_DELAY
+        status["runs"] += 1
+        status["last_run"] = time.time()
+        await asyncio.sleep(delay)
+
+
+def _start_background_jobs() -> None:
+    """登録済みジョブを起動する（複数セッションから呼ばれても 1 回だけ）。"""
+    global _job_users
+    _job_users += 1
+    if _job_users == 1:
+        for name, fn in _BACKGROUND_JOBS.items():
+            _JOB_TASKS[name] = asyncio.create_task(_run_job(name, fn))
+
+
+async def _stop_background_jobs() -> None:
+    """最後の利用者が抜けたらジョブを止める。"""
+    global _job_users
+    _job_users -= 1
+    if _job_users > 0:
+        return
+    tasks = list(_JOB_TASKS.values())
+    _JOB_TASKS.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# ---------------------------------------------------------------------------
+# Financial Statements
+# ---------------------------------------------------------------------------
+
+# StatementEnum → (年次属性, 四半期属性, 表示名, JSON の type)
+_STATEMENTS = {
+    StatementEnum.INCOME: ("income_stmt", "quarterly_income_stmt", "損益計算書", "income_statement"),
+    StatementEnum.BALANCE_SHEET: ("balance_sheet", "quarterly_balance_sheet", "貸借対照表", "balance_sheet"),
+    StatementEnum.CASH_FLOW: ("cashflow", "quarterly_cashflow", "キャッシュフロー計算書", "cash_flow"),
+}
+
+_STATEMENT_CACHE = _TTLCache(STATEMENT_CACHE_MAXSIZE, STATEMENT_CACHE_TTL, STATEMENT_CACHE_STALE, shared="statements")
+
+
+def _download_statements(ticker: str) -> dict:
+    """1 つの yf.Ticker から 3 表 × 年次/四半期の 6 フレームを取得する。キーは (StatementEnum, quarterly)。"""
+    t = _ticker(ticker)
+    frames = {}
+    for kind, (annual, quarterly, _, _) in _STATEMENTS.items():
+        frames[(kind, False)] = getattr(t, annual)
+        frames[(kind, True)] = getattr(t, quarterly)
+    return frames
+
+
+def _has_statements(frames: dict) -> bool:
+    return any(df is not None and not df.empty for df in frames.values())
+
+
+async def _fetch_statements(ticker: str) -> dict:
+    return await _fetch_upstream(lambda: _download_statements(ticker), "statements", ticker, cost=len(_STATEMENTS) * 2)
+
+
+async def _get_statements(ticker: str) -> Tuple[dict, bool]:
+    """全財務諸表を銘柄単位のキャッシュ経由で取得する。(frames, キャッシュ由来か) を返す。
+
+    どの表を求められても 6 フレームをまとめて 1 ジョブで取得するため、続けて別の表や
+    四半期/年次を求められてもキャッシュから返せる。
+    """
+    return await _cached(_STATEMENT_CACHE, ticker, lambda: _fetch_statements(ticker), cacheable=_has_statements)
+
+
+async def _statement_tool(ticker: str, kinds: List[StatementEnum], quarterly: bool, response_format: ResponseFormat) -> str:
+    """財務諸表ツール共通の取得・整形処理。kinds が 1 つなら単表、複数なら見出し付きで連結する。"""
+    frames, cached = await _get_statements(ticker)
+    period_label = "四半期" if quarterly else "年次"
+    found = [(kind, frames.get((kind, quarterly))) for kind in kinds]
+    found = [(kind, stmt) for kind, stmt in found if stmt is not None and not stmt.empty]
+    if not found:
+        names = "・".join(_STATEMENTS[kind][2] for kind in kinds)
+        return f"Error: '{ticker}' の{names}データが見つかりません。"
+
+    if len(kinds) == 1:
+        kind, stmt = found[0]
+        label, type_name = _STATEMENTS[kind][2:]
+        if response_format != ResponseFormat.MARKDOWN:
+            return _dumps({"ticker": ticker, "type": type_name, "period": period_label, "data": _stmt_to_dict(stmt), "cached": cached}, response_format)
+        return "\n".join([_format_statement_md(stmt, f"{ticker} {label} ({period_label})")] + _cache_note(cached))
+
+    if response_format != ResponseFormat.MARKDOWN:
+        return _dumps({
+            "ticker": ticker,
+            "period": period_label,
+            "statements": {_STATEMENTS[kind][3]: _stmt_to_dict(stmt) for kind, stmt in found},
+            "missing": [_STATEMENTS[kind][3] for kind in kinds if kind not in dict(found)],
+            "cached": cached,
+        }, response_format)
+    lines = [f"# {ticker} 財務諸表 ({period_label})"]
+    for kind, stmt in found:
+        lines += ["", _format_statement_md(stmt, _STATEMENTS[kind][2], heading="##")]
+    missing = [_STATEMENTS[kind][2] for kind in kinds if kind not in dict(found)]
+    if missing:
+        lines += ["", f"_データなし: {'、'.join(missing)}_"]
+    return "\n".join(lines + _cache_note(cached))
+
+
+# ---------------------------------------------------------------------------
+# Batch
+# ---------------------------------------------------------------------------
+
+_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+
+# v7 quote のフィールド名 → info のフィールド名（同名のものは変換不要）
+_QUOTE_TO_INFO = {
+    "regularMarketPrice": "currentPrice",
+    "regularMarketPreviousClose": "previousClose",
+    "regularMarketOpen": "open",
+    "regularMarketDayLow": "dayLow",
+    "regularMarketDayHigh": "dayHigh",
+    "regularMarketVolume": "volume",
+    "averageDailyVolume3Month": "averageVolume",
+    "epsTrailingTwelveMonths": "trailingEps",
+    "epsForward": "forwardEps",
+    "trailingAnnualDividendRate": "dividendRate",
+}
+# info の dividendYield（予想ベース）とは定義が違うため、quote の実績利回りは別の項目として返す
+_QUOTE_EXTRA_FIELDS = ["trailingAnnualDividendYield"]
+
+_QUOTE_CACHE = _TTLCache(INFO_CACHE_MAXSIZE, QUOTE_CACHE_TTL, shared="quote")
+
+
+def _chunks(items: List[str], size: int) -> List[List[str]]:
+    return [items[i:i + size] for i in range(0, len(items), max(size, 1))]
+
+
+def _download_quotes(symbols: List[str]) -> dict:
+    """v7 quote エンドポイントで複数銘柄のクォートを 1 リクエストで取得する（ブロッキング）。"""
+    from yfinance.data import YfData  # yfinance の共有セッション（cookie/crumb 管理込み）
+
+    data = YfData(session=_http_session()).get_raw_json(_QUOTE_URL, params={"symbols": ",".join(symbols), "formatted": "false"})
+    results = (data.get("quoteResponse") or {}).get("result") or []
+    return {q["symbol"].upper(): q for q in results if q.get("symbol")}
+
+
+async def _batch_quotes(symbols: List[str]) -> Tuple[dict, set]:
+    """複数銘柄のクォートをキャッシュ + チャンク単位の一括リクエストで取得する。
+
+    Returns:
+        ({シンボル: quote dict}, キャッシュから返したシンボルの集合)
+    """
+    unique = list(dict.fromkeys(symbols))
+    hits = await _cache_get_many(_QUOTE_CACHE, unique)
+    quotes = {sym: q for sym, (q, _) in hits.items()}
+    cached = set(hits)
+    misses = [sym for sym in unique if sym not in hits]
+    chunks = _chunks(misses, BATCH_CHUNK_SIZE)
+    results = await asyncio.gather(
+        *[_fetch_upstream(lambda c=c: _download_quotes(c), "quote", ",".join(c)) for c in chunks]
+    )
+    for result in results:
+        for sym, q in result.items():
+            _QUOTE_CACHE.set(sym, q)
+            quotes[sym] = q
+    return quotes, cached
+
+
+@_phase("convert")
+def _quote_to_valuation(quote: dict, fields: Optional[List[str]] = None) -> dict:
+    """v7 quote を _info_to_valuation と同じ項目構成に変換（quote に無い項目は None）。
+
+    fields 省略時は _QUOTE_EXTRA_FIELDS（info に対応する項目がないもの）も付ける。
+    """
+    info = {k: v for k, v in quote.items() if k != "dividendYield"}  # quote の dividendYield は単位が info と異なる
+    for src, dst in _QUOTE_TO_INFO.items():
+        info[dst] = quote.get(src)
+    out = _info_to_valuation(info, fields)
+    if not fields:
+        out.update({k: _safe_val(quote.get(k)) for k in _QUOTE_EXTRA_FIELDS})
+    return out
+
+
+def _download_history(symbols: List[str], period: str, interval: str):
+    """yf.download で複数銘柄の OHLCV をまとめて取得する（ブロッキング）。"""
+    return yf.download(
+        symbols, period=period, interval=interval, group_by="column",
+        auto_adjust=True, threads=max(1, min(UPSTREAM_PER_HOST, len(symbols))), progress=False,
+        session=_http_session(),
+    )
+
+
+_BATCH_HISTORY_CACHE = _TTLCache(32, STORE_REFRESH, shared="batch_history")
+
+
+async def _download_history_chunks(symbols: List[str], period: str, interval: str):
+    """上流ゲートのバースト以下の銘柄数に分けて順に一括取得し、列を (項目, ティッカー) で連結する。
+
+    分割ごとにトークンを取り直すので、大きな一括取得の間にも対話的な呼び出しが割り込める。
+    """
+    frames = []
+    for chunk in _chunks(symbols, _UPSTREAM.burst):
+        key = ",".join(chunk)
+        df = await _fetch_upstream(
+            lambda c=chunk: _download_history(c, period, interval),
+            "download", key, period=period, interval=interval, cost=len(chunk),
+        )
+        if df is None or df.empty:
+            continue
+        if len(chunk) == 1 and not isinstance(df.columns, pd.MultiIndex):  # 単一銘柄で列が潰れた場合
+            df = pd.concat({chunk[0]: df}, axis=1).swaplevel(axis=1)
+        frames.append(df)
+    if len(frames) <= 1:
+        return frames[0] if frames else pd.DataFrame()
+    return pd.concat(frames, axis=1)
+
+
+async def _batch_history(symbols: List[str], period: str, interval: str) -> Tuple[Any, bool]:
+    """複数銘柄の OHLCV を一括取得する。列は (項目, ティッカー) の MultiIndex。
+
+    Returns:
+        (DataFrame, キャッシュ由来か)
+    """
+    symbols = list(dict.fromkeys(symbols))
+    key = ",".join(sorted(symbols))
+    return await _cached(
+        _BATCH_HISTORY_CACHE, (key, period, interval),
+        lambda: _download_history_chunks(symbols, period, interval),
+        cacheable=lambda df: df is not None and not df.empty,
+    )
+
+
+def _field_matrix(df, field: str, symbols: List[str]):
+    """_batch_history の結果から 1 項目分を取り出し、列をティッカー順に揃える。"""
+    if df is None or df.empty or field not in df.columns.get_level_values(0):
+        return None
+    frame = df[field]
+    if not hasattr(frame, "columns"):  # 単一銘柄で列が潰れた場合
+        frame = frame.to_frame(symbols[0])
+    return frame.reindex(columns=symbols)
+
+
+async def _aligned_returns(symbols: List[str], period: str, interval: str, min_obs: int = 20) -> Tuple[Any, List[str], bool]:
+    """複数銘柄の終値を一括取得し、日付を揃えたリターン行列を作る。
+
+    休場日の違いは直前値で埋め（最大 5 本）、全銘柄が揃う日だけを残す。
+    データが min_obs 本に満たない銘柄は除外する。
+
+    Returns:
+        (リターンの DataFrame（列=銘柄）, 除外した銘柄, キャッシュ由来か)
+    """
+    hist, cached = await _batch_history(symbols, period, interval)
+    closes = _field_matrix(hist, "Close", symbols)
+    if closes is None:
+        return pd.DataFrame(), list(symbols), cached
+    counts = closes.notna().sum()
+    dropped = [sym for sym in symbols if counts.get(sym, 0) < min_obs]
+    closes = closes.drop(columns=dropped).dropna(how="all").ffill(limit=5)
+    returns = (closes / closes.shift(1) - 1).iloc[1:].dropna(how="any")
+    return returns, dropped, cached
+
+
+# ---------------------------------------------------------------------------
+# Bar Store
+# ---------------------------------------------------------------------------
+
+# ローカル保存の対象とする足（日中足は Yahoo 側の保持期間が短いため対象外）
+_STORE_INTERVALS = {"1d", "5d", "1wk", "1mo", "3mo"}
+# 営業日で数える短い期間はカレンダーでの切り出しと一致しないため常に直接取得する
+_STORE_SKIP_PERIODS = {"1d", "5d"}
+_PERIOD_MONTHS = {"1mo": 1, "3mo": 3, "6mo": 6, "1y": 12, "2y": 24, "5y": 60, "10y": 120}
+_ACTION_COLUMNS = ("Dividends", "Stock Splits")
+
+
+def _period_start(period: str, now) -> Optional["pd.Timestamp"]:
+    """period の起点（UTC）を返す。'max' は None。"""
+    if period == "max":
+        return None
+    if period == "ytd":
+        return pd.Timestamp(year=now.year, month=1, day=1, tz="UTC")
+    return now - pd.DateOffset(months=_PERIOD_MONTHS[period])
+
+
+class _BarStore:
+    """(ticker, interval) ごとの OHLCV をディスクに保持するストア。
+
+    bars.npy は ts（UTC ナノ秒）と各列を持つ構造化配列で、メモリマップで開いて
+    必要な期間だけを読み込む。meta.json はタイムゾーン、取得済み範囲の起点
+    （covered_from、None は全期間）と最終取得時刻を持つ。書き込みは一時ファイルからの
+    置換で行うため、別プロセスが読み込み中でも書きかけのファイルは見えない。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, ticker: str, interval: str) -> str:
+        return os.path.join(self.root, re.sub(r"[^A-Za-z0-9._^=-]", "_", ticker), interval)
+
+    def meta(self, ticker: str, interval: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._path(ticker, interval), "meta.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read(self, ticker: str, interval: str, start=None):
+        """start（UTC Timestamp）以降の足を DataFrame で返す。未保存なら None。"""
+        meta = self.meta(ticker, interval)
+        if meta is None:
+            return None
+        try:
+            bars = np.load(os.path.join(self._path(ticker, interval), "bars.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        lo = int(np.searchsorted(bars["ts"], start.value)) if start is not None else 0
+        part = np.array(bars[lo:])  # 必要な範囲だけをメモリに載せる
+        index = pd.to_datetime(part["ts"], utc=True)
+        index = index.tz_convert(meta["tz"]) if meta.get("tz") else index.tz_localize(None)
+        index.name = meta.get("index_name")
+        return pd.DataFrame({name: part[name] for name in part.dtype.names if name != "ts"}, index=index)
+
+    def write(self, ticker: str, interval: str, df, period: str, covered_from) -> None:
+        path = self._path(ticker, interval)
+        os.makedirs(path, exist_ok=True)
+        columns = {}
+        for i, col in enumerate(df.columns):
+            values = df.iloc[:, i].to_numpy()
+            if values.dtype.kind not in "biuf":
+                values = values.astype("f8")
+            if col == "Volume" and values.dtype.kind == "f" and not np.isnan(values).any():
+                values = values.astype("i8")  # 結合で float 化した出来高を整数に戻す
+            columns[str(col)] = values
+        bars = np.empty(len(df), dtype=[("ts", "<i8")] + [(name, v.dtype) for name, v in columns.items()])
+        utc = df.index.tz_convert(None) if df.index.tz is not None else df.index
+        bars["ts"] = np.asarray(utc, dtype="datetime64[ns]").view("i8")
+        for name, values in columns.items():
+            bars[name] = values
+        meta = {
+            "tz": str(df.index.tz) if df.index.tz is not None else None,
+            "index_name": df.index.name,
+            "period": period,
+            "covered_from": covered_from.value if covered_from is not None else None,
+            "fetched_at": time.time(),
+            "rows": len(df),
+        }
+        self._replace(os.path.join(path, "bars.npy"), lambda f: np.save(f, bars))
+        self._replace(os.path.join(path, "meta.json"), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    @staticmethod
+    def _replace(target: str, write: Callable[[Any], Any]) -> None:
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                write(f)
+            os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+_BAR_STORE = _BarStore(STORE_DIR)
+
+
+def _has_new_actions(stored, tail) -> bool:
+    """tail に stored に無い配当・分割があるか（あれば過去の調整後価格が変わる）。"""
+    cols = [c for c in _ACTION_COLUMNS if c in tail.columns]
+    if tail.empty or not cols:
+        return False
+    events = tail[cols].fillna(0).ne(0).any(axis=1)
+    if not events.any():
+        return False
+    known_cols = [c for c in cols if c in stored.columns]
+    known = stored[known_cols].reindex(tail.index).fillna(0).ne(0).any(axis=1) if known_cols else False
+    return bool((events & ~known).any())
+
+
+def _merge_bars(stored, tail):
+    """stored の末尾を tail で置き換え・追記する（重複する足は tail を優先）。"""
+    if tail is None or tail.empty:
+        return stored
+    merged = pd.concat([stored[stored.index < tail.index[0]], tail])
+    for col in _ACTION_COLUMNS:
+        if col in merged.columns:
+            merged[col] = merged[col].fillna(0.0)
+    return merged
+
+
+async def _fetch_history(ticker: str, period: str, interval: str):
+    return await _fetch_upstream(
+        lambda: _ticker(ticker).history(period=period, interval=interval),
+        "history", ticker, period=period, interval=interval,
+    )
+
+
+async def _get_history(ticker: str, period: str, interval: str, refresh: bool = False) -> Tuple[Any, bool]:
+    """価格ヒストリーを取得する。(DataFrame, ローカルストアだけで応答したか) を返す。
+
+    日足以上はローカルストアから period 分を切り出し、最終取得から STORE_REFRESH 秒を
+    過ぎていれば最後の足以降だけを上流から取得して追記する。保存範囲より長い
+    period を要求された場合と、配当・分割で調整後価格が変わった場合は取り直す。
+    日中足は _get_intraday（取得済みの細かい足からの集約）に任せる。
+    refresh=True なら STORE_REFRESH 以内でも上流に問い合わせる（先読み用）。
+    """
+    if interval in _INTRADAY_MINUTES:
+        return await _get_intraday(ticker, period, interval, refresh)
+    if not STORE_ENABLED or interval not in _STORE_INTERVALS or period in _STORE_SKIP_PERIODS:
+        return await _fetch_history(ticker, period, interval), False
+
+    now = pd.Timestamp.now(tz="UTC")
+    start = _period_start(period, now)
+    meta = await asyncio.to_thread(_BAR_STORE.meta, ticker, interval)
+    covered = meta is not None and (
+        meta["covered_from"] is None or (start is not None and start.value >= meta["covered_from"])
+    )
+    if covered and not refresh and time.time() - meta["fetched_at"] < STORE_REFRESH:
+        df = await asyncio.to_thread(_BAR_STORE.read, ticker, interval, start)
+        if df is not None and not df.empty:
+            _count("store_hits")
+            return df, True
+
+    fetch_period = period
+    if covered:
+        stored = await asyncio.to_thread(_BAR_STORE.read, ticker, interval)
+        if stored is not None and not stored.empty:
+            tail_start = str(stored.index[-1].date())
+            tail = await _fetch_upstream(
+                lambda: _ticker(ticker).history(start=tail_start, interval=interval),
+                "history", ticker, interval=interval, extra=tail_start,
+            )
+            if not _has_new_actions(stored, tail):
+                merged = _merge_bars(stored, tail)
+                covered_from = pd.Timestamp(meta["covered_from"], tz="UTC") if meta["covered_from"] is not None else None
+                await asyncio.to_thread(_BAR_STORE.write, ticker, interval, merged, meta["period"], covered_from)
+                _count("store_tail_fetches")
+                return (merged[merged.index >= start] if start is not None else merged), False
+        fetch_period = meta["period"]  # 保存済み範囲ごと取り直す
+
+    _count("store_full_fetches")
+    df = await _fetch_history(ticker, fetch_period, interval)
+    if df is not None and not df.empty:
+        await asyncio.to_thread(_BAR_STORE.write, ticker, interval, df, fetch_period, _period_start(fetch_period, now))
+        if fetch_period != period and start is not None:
+            df = df[df.index >= start]
+    return df, False
+
+
+# ---------------------------------------------------------------------------
+# Intraday
+# ---------------------------------------------------------------------------
+
+_INTRADAY_MINUTES = {"1m": 1, "2m": 2, "5m": 5, "15m": 15, "30m": 30, "60m": 60, "90m": 90, "1h": 60}
+# Yahoo が 5 分足を返す期間（約 60 日）。これより長い period は要求された足をそのまま取得する
+_INTRADAY_BASE_PERIODS = {"1d", "5d", "1mo"}
+
+# (ticker, interval) → (period, DataFrame)
+_INTRADAY_CACHE = _TTLCache(64, INTRADAY_CACHE_TTL, shared="intraday")
+
+
+def _period_days(period: str, now) -> float:
+    """期間の比較用の日数（'Nd' は営業日数、それ以外は暦日数）。"""
+    if period == "max":
+        return float("inf")
+    if period.endswith("d"):
+        return float(period[:-1])
+    return (now - _period_start(period, now)).days
+
+
+def _slice_period(df, period: str, now):
+    """より長い期間の足から period 分を切り出す（'Nd' は直近 N 取引日）。"""
+    if period == "max":
+        return df
+    if period.endswith("d"):
+        days = df.index.normalize().unique()
+        return df[df.index >= days[-int(period[:-1]):][0]] if len(days) else df
+    return df[df.index >= _period_start(period, now)]
+
+
+def _resample_intraday(df, minutes: int):
+    """日中足を minutes 分足に集約する（始値=最初、高値=最大、安値=最小、終値=最後、出来高=合計）。
+
+    足の区切りは各取引日の最初の足を起点にする（Yahoo の日中足と同じ並び。
+    夏時間の切り替えや 90 分足でもずれない）。
+    """
+    local = df.index.tz_localize(None) if df.index.tz is not None else df.index
+    ts = local.asi8
+    unit = pd.Timedelta(minutes=minutes).value // pd.Timedelta(1, unit=local.unit).value
+    day = local.normalize().asi8
+    day_first = pd.Series(ts).groupby(day).transform("min").to_numpy()
+    bins = day_first + (ts - day_first) // unit * unit
+    agg = {"Open": "first", "High": "max", "Low": "min", "Close": "last", "Volume": "sum", "Dividends": "sum", "Stock Splits": "max"}
+    out = df.groupby(bins, sort=True).agg({c: agg.get(c, "last") for c in df.columns})
+    index = pd.DatetimeIndex(pd.to_datetime(out.index, unit=local.unit).as_unit(local.unit), name=df.index.name)
+    out.index = index.tz_localize(df.index.tz) if df.index.tz is not None else index
+    return out
+
+
+async def _get_intraday(ticker: str, period: str, interval: str, refresh: bool = False) -> Tuple[Any, bool]:
+    """日中足を取得する。(DataFrame, キャッシュから応答したか) を返す。
+
+    同じ銘柄で取得済みの足のうち、要求された足を割り切れる細かさで period を含むものがあれば
+    それを集約して返し、上流には出さない。無ければ上流から取得してキャッシュする。
+    period が INTRADAY_BASE の保持期間内なら INTRADAY_BASE でまとめて取得し、
+    後続の 15m/30m/1h などの要求をすべてキャッシュから返せるようにする。
+    refresh=True ならキャッシュを見ずに取得し直す。
+    """
+    minutes = _INTRADAY_MINUTES[interval]
+    now = pd.Timestamp.now(tz="UTC")
+    wanted = _period_days(period, now)
+    # 粗い順（集約する行数が少ない順）に探す。同じ細かさなら要求された足そのものを優先
+    sources = sorted(
+        ((m, i) for i, m in _INTRADAY_MINUTES.items() if minutes % m == 0),
+        key=lambda x: (-x[0], x[1] != interval),
+    )
+    for src_minutes, src in ([] if refresh else sources):
+        entry, _ = await _cache_get(_INTRADAY_CACHE, (ticker, src))
+        if entry is None or _period_days(entry[0], now) < wanted:
+            continue
+        df = _slice_period(entry[1], period, now) if entry[0] != period else entry[1]
+        return (df if src_minutes == minutes else _resample_intraday(df, minutes)), True
+
+    fetch_interval = interval
+    base = _INTRADAY_MINUTES.get(INTRADAY_BASE)
+    if base and base < minutes and minutes % base == 0 and period in _INTRADAY_BASE_PERIODS:
+        fetch_interval = INTRADAY_BASE
+    df = await _fetch_history(ticker, period, fetch_interval)
+    if df is None or df.empty:
+        return df, False
+    _INTRADAY_CACHE.set((ticker, fetch_interval), (period, df))
+    return (df if fetch_interval == interval else _resample_intraday(df, minutes)), False
+
+
+# ---------------------------------------------------------------------------
+# News
+# ---------------------------------------------------------------------------
+
+# 銘柄ごとに保持する記事数の上限（公開日時の古いものから捨てる）
+_NEWS_MAX_ITEMS = 200
+# ticker → {記事 ID: 記事}。TTL 内は上流に出さず、期限後も 1 週間は再取得時のマージ元として残す
+_NEWS_FEEDS = _TTLCache(256, NEWS_CACHE_TTL, 7 * 86400)
+# 記事を初めて取得した順の通し番号（cursor の単位）。_NEWS_SEEN は記事 ID → 通し番号で、フィードが
+# キャッシュから追い出されて取り直しても既知の記事に同じ番号を振る（古いものから _NEWS_SEEN_MAX 件まで）
+_news_seq = 0
+_NEWS_SEEN: "OrderedDict[str, int]" = OrderedDict()
+_NEWS_SEEN_MAX = 20000
+# cursor に埋め込むプロセスの識別子。再起動後の cursor は通し番号が合わないので期限切れとして扱う
+_NEWS_EPOCH = f"{int(time.time()):x}{random.getrandbits(16):04x}"
+
+
+def _parse_time(value: Any) -> Optional[float]:
+    """UNIX 秒（数値・数字文字列）または ISO 8601 文字列を UNIX 秒に変換する。解釈できなければ None。"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def _normalize_article(article: dict) -> Optional[dict]:
+    """yfinance の新旧どちらの形式の記事も {id, title, url, published, provider, summary} にそろえる。"""
+    content = article.get("content") or {}
+    url = (content.get("canonicalUrl") or {}).get("url") or (content.get("clickThroughUrl") or {}).get("url") or article.get("link")
+    article_id = article.get("id") or content.get("id") or article.get("uuid") or url
+    if not article_id:
+        return None
+    return {
+        "id": str(article_id),
+        "title": content.get("title") or article.get("title") or "タイトル不明",
+        "url": url,
+        "published": _parse_time(content.get("pubDate") or article.get("providerPublishTime")),
+        "provider": (content.get("provider") or {}).get("displayName") or article.get("publisher"),
+        "summary": content.get("summary") or article.get("summary") or "",
+    }
+
+
+async def _get_news_feed(ticker: str) -> Tuple[dict, bool]:
+    """銘柄の記事を {ID: 記事} で返す。(feed, キャッシュだけで応答したか)。
+
+    TTL 内はキャッシュを返し、期限後は上流の最新一覧を既存の記事にマージする
+    （既知の ID は seq を保ったまま、新しい ID にだけ新しい seq を振る）。
+    """
+    global _news_seq
+    feed, state = _NEWS_FEEDS.get(ticker)
+    if state == "fresh":
+        return feed, True
+    raw = await _fetch_upstream(lambda: _ticker(ticker).news, "news", ticker)
+    merged = dict(feed or {})
+    for article in raw or []:
+        item = _normalize_article(article)
+        if item is None or item["id"] in merged:
+            continue
+        seq = _NEWS_SEEN.get(item["id"])
+        if seq is None:
+            _news_seq += 1
+            seq = _NEWS_SEEN[item["id"]] = _news_seq
+            if len(_NEWS_SEEN) > _NEWS_SEEN_MAX:
+                _NEWS_SEEN.popitem(last=False)
+        merged[item["id"]] = {**item, "seq": seq}
+    if len(merged) > _NEWS_MAX_ITEMS:
+        keep = sorted(merged.values(), key=lambda a: a["published"] or 0, reverse=True)[:_NEWS_MAX_ITEMS]
+        merged = {a["id"]: a for a in keep}
+    _NEWS_FEEDS.set(ticker, merged)
+    return merged, False
+
+
+def _news_cursor(seq: int) -> str:
+    return f"{_NEWS_EPOCH}-{seq}"
+
+
+def _parse_cursor(text: Optional[str]) -> Tuple[Optional[int], bool]:
+    """cursor を (通し番号, 期限切れか) に変換する。別のプロセス（再起動前など）が発行したものは期限切れ。"""
+    if not text:
+        return None, False
+    epoch, sep, seq = text.rpartition("-")
+    if not sep or not seq.isdigit():
+        raise ValueError(f"cursor を解釈できません: {text}")
+    if epoch != _NEWS_EPOCH:
+        return None, True
+    return int(seq), False
+
+
+def _select_news(articles, since: Optional[float], cursor: Optional[int], count: int) -> Tuple[List[dict], int, bool]:
+    """since（公開日時）・cursor（取得順の通し番号）で絞り、count 件を公開日時の新しい順で返す。
+
+    cursor 指定時は取得順の古いものから count 件を選び、返した記事の最大の通し番号を次の cursor にする
+    （残りは次回に続けて返す）。cursor なしは公開日時の新しい count 件を返し、次の cursor は渡された記事の
+    最大の通し番号（それ以前の記事は以後返さない）。(記事, 次の通し番号, 残りがあるか) を返す。
+    """
+    articles = list(articles)
+    picked = [
+        a for a in articles
+        if (since is None or (a["published"] or 0) > since) and (cursor is None or a["seq"] > cursor)
+    ]
+    if cursor is None:
+        picked.sort(key=lambda a: a["published"] or 0, reverse=True)
+        return picked[:count], max((a["seq"] for a in articles), default=0), False
+    picked.sort(key=lambda a: a["seq"])
+    out = picked[:count]
+    next_seq = max(cursor, out[-1]["seq"]) if out else cursor
+    out.sort(key=lambda a: a["published"] or 0, reverse=True)
+    return out, next_seq, len(picked) > count
+
+
+def _article_out(article: dict) -> dict:
+    out = {k: v for k, v in article.items() if k != "seq"}
+    if out["published"] is not None:
+        out["published"] = datetime.fromtimestamp(out["published"], timezone.utc).isoformat().replace("+00:00", "Z")
+    return out
+
+
+def _news_notes(next_cursor: str, more: bool, expired: bool) -> List[str]:
+    notes = []
+    if expired:
+        notes.append("_cursor が無効（サーバー再起動など）のため最新の記事から返しました_")
+    if more:
+        notes.append("_新着が残っています。next_cursor を指定して続きを取得してください_")
+    return notes + [f"_next_cursor: {next_cursor}_"]
+
+
+@_phase("render")
+def _format_news_md(title: str, articles: List[dict]) -> List[str]:
+    lines = [title, ""]
+    for i, a in enumerate(articles, 1):
+        lines.append(f"## {i}. {a['title']}")
+        if a.get("tickers"):
+            lines.append(f"- **銘柄**: {', '.join(a['tickers'])}")
+        if a["provider"]:
+            lines.append(f"- **媒体**: {a['provider']}")
+        if a["published"]:
+            lines.append(f"- **公開日時**: {a['published'][:19]}")
+        if a["url"]:
+            lines.append(f"- **URL**: {a['url']}")
+        if a["summary"]:
+            lines.append(f"- **要約**: {a['summary'][:300]}{'...' if len(a['summary']) > 300 else ''}")
+        lines.append("")
+    return lines
+
+
+# ---------------------------------------------------------------------------
+# Screener
+# ---------------------------------------------------------------------------
+
+# 1 回の取得件数（ScreenerInput.count の上限）。count はここから切り出す
+_SCREENER_MAX = 100
+_SCREENER_CACHE = _TTLCache(32, SCREENER_CACHE_TTL, SCREENER_CACHE_TTL, shared="screener")
+
+
+def _download_screener(query_type: str) -> dict:
+    """プリセットクエリを _SCREENER_MAX 件で実行する（ブロッキング）。"""
+    screener = _screener()
+    screener.set_predefined_body(query_type)
+    screener.size = _SCREENER_MAX
+    return screener.response
+
+
+async def _fetch_screener(query_type: str) -> dict:
+    return await _fetch_upstream(lambda: _download_screener(query_type), "screener", query_type, extra=_SCREENER_MAX)
+
+
+async def _get_screener(query_type: str) -> Tuple[dict, bool]:
+    """プリセットクエリの結果をキャッシュ経由で取得する。(response, キャッシュ由来か) を返す。"""
+    return await _cached(
+        _SCREENER_CACHE, query_type, lambda: _fetch_screener(query_type),
+        cacheable=lambda r: bool(r and r.get("quotes")),
+    )
+
+
+@_background_job("screener")
+async def _screener_job() -> float:
+    """SCREENER_PREWARM のクエリを TTL が切れる前に順に取り直す（失敗したクエリは最後にまとめて報告）。"""
+    if not SCREENER_PREWARM:
+        return 3600.0
+    await _ensure_heavy_modules()
+    failed = []
+    for query_type in SCREENER_PREWARM:
+        try:
+            result = await _fetch_screener(query_type)
+        except Exception as e:
+            failed.append(f"{query_type}: {type(e).__name__}: {e}")
+            continue
+        if result and result.get("quotes"):
+            _SCREENER_CACHE.set(query_type, result)
+    if failed:
+        raise RuntimeError("; ".join(failed))
+    return SCREENER_CACHE_TTL * 0.9
+
+
+# ---------------------------------------------------------------------------
+# Universe
+# ---------------------------------------------------------------------------
+
+# 列名 → (取得元, 元の項目名, 数値か)。quote は一括クォート、info は銘柄ごとの info（更新は UNIVERSE_INFO_REFRESH ごと）
+_UNIVERSE_COLUMNS = {
+    "symbol": ("quote", "symbol", False),
+    "name": ("quote", "shortName", False),
+    "exchange": ("quote", "exchange", False),
+    "currency": ("quote", "currency", False),
+    "price": ("quote", "regularMarketPrice", True),
+    "change_pct": ("quote", "regularMarketChangePercent", True),
+    "volume": ("quote", "regularMarketVolume", True),
+    "market_cap": ("quote", "marketCap", True),
+    "pe": ("quote", "trailingPE", True),
+    "forward_pe": ("quote", "forwardPE", True),
+    "pb": ("quote", "priceToBook", True),
+    "eps": ("quote", "epsTrailingTwelveMonths", True),
+    "dividend_yield": ("quote", "trailingAnnualDividendYield", True),
+    "high_52w": ("quote", "fiftyTwoWeekHigh", True),
+    "low_52w": ("quote", "fiftyTwoWeekLow", True),
+    "roe": ("info", "returnOnEquity", True),
+    "roa": ("info", "returnOnAssets", True),
+    "beta": ("info", "beta", True),
+    "debt_to_equity": ("info", "debtToEquity", True),
+    "sector": ("info", "sector", False),
+    "industry": ("info", "industry", False),
+}
+_UNIVERSE_DEFAULT_COLUMNS = ["symbol", "name", "price", "market_cap", "pe", "pb", "dividend_yield", "roe", "sector"]
+
+# 式で使える関数
+_EXPR_FUNCS = {
+    "abs": lambda x: np.abs(x),
+    "log": lambda x: np.log(x),
+    "isnull": lambda x: pd.isna(x) if isinstance(x, np.ndarray) else x is None,
+    "notnull": lambda x: ~pd.isna(x) if isinstance(x, np.ndarray) else x is not None,
+}
+
+
+class _Snapshot:
+    """ユニバースの列指向スナップショット（列名 → ndarray）。並べ替え順は列ごとに遅延計算して保持する。"""
+
+    def __init__(self, columns: dict, built_at: float, pending: int):
+        self.columns = columns
+        self.built_at = built_at
+        self.pending = pending  # info 由来の列がまだ無い銘柄数
+        self._order: dict = {}
+
+    def __len__(self) -> int:
+        return len(self.columns["symbol"])
+
+    def order(self, name: str):
+        """列の昇順の並び（欠損は末尾）と欠損でない件数を返す。"""
+        if name not in self._order:
+            self._order[name] = _argsort_nan_last(self.columns[name])
+        return self._order[name]
+
+
+def _argsort_nan_last(values):
+    """(昇順のインデックス, 欠損でない件数)。文字列列は None を末尾に回す。"""
+    if values.dtype == object:
+        missing = pd.isna(values)
+        keys = np.where(missing, "", values).astype(str)
+    else:
+        missing = np.isnan(values)
+        keys = values
+    valid = np.flatnonzero(~missing)
+    order = np.concatenate([valid[np.argsort(keys[valid], kind="stable")], np.flatnonzero(missing)])
+    return order, len(valid)
+
+
+_SNAPSHOT: Optional[_Snapshot] = None
+_UNIVERSE_QUOTES: dict = {}
+_UNIVERSE_INFO: dict = {}  # sym → (取得時刻, info 由来の項目)
+_UNIVERSE_LOCK = _LoopBound(asyncio.Lock)
+_UNIVERSE_INFO_LOCK = _LoopBound(asyncio.Lock)
+_FUNDAMENTALS_BATCH = 2
+_FUNDAMENTALS_PUBLISH = 50
+
+
+def _build_snapshot(symbols: List[str]) -> _Snapshot:
+    columns = {}
+    for name, (source, key, numeric) in _UNIVERSE_COLUMNS.items():
+        if source == "quote":
+            raw = [(_UNIVERSE_QUOTES.get(sym) or {}).get(key) for sym in symbols]
+        else:
+            raw = [_UNIVERSE_INFO.get(sym, (0, {}))[1].get(key) for sym in symbols]
+        if numeric:
+            columns[name] = np.array([np.nan if v is None else v for v in raw], dtype=float)
+        else:
+            columns[name] = np.array(raw, dtype=object)
+    columns["symbol"] = np.array(symbols, dtype=object)
+    pending = sum(1 for sym in symbols if sym not in _UNIVERSE_INFO)
+    return _Snapshot(columns, time.time(), pending)
+
+
+async def _refresh_universe(fundamentals: bool = True) -> _Snapshot:
+    """ユニバースのクォートを一括取得してスナップショットを作り直す。
+
+    fundamentals=True なら続けて _refresh_fundamentals で info 由来の列を更新する。
+    """
+    global _SNAPSHOT
+    async with _UNIVERSE_LOCK.get():
+        chunks = _chunks(UNIVERSE, BATCH_CHUNK_SIZE)
+        results = await asyncio.gather(*[_batch_quotes(c) for c in chunks], return_exceptions=True)
+        for result in results:
+            if not isinstance(result, BaseException):
+                _UNIVERSE_QUOTES.update(result[0])
+        _SNAPSHOT = _build_snapshot(UNIVERSE)
+    if fundamentals:
+        await _refresh_fundamentals()
+    return _SNAPSHOT
+
+
+async def _universe_info(sym: str) -> dict:
+    """info キャッシュにあればそれを使い、無ければ上流から取得する（大量の銘柄で info キャッシュを追い出さない）。"""
+    info, state = _INFO_CACHE.get(sym)
+    if state:
+        return info
+    return await _fetch_upstream(lambda: _ticker(sym).info, "info", sym)
+
+
+async def _refresh_fundamentals() -> None:
+    """info 由来の列（ROE・セクターなど）が古い銘柄を少数ずつ取得する。
+
+    上流ゲートの待ち行列を占有して対話的なツール呼び出しを待たせないよう、
+    _FUNDAMENTALS_BATCH 件ずつ順に取得し、_FUNDAMENTALS_PUBLISH 件ごとにスナップショットを作り直す。
+    """
+    global _SNAPSHOT
+    async with _UNIVERSE_INFO_LOCK.get():
+        info_keys = [key for source, key, _ in _UNIVERSE_COLUMNS.values() if source == "info"]
+        stale = [sym for sym in UNIVERSE if time.time() - _UNIVERSE_INFO.get(sym, (0, None))[0] > UNIVERSE_INFO_REFRESH]
+        for i, batch in enumerate(_chunks(stale, _FUNDAMENTALS_BATCH)):
+            infos = await asyncio.gather(*[_universe_info(sym) for sym in batch], return_exceptions=True)
+            for sym, info in zip(batch, infos):
+                if not isinstance(info, BaseException) and info:
+                    _UNIVERSE_INFO[sym] = (time.time(), {k: _safe_val(info.get(k)) for k in info_keys})
+            if (i + 1) % (_FUNDAMENTALS_PUBLISH // _FUNDAMENTALS_BATCH) == 0:
+                _SNAPSHOT = _build_snapshot(UNIVERSE)
+        if stale:
+            _SNAPSHOT = _build_snapshot(UNIVERSE)
+
+
+@_background_job("universe")
+async def _universe_job() -> float:
+    if not UNIVERSE:
+        return 3600.0
+    await _ensure_heavy_modules()
+    await _refresh_universe()
+    return UNIVERSE_REFRESH
+
+
+def _parse_expr(text: str) -> ast.AST:
+    """式を構文解析し、列名・定数・比較・論理演算・四則演算・許可した関数だけで構成されているか検証する。"""
+    tree = ast.parse(text, mode="eval")
+    allowed = (
+        ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+        ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE,
+        ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Name, ast.Load, ast.Constant, ast.List, ast.Tuple, ast.Call,
+    )
+    callees = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    for node in ast.walk(tree):
+        if not isinstance(node, allowed):
+            raise ValueError(f"式に使えない構文です: {type(node).__name__}")
+        # 関数名は呼び出し位置（Call.func）でだけ使える。それ以外の名前は列でなければならない
+        if isinstance(node, ast.Name) and id(node) not in callees and node.id not in _UNIVERSE_COLUMNS:
+            raise ValueError(f"未知の列: {node.id}（使える列: {', '.join(_UNIVERSE_COLUMNS)}）")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in _EXPR_FUNCS and not node.keywords):
+            raise ValueError(f"使える関数は {', '.join(_EXPR_FUNCS)} のみです")
+    return tree
+
+
+def _expr_names(tree: ast.AST) -> List[str]:
+    return list(dict.fromkeys(n.id for n in ast.walk(tree) if isinstance(n, ast.Name) and n.id in _UNIVERSE_COLUMNS))
+
+
+# 演算子 → numpy の ufunc 名（numpy は遅延読み込みのため名前で持つ）
+_COMPARE_OPS = {
+    ast.Eq: "equal", ast.NotEq: "not_equal", ast.Lt: "less", ast.LtE: "less_equal",
+    ast.Gt: "greater", ast.GtE: "greater_equal",
+}
+_BIN_OPS = {ast.Add: "add", ast.Sub: "subtract", ast.Mult: "multiply", ast.Div: "divide"}
+
+
+def _eval_expr(node: ast.AST, columns: dict) -> Any:
+    """_parse_expr 済みの式を列 ndarray 上でベクトル演算として評価する（欠損との比較は False）。"""
+    if isinstance(node, ast.Expression):
+        return _eval_expr(node.body, columns)
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [_eval_expr(e, columns) for e in node.elts]
+    if isinstance(node, ast.Name):
+        return columns[node.id]
+    if isinstance(node, ast.Call):
+        return _EXPR_FUNCS[node.func.id](*[_eval_expr(a, columns) for a in node.args])
+    if isinstance(node, ast.BoolOp):
+        values = [np.asarray(_eval_expr(v, columns), dtype=bool) for v in node.values]
+        return (np.logical_and if isinstance(node.op, ast.And) else np.logical_or).reduce(values)
+    if isinstance(node, ast.UnaryOp):
+        value = _eval_expr(node.operand, columns)
+        if isinstance(node.op, ast.Not):
+            return np.logical_not(value)
+        return np.negative(value) if isinstance(node.op, ast.USub) else value
+    if isinstance(node, ast.BinOp):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return getattr(np, _BIN_OPS[type(node.op)])(_eval_expr(node.left, columns), _eval_expr(node.right, columns))
+    if isinstance(node, ast.Compare):
+        result, left = None, _eval_expr(node.left, columns)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _eval_expr(comparator, columns)
+            if isinstance(op, (ast.In, ast.NotIn)):
+                mask = np.isin(left, right if isinstance(right, list) else [right])
+                mask = ~mask if isinstance(op, ast.NotIn) else mask
+            else:
+                with np.errstate(invalid="ignore"):
+                    mask = getattr(np, _COMPARE_OPS[type(op)])(left, right)
+                if isinstance(mask, np.ndarray) and mask.dtype == object:
+                    mask = mask.astype(bool)
+            result = mask if result is None else np.logical_and(result, mask)
+            left = right
+        return result
+    raise ValueError(f"式に使えない構文です: {type(node).__name__}")
+
+
+@_phase("convert")
+def _screen_snapshot(snapshot: _Snapshot, params: "UniverseScreenInput") -> Tuple[List[dict], int, List[str]]:
+    """フィルタ・並べ替えを適用して (行, 一致件数, 出力列) を返す。"""
+    n = len(snapshot)
+    names: List[str] = []
+    mask = np.ones(n, dtype=bool)
+    if params.filter:
+        tree = _parse_expr(params.filter)
+        names += _expr_names(tree)
+        mask = np.broadcast_to(np.asarray(_eval_expr(tree, snapshot.columns), dtype=bool), (n,))
+
+    if params.sort:
+        tree = _parse_expr(params.sort)
+        names += _expr_names(tree)
+        if isinstance(tree.body, ast.Name):
+            order, valid = snapshot.order(tree.body.id)  # 列そのものならキャッシュした並びを使う
+        else:
+            order, valid = _argsort_nan_last(np.asarray(_eval_expr(tree, snapshot.columns), dtype=float))
+        if params.descending:
+            order = np.concatenate([order[:valid][::-1], order[valid:]])
+    else:
+        order = np.arange(n)
+
+    selected = order[mask[order]]
+    fields = params.columns or list(dict.fromkeys(_UNIVERSE_DEFAULT_COLUMNS + names))
+    picked = selected[:params.limit]
+    columns = {f: snapshot.columns[f][picked] for f in fields}
+    rows = [dict(zip(fields, (_safe_val(v) for v in values))) for values in zip(*columns.values())]
+    return rows, len(selected), fields
+
+
+# ---------------------------------------------------------------------------
+# Watchlist
+# ---------------------------------------------------------------------------
+
+async def _watch_info(sym: str) -> None:
+    info = await _fetch_upstream(lambda: _ticker(sym).info, "info", sym)
+    if info:
+        _INFO_CACHE.set(sym, info)
+
+
+async def _watch_history(sym: str) -> None:
+    for period, interval in WATCH_HISTORY:
+        await _get_history(sym, period, interval, refresh=True)
+
+
+async def _watch_statements(sym: str) -> None:
+    frames = await _fetch_statements(sym)
+    if _has_statements(frames):
+        _STATEMENT_CACHE.set(sym, frames)
+
+
+# 種別 → (更新間隔（秒）, 1 銘柄あたりの上流リクエスト数, 更新処理)。初回はこの順に全銘柄を取得する
+_WATCH_KINDS = {
+    "info": (WATCH_INFO_INTERVAL, 1, _watch_info),
+    "history": (WATCH_HISTORY_INTERVAL, len(WATCH_HISTORY), _watch_history),
+    "statements": (WATCH_STATEMENTS_INTERVAL, len(_STATEMENTS) * 2, _watch_statements),
+}
+if not WATCH_HISTORY:
+    del _WATCH_KINDS["history"]  # 先読みする足がなければ種別ごと外す（コスト 0 の空振りを積まない）
+# 1 回のジョブ実行で並行して更新する件数
+_WATCH_BATCH = 2
+# (予定時刻（monotonic）, 通し番号, 種別, 銘柄) のヒープ
+_WATCH_QUEUE: list = []
+# (種別, 銘柄) → 最終更新時刻 / 直近の失敗内容
+_WATCH_REFRESHED: dict = {}
+_WATCH_FAILED: dict = {}
+_watch_seq = 0
+
+
+def _watch_schedule(kind: str, sym: str, delay: float) -> None:
+    global _watch_seq
+    _watch_seq += 1
+    heapq.heappush(_WATCH_QUEUE, (time.monotonic() + delay, _watch_seq, kind, sym))
+
+
+def _jittered(interval: float) -> float:
+    return interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+
+@_background_job("watchlist")
+async def _watchlist_job() -> float:
+    """WATCHLIST の info・直近の足・財務諸表を種別ごとの間隔で取り直し、キャッシュを温めておく。
+
+    1 回の実行では予定時刻を過ぎた _WATCH_BATCH 件だけを更新し、使ったリクエスト数 / WATCH_RATE 秒は
+    次を始めない（上流レートの残りを対話的なツール呼び出しに回す）。次回の予定は間隔に揺らぎを加えて
+    積み直し、銘柄の更新が同じ時刻に集中しないようにする。失敗した銘柄は _JOB_RETRY_DELAY 後に再試行する。
+    """
+    if not _WATCH_QUEUE:
+        for kind, (interval, _, _) in _WATCH_KINDS.items():
+            if interval > 0:
+                for sym in WATCHLIST:
+                    _watch_schedule(kind, sym, 0.0)
+    if not _WATCH_QUEUE:
+        return 3600.0
+    await _ensure_heavy_modules()
+
+    now = time.monotonic()
+    batch = []
+    while _WATCH_QUEUE and _WATCH_QUEUE[0][0] <= now and len(batch) < _WATCH_BATCH:
+        batch.append(heapq.heappop(_WATCH_QUEUE)[2:])
+    results = await asyncio.gather(*[_WATCH_KINDS[kind][2](sym) for kind, sym in batch], return_exceptions=True)
+    used = 0
+    for (kind, sym), result in zip(batch, results):
+        interval, cost, _ = _WATCH_KINDS[kind]
+        used += cost
+        if isinstance(result, BaseException):
+            _WATCH_FAILED[(kind, sym)] = f"{type(result).__name__}: {result}"
+            _watch_schedule(kind, sym, min(_jittered(interval), _JOB_RETRY_DELAY))
+        else:
+            _WATCH_FAILED.pop((kind, sym), None)
+            _WATCH_REFRESHED[(kind, sym)] = time.time()
+            _watch_schedule(kind, sym, _jittered(interval))
+    pace = used / WATCH_RATE if WATCH_RATE > 0 else 0.0
+    return max(pace, _WATCH_QUEUE[0][0] - time.monotonic(), 0.0)
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+# バリュエーション系ツールが返す項目（fields 射影で指定できる名前）
+_VALUATION_FIELDS = [
+    "shortName", "longName", "symbol", "exchange", "currency",
+    "currentPrice", "previousClose", "open", "dayLow", "dayHigh",
+    "fiftyTwoWeekLow", "fiftyTwoWeekHigh",
+    "marketCap", "enterpriseValue",
+    "trailingPE", "forwardPE", "priceToBook",
+    "trailingEps", "forwardEps",
+    "dividendYield", "dividendRate", "exDividendDate",
+    "beta", "volume", "averageVolume",
+    "totalRevenue", "grossProfits", "ebitda", "netIncomeToCommon",
+    "returnOnEquity", "returnOnAssets",
+    "debtToEquity", "currentRatio", "quickRatio",
+    "sector", "industry", "country", "website", "longBusinessSummary",
+]
+
+# スクリーナーが fields 省略時に返すクォート項目
+_SCREENER_FIELDS = [
+    "symbol", "shortName", "regularMarketPrice", "regularMarketChangePercent",
+    "regularMarketVolume", "marketCap", "trailingPE",
+]
+
+# compact 形式で使う短縮キー（対応表は yfinance://short-keys リソースで参照できる）。
+# 短縮キーから元の名前に一意に戻せるよう、値はすべて異なるものにする
+_SHORT_KEYS = {
+    "ticker": "t", "symbol": "s", "shortName": "n", "longName": "ln", "exchange": "x", "currency": "cur",
+    "currentPrice": "p", "regularMarketPrice": "rp", "previousClose": "pc", "open": "op", "dayLow": "dl", "dayHigh": "dh",
+    "fiftyTwoWeekLow": "l52", "fiftyTwoWeekHigh": "h52", "marketCap": "mc", "enterpriseValue": "ev",
+    "trailingPE": "pe", "forwardPE": "fpe", "priceToBook": "pb", "trailingEps": "eps", "forwardEps": "feps",
+    "dividendYield": "dy", "trailingAnnualDividendYield": "tdy", "dividendRate": "dr", "exDividendDate": "exd", "beta": "b",
+    "volume": "vol", "regularMarketVolume": "rv", "averageVolume": "av", "regularMarketChangePercent": "chg",
+    "totalRevenue": "rev", "grossProfits": "gp", "netIncomeToCommon": "ni",
+    "returnOnEquity": "roe", "returnOnAssets": "roa", "debtToEquity": "de", "currentRatio": "cr", "quickRatio": "qr",
+    "sector": "sec", "industry": "ind", "country": "ctry", "website": "web", "longBusinessSummary": "sum",
+    "date": "d", "Open": "o", "High": "h", "Low": "l", "Close": "c", "Volume": "v",
+    "Dividends": "div", "Stock Splits": "spl",
+    "cached": "ca", "status": "st", "error": "err", "elapsed_ms": "ms", "source": "src",
+    "period": "per", "interval": "int", "records": "r", "quotes": "q", "count": "k",
+    "articles": "a", "title": "ti", "url": "u", "published": "pub", "provider": "pv", "summary": "sm",
+    "tickers": "ts", "next_cursor": "nc", "has_more": "more", "cursor_expired": "cx",
+}
+
+
+def _shorten(obj: Any) -> Any:
+    """dict のキーを _SHORT_KEYS で短縮する（ネストした dict/list も対象）。
+
+    短縮キーと同名の元のキーが同じ dict にある場合（対応表にない列名など）は後の方を元の名前のまま残す。
+    """
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            short = _SHORT_KEYS.get(k, k)
+            out[k if short in out else short] = _shorten(v)
+        return out
+    if isinstance(obj, list) and obj and isinstance(obj[0], (dict, list)):
+        first = obj[0]
+        if isinstance(first, dict) and not any(isinstance(v, (dict, list)) for v in first.values()):
+            # 同じキー構成のフラットなレコード列はキー対応を 1 回だけ計算する
+            keys = tuple(first)
+            mapped = tuple(_shorten(dict.fromkeys(keys)))
+            return [dict(zip(mapped, r.values())) if tuple(r) == keys else _shorten(r) for r in obj]
+        return [_shorten(v) for v in obj]
+    return obj
+
+
+@_phase("render")
+def _dumps(obj: Any, response_format: Enum, indent: Optional[int] = 2) -> str:
+    """JSON 系フォーマットのシリアライズ。compact はインデントなし・短縮キー。"""
+    if response_format.value == "compact":
+        return json.dumps(_shorten(obj), ensure_ascii=False, separators=(",", ":"))
+    if indent is None:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+
+def _safe_val(val: Any) -> Any:
+    """pandas/numpy の値を JSON シリアライズ可能な Python 型に変換。"""
+    if isinstance(val, (np.integer, np.floating, np.bool_)):
+        val = val.item()
+    try:
+        if pd.isna(val):
+            return None
+    except (TypeError, ValueError):
+        pass  # list など配列状の値はそのまま返す
+    return val
+
+
+def _index_labels(index) -> List[str]:
+    """インデックスを ISO 形式の文字列リストに変換（時刻が全て 0 時なら日付のみ）。"""
+    if isinstance(index, pd.DatetimeIndex):
+        local = index.tz_localize(None) if index.tz is not None else index
+        if (index == index.normalize()).all():
+            return np.datetime_as_string(local.to_numpy(), unit="D").tolist()
+        labels = np.datetime_as_string(local.to_numpy(), unit="s")
+        if index.tz is None:
+            return labels.tolist()
+        # UTC オフセットは種類が少ない（夏時間の切替程度）ので一意な値だけ整形して付与
+        offsets = (local - index.tz_convert(None)).total_seconds().astype(int)
+        uniq, inverse = np.unique(offsets, return_inverse=True)
+        suffixes = np.array([f"{'+' if o >= 0 else '-'}{abs(o) // 3600:02d}:{abs(o) % 3600 // 60:02d}" for o in uniq])
+        return np.char.add(labels, suffixes[inverse]).tolist()
+    return index.astype(str).tolist()
+
+
+def _column_values(col) -> list:
+    """1 列分を一括変換したリストにする（NaN→None、numpy スカラ→Python 型）。"""
+    values = col.to_numpy()
+    kind = values.dtype.kind
+    if kind in "biu":
+        return values.tolist()
+    if kind == "f":
+        out = values.astype(object)
+        out[np.isnan(values)] = None
+        return out.tolist()
+    return [_safe_val(v) for v in values]
+
+
+@_phase("convert")
+def _df_to_columns(df) -> dict:
+    """DataFrame を列指向の dict（{'date': [...], 列名: [...]}）に変換。"""
+    if df is None or df.empty:
+        return {}
+    columns = {"date": _index_labels(df.index)}
+    for i, col in enumerate(df.columns):
+        columns[str(col)] = _column_values(df.iloc[:, i])
+    return columns
+
+
+@_phase("convert")
+def _df_to_records(df) -> List[dict]:
+    """DataFrame を JSON シリアライズ可能なレコードのリストに変換。"""
+    columns = _df_to_columns(df)
+    if not columns:
+        return []
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+
+@_phase("render")
+def _df_to_csv(df) -> str:
+    """DataFrame を date 列付きの CSV 文字列に変換（浮動小数は有効桁 10 桁）。"""
+    out = df.copy(deep=False)
+    out.index = _index_labels(df.index)
+    return out.to_csv(index_label="date", float_format="%.10g", lineterminator="\n")
+
+
+def _lttb_indices(y, n_out: int):
+    """Largest-Triangle-Three-Buckets で残す行の位置を返す（先頭と末尾は必ず含む）。
+
+    x は足の通し番号（取引のない日を詰めた等間隔）とする。各バケットの境界と
+    次バケットの平均は一括計算し、ループではバケット内の三角形面積の argmax だけを取る。
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    every = (n - 2) / (n_out - 2)
+    edges = np.append((np.floor(np.arange(n_out - 1) * every) + 1).astype(np.int64), n)
+    edges[-2] = n - 1  # 最後のバケットの「次」は末尾の 1 点
+    cs = np.concatenate([[0.0], np.cumsum(y)])
+    lo, hi = edges[1:-1], edges[2:]
+    avg_y = (cs[hi] - cs[lo]) / (hi - lo)
+    avg_x = (lo + hi - 1) / 2.0
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        xs = np.arange(start, end)
+        area = np.abs((a - avg_x[i]) * (y[start:end] - y[a]) - (a - xs) * (avg_y[i] - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def _ohlc_buckets(df, n_out: int):
+    """連続する足を n_out 個のバケットに集約する（始値=最初、高値=最大、安値=最小、終値=最後、出来高/配当=合計）。
+
+    日付は各バケット先頭の足。分割は期間内の比率の積（無ければ 0）。
+    """
+    n = len(df)
+    starts = np.unique(np.arange(n_out) * n // n_out)
+    ends = np.append(starts[1:], n) - 1
+    out = {}
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if col == "High":
+            out[col] = np.fmax.reduceat(values, starts)
+        elif col == "Low":
+            out[col] = np.fmin.reduceat(values, starts)
+        elif col == "Open":
+            out[col] = values[starts]
+        elif col in ("Volume", "Dividends"):
+            out[col] = np.add.reduceat(np.nan_to_num(values), starts)
+        elif col == "Stock Splits":
+            ratio = np.multiply.reduceat(np.where(values > 0, values, 1.0), starts)
+            out[col] = np.where(ratio == 1.0, 0.0, ratio)
+        else:
+            out[col] = values[ends]
+    return pd.DataFrame(out, index=df.index[starts])
+
+
+@_phase("convert")
+def _downsample(df, max_points: Optional[int], method: "DownsampleEnum"):
+    """max_points を超える行数なら method で間引く。(DataFrame, 間引き前の行数) を返す。"""
+    n = len(df)
+    if not max_points or n <= max_points:
+        return df, n
+    if method == DownsampleEnum.LTTB:
+        y = df["Close"].ffill().bfill().to_numpy(dtype=float)
+        return df.iloc[_lttb_indices(y, max_points)], n
+    return _ohlc_buckets(df, max_points), n
+
+
+@_phase("convert")
+def _df_to_matrix(df) -> List[list]:
+    """DataFrame の値を行ごとのリスト（NaN→None）に変換。"""
+    return [list(row) for row in zip(*(_column_values(df.iloc[:, i]) for i in range(df.shape[1])))]
+
+
+@_phase("convert")
+def _stmt_to_dict(stmt) -> dict:
+    """財務諸表 DataFrame を {期末日: {項目: 値}} に変換。"""
+    items = [str(idx) for idx in stmt.index]
+    return {
+        str(col)[:10]: dict(zip(items, _column_values(stmt.iloc[:, i])))
+        for i, col in enumerate(stmt.columns)
+    }
+
+
+@_phase("render")
+def _format_statement_md(stmt, title: str, heading: str = "#") -> str:
+    """財務諸表 DataFrame を Markdown テーブルに整形（100万以上は M 単位）。"""
+    lines = [f"{heading} {title}", ""]
+    cols = [str(c)[:10] for c in stmt.columns]
+    lines += [
+        "| 項目 | " + " | ".join(cols) + " |",
+        "| --- | " + " | ".join(["---:"] * len(cols)) + " |",
+    ]
+    columns = [_column_values(stmt.iloc[:, i]) for i in range(stmt.shape[1])]
+    for idx, row in zip(stmt.index, zip(*columns)):
+        vals = []
+        for v in row:
+            if v is None:
+                vals.append("N/A")
+            elif isinstance(v, (int, float)):
+                vals.append(f"{v/1e6:,.1f}M" if abs(v) >= 1e6 else f"{v:,.0f}")
+            else:
+                vals.append(str(v))
+        lines.append(f"| {idx} | " + " | ".join(vals) + " |")
+    return "\n".join(lines)
+
+
+# 年率換算に使う 1 年あたりの足の本数（日中足は 1 日 6.5 時間の取引時間で換算）
+_BARS_PER_YEAR = {
+    "1m": 252 * 390, "2m": 252 * 195, "5m": 252 * 78, "15m": 252 * 26, "30m": 252 * 13,
+    "60m": 252 * 6.5, "90m": 252 * 6.5 / 1.5, "1h": 252 * 6.5,
+    "1d": 252, "5d": 252 / 5, "1wk": 52, "1mo": 12, "3mo": 4,
+}
+
+
+@_phase("convert")
+def _compute_indicators(hist, params: "IndicatorInput") -> dict:
+    """OHLCV DataFrame から指標の系列をまとめて計算する。{列名: Series} を返す。"""
+    close, high, low = hist["Close"], hist["High"], hist["Low"]
+    w = params.window
+    out = {}
+    for ind in dict.fromkeys(params.indicators):
+        if ind == IndicatorEnum.SMA:
+            out[f"sma_{w}"] = close.rolling(w).mean()
+        elif ind == IndicatorEnum.EMA:
+            out[f"ema_{w}"] = close.ewm(span=w, adjust=False, min_periods=w).mean()
+        elif ind == IndicatorEnum.RSI:
+            # Wilder の平滑化（alpha = 1/n の指数移動平均）
+            n = params.rsi_window
+            delta = close.diff()
+            gain = delta.clip(lower=0).ewm(alpha=1 / n, adjust=False, min_periods=n).mean()
+            loss = (-delta.clip(upper=0)).ewm(alpha=1 / n, adjust=False, min_periods=n).mean()
+            out[f"rsi_{n}"] = 100 - 100 / (1 + gain / loss)
+        elif ind == IndicatorEnum.MACD:
+            fast = close.ewm(span=params.macd_fast, adjust=False).mean()
+            slow = close.ewm(span=params.macd_slow, adjust=False).mean()
+            macd = (fast - slow).where(close.expanding().count() >= params.macd_slow)
+            signal = macd.ewm(span=params.macd_signal, adjust=False, min_periods=params.macd_signal).mean()
+            out["macd"] = macd
+            out["macd_signal"] = signal
+            out["macd_hist"] = macd - signal
+        elif ind == IndicatorEnum.BOLLINGER:
+            mid = close.rolling(w).mean()
+            std = close.rolling(w).std(ddof=0)
+            out[f"bb_upper_{w}"] = mid + params.bollinger_std * std
+            out[f"bb_middle_{w}"] = mid
+            out[f"bb_lower_{w}"] = mid - params.bollinger_std * std
+        elif ind == IndicatorEnum.ATR:
+            n = params.atr_window
+            prev_close = close.shift(1)
+            tr = pd.concat([high - low, (high - prev_close).abs(), (low - prev_close).abs()], axis=1).max(axis=1)
+            out[f"atr_{n}"] = tr.ewm(alpha=1 / n, adjust=False, min_periods=n).mean()
+        elif ind == IndicatorEnum.VOLATILITY:
+            log_ret = np.log(close / close.shift(1))
+            out[f"volatility_{w}"] = log_ret.rolling(w).std() * np.sqrt(_BARS_PER_YEAR[params.interval.value])
+        elif ind == IndicatorEnum.DRAWDOWN:
+            out["drawdown"] = close / close.cummax() - 1
+    return out
+
+
+def _ledoit_wolf(centered) -> Tuple[Any, float]:
+    """Ledoit-Wolf (2004) の縮小共分散（目標はスケール付き単位行列）。(共分散, 縮小強度) を返す。"""
+    t, n = centered.shape
+    emp_cov = centered.T @ centered / t
+    mu = np.trace(emp_cov) / n
+    x2 = centered ** 2
+    beta_ = (x2.T @ x2).sum() / t
+    delta_ = (emp_cov ** 2).sum()
+    beta = (beta_ / t - delta_ / t) / n
+    delta = (delta_ - 2 * mu * np.trace(emp_cov) + n * mu ** 2) / n
+    intensity = 0.0 if delta == 0 else float(min(beta, delta) / delta)
+    return (1 - intensity) * emp_cov + intensity * mu * np.eye(n), intensity
+
+
+@_phase("convert")
+def _covariance_stats(returns, benchmark_returns=None, shrinkage: "ShrinkageEnum" = None) -> dict:
+    """リターン行列（列=銘柄）から共分散・相関・ベータをまとめて計算する。"""
+    x = returns.to_numpy(dtype=float)
+    centered = x - x.mean(axis=0)
+    t = len(x)
+    intensity = None
+    if shrinkage == ShrinkageEnum.LEDOIT_WOLF:
+        cov, intensity = _ledoit_wolf(centered)
+    else:
+        cov = centered.T @ centered / (t - 1)
+    std = np.sqrt(np.diag(cov))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = cov / np.outer(std, std)
+    np.fill_diagonal(corr, 1.0)
+    result = {"cov": cov, "corr": corr, "vol": std, "shrinkage_intensity": intensity, "observations": t}
+    if benchmark_returns is not None:
+        m = benchmark_returns.to_numpy(dtype=float)
+        m = m - m.mean()
+        var_m = m @ m
+        result["beta"] = centered.T @ m / var_m if var_m > 0 else np.full(x.shape[1], np.nan)
+    return result
+
+
+def _round_matrix(matrix, decimals: int) -> List[list]:
+    """ndarray を丸めたネストリストに変換（NaN→None）。"""
+    rounded = np.round(matrix, decimals).astype(object)
+    rounded[np.isnan(matrix)] = None
+    return rounded.tolist()
+
+
+def _tail_stats(worst) -> Tuple[float, float]:
+    """昇順に並んだ最悪側リターンから (VaR, CVaR) を損失（正の値）として返す。"""
+    return float(-worst[-1]), float(-worst.mean())
 
 
-class PriceHistoryInput(BaseModel):
-    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
-    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
-    period: PeriodEnum = Field(default=PeriodEnum.ONE_YEAR, description="取得期間: '1d','5d','1mo','3mo','6mo','1y','2y','5y','10y','ytd','max'")
-    interval: IntervalEnum = Field(default=IntervalEnum.ONE_DAY, description="足の間隔: '1d','1wk','1mo' など")
-    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown' または 'json'")
+def _mc_tail(mean, chol, weights, n_paths: int, seed, k: int):
+    """モンテカルロの 1 チャンク分。ポートフォリオリターンの最悪 k 件を昇順で返す。
 
+    資産の保有期間対数リターンを多変量正規 N(mean, chol chol^T) から生成する。
+    プロセスプールから呼ばれるためモジュールレベルに置く（ワーカーでの読み込みは _IN_POOL_WORKER を参照）。
+    """
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal((n_paths, len(mean)))
+    port = np.expm1(mean + z @ chol.T) @ weights
+    k = min(k, n_paths)
+    return np.sort(np.partition(port, k - 1)[:k])
 
-class FinancialsInput(BaseModel):
-    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
-    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
-    quarterly: bool = Field(default=False, description="True で四半期データ、False で年次データ")
-    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown' または 'json'")
 
+_RISK_POOL = None
 
-class NewsInput(BaseModel):
-    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
-    ticker: str = Field(..., description="ティッカーシンボル（例: 'AAPL', '7203.T'）", min_length=1, max_length=20)
-    count: int = Field(default=10, description="取得するニュース件数 (1〜50)", ge=1, le=50)
 
+def _risk_pool():
+    global _RISK_POOL
+    if _RISK_POOL is None:
+        from concurrent.futures import ProcessPoolExecutor  # 大量パスのときだけ使う
 
-class ScreenerInput(BaseModel):
-    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
-    query_type: str = Field(
-        ...,
-        description=(
-            "スクリーニングクエリ種別。例: 'most_actives', 'day_gainers', 'day_losers', "
-            "'growth_technology_stocks', 'undervalued_growth_stocks', 'aggressive_small_caps', "
-            "'small_cap_gainers', 'undervalued_large_caps', 'most_shorted_stocks'"
+        # 上流・SQLite・メトリクスのスレッドが動いているプロセスを fork すると子でロックが壊れうるので spawn で起動する
+        _RISK_POOL = ProcessPoolExecutor(
+            max_workers=RISK_PROCESSES or os.cpu_count() or 1, mp_context=multiprocessing.get_context("spawn"),
         )
-    )
-    count: int = Field(default=25, description="取得する銘柄数 (1〜100)", ge=1, le=100)
-    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown' または 'json'")
+    return _RISK_POOL
 
 
-class MultiTickerInput(BaseModel):
-    model_config = ConfigDict(str_strip_whitespace=True, validate_assignment=True, extra="forbid")
-    tickers: List[str] = Field(..., description="ティッカーシンボルのリスト（例: ['AAPL','MSFT','GOOG']）", min_length=1, max_length=20)
-    response_format: ResponseFormat = Field(default=ResponseFormat.MARKDOWN, description="出力フォーマット: 'markdown' または 'json'")
+async def _monte_carlo_var(log_returns, weights, horizon: int, confidence: float, n_paths: int, seed: int) -> Tuple[float, float]:
+    """保有期間リターンのモンテカルロ VaR/CVaR。
 
+    パスは RISK_MC_CHUNK 件ずつのチャンクに分け、SeedSequence(seed) から派生した
+    シードを割り当てる（分割はワーカー数に依存しないので結果はシードだけで決まる）。
+    各チャンクは最悪側の k 件だけを返し、親プロセスで統合する。
+    n_paths が RISK_PROCESS_THRESHOLD 以上ならプロセスプール、未満ならスレッドで実行する。
+    """
+    x = log_returns.to_numpy(dtype=float)
+    mean = x.mean(axis=0) * horizon
+    cov = np.cov(x, rowvar=False).reshape(len(mean), len(mean)) * horizon
+    # 半正定値でも分解できるよう対角に微小量を足す
+    chol = np.linalg.cholesky(cov + np.eye(len(mean)) * 1e-12 * max(np.trace(cov), 1e-12))
+    k = max(1, int(np.ceil(n_paths * (1 - confidence))))
+    sizes = [min(RISK_MC_CHUNK, n_paths - i) for i in range(0, n_paths, RISK_MC_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    loop = asyncio.get_running_loop()
+    if n_paths >= RISK_PROCESS_THRESHOLD:
+        pool = _risk_pool()
+        tails = await asyncio.gather(*[
+            loop.run_in_executor(pool, _mc_tail, mean, chol, weights, n, sd, k) for n, sd in zip(sizes, seeds)
+        ])
+    else:
+        tails = await asyncio.to_thread(lambda: [_mc_tail(mean, chol, weights, n, sd, k) for n, sd in zip(sizes, seeds)])
+    worst = np.sort(np.concatenate(tails))[:k]
+    return _tail_stats(worst)
 
-# ---------------------------------------------------------------------------
-# Helpers
-# ---------------------------------------------------------------------------
 
-def _safe_val(val: Any) -> Any:
-    """pandas/numpy の値を JSON シリアライズ可能な Python 型に変換。"""
-    try:
-        import pandas as pd
-        import numpy as np
-        if pd.isna(val):
-            return None
-    except Exception:
-        pass
-    try:
-        import numpy as np
-        if isinstance(val, (np.integer,)):
-            return int(val)
-        if isinstance(val, (np.floating,)):
-            return float(val)
-    except Exception:
-        pass
-    return val
+@_phase("convert")
+def _info_to_valuation(info: dict, fields: Optional[List[str]] = None) -> dict:
+    """info dict から主要なバリュエーション指標を抽出（fields 指定時はその項目だけ）。"""
+    return {k: _safe_val(info.get(k)) for k in (fields or _VALUATION_FIELDS)}
 
 
-def _df_to_records(df) -> List[dict]:
-    """DataFrame を JSON シリアライズ可能なレコードのリストに変換。"""
-    if df is None or df.empty:
-        return []
-    records = []
-    for idx, row in df.iterrows():
-        record = {"date": str(idx)}
-        for col in df.columns:
-            record[str(col)] = _safe_val(row[col])
-        records.append(record)
-    return records
-
-
-def _info_to_valuation(info: dict) -> dict:
-    """info dict から主要なバリュエーション指標を抽出。"""
-    fields = [
-        "shortName", "longName", "symbol", "exchange", "currency",
-        "currentPrice", "previousClose", "open", "dayLow", "dayHigh",
-        "fiftyTwoWeekLow", "fiftyTwoWeekHigh",
-        "marketCap", "enterpriseValue",
-        "trailingPE", "forwardPE", "priceToBook",
-        "trailingEps", "forwardEps",
-        "dividendYield", "dividendRate", "exDividendDate",
-        "beta", "volume", "averageVolume",
-        "totalRevenue", "grossProfits", "ebitda", "netIncomeToCommon",
-        "returnOnEquity", "returnOnAssets",
-        "debtToEquity", "currentRatio", "quickRatio",
-        "sector", "industry", "country", "website", "longBusinessSummary",
+def _format_cell(val: Any) -> str:
+    """汎用テーブル用のセル整形（大きな数値は T/B/M 単位）。"""
+    if val is None:
+        return "N/A"
+    if isinstance(val, bool):
+        return str(val)
+    if isinstance(val, (int, float)):
+        if abs(val) >= 1e12:
+            return f"{val/1e12:.2f}T"
+        if abs(val) >= 1e9:
+            return f"{val/1e9:.2f}B"
+        if abs(val) >= 1e6:
+            return f"{val/1e6:.2f}M"
+        return f"{val:,.2f}" if isinstance(val, float) else f"{val:,}"
+    text = str(val).replace("|", "/").replace("\n", " ")
+    return text if len(text) <= 40 else text[:39] + "…"
+
+
+@_phase("render")
+def _format_compare_md(data: List[dict]) -> List[str]:
+    """yfinance_compare_tickers の既定の比較表。"""
+    lines = [
+        "# 銘柄比較",
+        "",
+        "| ティッカー | 社名 | 現在値 | PER | PBR | 配当利回り | 時価総額 | ROE |",
+        "| --- | --- | ---: | ---: | ---: | ---: | ---: | ---: |",
+    ]
+    for d in data:
+        sym = d.get("ticker", "")
+        name = (d.get("shortName") or "")[:20] if d.get("status") == "ok" else f"({d.get('status')})"
+        price = d.get("currentPrice")
+        pe = d.get("trailingPE")
+        pb = d.get("priceToBook")
+        dy = d.get("dividendYield")
+        mcap = d.get("marketCap")
+        roe = d.get("returnOnEquity")
+        price_s = f"{price:.2f}" if price is not None else "N/A"
+        pe_s = f"{pe:.1f}" if pe is not None else "N/A"
+        pb_s = f"{pb:.2f}" if pb is not None else "N/A"
+        dy_s = f"{dy:.2%}" if dy is not None else "N/A"
+        mcap_s = f"{mcap/1e9:.1f}B" if mcap and mcap >= 1e9 else (f"{mcap/1e6:.1f}M" if mcap else "N/A")
+        roe_s = f"{roe:.2%}" if roe is not None else "N/A"
+        lines.append(f"| {sym} | {name} | {price_s} | {pe_s} | {pb_s} | {dy_s} | {mcap_s} | {roe_s} |")
+    return lines
+
+
+@_phase("render")
+def _format_fields_md(title: str, rows: List[dict], fields: List[str]) -> List[str]:
+    """fields 射影時の Markdown テーブル（列は fields の順）。"""
+    lines = [
+        f"# {title}",
+        "",
+        "| " + " | ".join(fields) + " |",
+        "| " + " | ".join(["---"] * len(fields)) + " |",
     ]
-    return {k: _safe_val(info.get(k)) for k in fields}
+    for r in rows:
+        lines.append("| " + " | ".join(_format_cell(r.get(f)) for f in fields) + " |")
+    return lines
 
 
+@_phase("render")
 def _format_valuation_md(data: dict, ticker: str) -> str:
     name = data.get("shortName") or data.get("longName") or ticker
     lines = [f"# {name} ({ticker}) バリュエーション概要", ""]
@@ -225,6 +3396,7 @@ def _format_valuation_md(data: dict, ticker: str) -> str:
     return "\n".join(lines)
 
 
+@_phase("render")
 def _format_analyst_md(info: dict, ticker: str) -> str:
     name = info.get("shortName") or ticker
     lines = [f"# {name} ({ticker}) アナリストコンセンサス", ""]
@@ -264,16 +3436,19 @@ def _format_analyst_md(info: dict, ticker: str) -> str:
 @mcp.tool(
     name="yfinance_get_valuation",
 )
-async def yfinance_get_valuation(params: TickerInput) -> str:
+@_instrumented
+async def yfinance_get_valuation(params: ValuationInput) -> str:
     """
     指定したティッカーの株価・バリュエーション指標を取得する。
 
     PER, PBR, 配当利回り, 時価総額, 52週高値/安値, ROE, ROA など主要指標を返す。
+    fields で必要な項目だけに絞ると応答が小さくなる。
 
     Args:
-        params (TickerInput):
+        params (ValuationInput):
             - ticker (str): ティッカーシンボル（例: 'AAPL', '7203.T'）
-            - response_format (str): 'markdown' または 'json'
+            - fields (List[str]): 返す項目名（省略時は全項目）
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: バリュエーション指標（Markdown or JSON）
@@ -284,13 +3459,15 @@ async def yfinance_get_valuation(params: TickerInput) -> str:
     """
     try:
         ticker = params.ticker.upper()
-        info = await asyncio.to_thread(lambda: yf.Ticker(ticker).info)
+        info, cached = await _get_info(ticker)
         if not info or info.get("trailingPE") is None and info.get("currentPrice") is None:
             return f"Error: '{ticker}' のデータが見つかりません。ティッカーシンボルを確認してください。"
-        data = _info_to_valuation(info)
+        data = _info_to_valuation(info, params.fields)
         if params.response_format == ResponseFormat.MARKDOWN:
-            return _format_valuation_md(data, ticker)
-        return json.dumps(data, ensure_ascii=False, indent=2)
+            if params.fields:
+                return "\n".join(_format_fields_md(f"{ticker} バリュエーション", [data], params.fields) + _cache_note(cached))
+            return "\n".join([_format_valuation_md(data, ticker)] + _cache_note(cached))
+        return _dumps({**data, "cached": cached}, params.response_format)
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
@@ -298,44 +3475,56 @@ async def yfinance_get_valuation(params: TickerInput) -> str:
 @mcp.tool(
     name="yfinance_get_price_history",
 )
+@_instrumented
 async def yfinance_get_price_history(params: PriceHistoryInput) -> str:
     """
     指定したティッカーの OHLCV（始値・高値・安値・終値・出来高）ヒストリーを取得する。
 
     日次・週次・月次など複数の時間軸に対応。テクニカル分析、VaR計算、
-    相関分析などに活用できる。
+    相関分析などに活用できる。日足以上はローカルストアに保存され、
+    2回目以降は前回以降の足だけを上流から取得する。
 
     Args:
         params (PriceHistoryInput):
             - ticker (str): ティッカーシンボル
             - period (str): 取得期間（'1d','1mo','1y','5y','max' など）
             - interval (str): 足の間隔（'1d','1wk','1mo' など）
-            - response_format (str): 'markdown' または 'json'
+            - max_points (int): 返す足の最大本数（超えたら期間全体を保ったまま間引く）
+            - downsample (str): 'ohlc'（バケット集約、既定）または 'lttb'（形状を保つ足を選択）
+            - response_format (str): 'markdown'、'json'、'compact'、'columns'、'csv'
+              （大量の足を機械処理するなら 'columns' か 'csv' が最小）
 
     Returns:
-        str: OHLCV データ（Markdown テーブル or JSON レコード配列）
+        str: OHLCV データ（Markdown テーブル、JSON レコード配列、列指向 JSON または CSV）
     """
     try:
         ticker = params.ticker.upper()
-        hist = await asyncio.to_thread(
-            lambda: yf.Ticker(ticker).history(
-                period=params.period.value,
-                interval=params.interval.value,
-            )
-        )
+        hist, cached = await _get_history(ticker, params.period.value, params.interval.value)
         if hist is None or hist.empty:
             return f"Error: '{ticker}' の価格ヒストリーが見つかりません。"
 
-        records = _df_to_records(hist)
+        hist, total = _downsample(hist, params.max_points, params.downsample)
+        meta = {"ticker": ticker, "period": params.period.value, "interval": params.interval.value, "cached": cached}
+        if len(hist) < total:
+            meta["downsampled"] = {"method": params.downsample.value, "from": total, "to": len(hist)}
 
-        if params.response_format == ResponseFormat.JSON:
-            return json.dumps({"ticker": ticker, "period": params.period.value, "interval": params.interval.value, "records": records}, ensure_ascii=False, indent=2)
+        fmt = params.response_format
+        if fmt == HistoryFormat.CSV:
+            return _df_to_csv(hist)
+        if fmt == HistoryFormat.COLUMNS:
+            return _dumps({**meta, "columns": _df_to_columns(hist)}, fmt, indent=None)
+        if fmt != HistoryFormat.MARKDOWN:
+            return _dumps({**meta, "records": _df_to_records(hist)}, fmt)
 
-        # Markdown テーブル（直近50件まで表示）
-        show = records[-50:]
+        # Markdown テーブル（max_points 指定時は間引いた全件、それ以外は直近50件まで表示）
+        show = _df_to_records(hist if params.max_points else hist.iloc[-50:])
+        if len(hist) < total:
+            summary = f"全 {total} 件 （{params.downsample.value} で {len(show)} 件に間引き）"
+        else:
+            summary = f"全 {total} 件 （直近 {len(show)} 件表示）"
         lines = [
             f"# {ticker} 価格ヒストリー ({params.period.value} / {params.interval.value})",
-            f"全 {len(records)} 件 （直近 {len(show)} 件表示）",
+            summary,
             "",
             "| 日付 | 始値 | 高値 | 安値 | 終値 | 出来高 |",
             "| --- | ---: | ---: | ---: | ---: | ---: |",
@@ -345,16 +3534,376 @@ async def yfinance_get_price_history(params: PriceHistoryInput) -> str:
             h = f"{r.get('High'):.2f}" if r.get("High") is not None else "N/A"
             lo = f"{r.get('Low'):.2f}" if r.get("Low") is not None else "N/A"
             c = f"{r.get('Close'):.2f}" if r.get("Close") is not None else "N/A"
-            v = f"{r.get('Volume'):,}" if r.get("Volume") is not None else "N/A"
+            # ローカルストアの足は float で持つので、出来高は整数に戻して表示する
+            v = f"{int(r.get('Volume')):,}" if r.get("Volume") is not None else "N/A"
             lines.append(f"| {r['date'][:10]} | {o} | {h} | {lo} | {c} | {v} |")
-        return "\n".join(lines)
+        return "\n".join(lines + _cache_note(cached))
+    except Exception as e:
+        return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
+
+
+@mcp.tool(
+    name="yfinance_get_price_history_batch",
+)
+@_instrumented
+async def yfinance_get_price_history_batch(params: BatchPriceHistoryInput) -> str:
+    """
+    複数ティッカーの終値・出来高を日付で揃えた行列として一括取得する。
+
+    yf.download の複数銘柄ダウンロードを使い、最大100銘柄を少数の上流リクエストで
+    取得する。ポートフォリオ分析や相関分析の入力に向く。
+
+    Args:
+        params (BatchPriceHistoryInput):
+            - tickers (List[str]): ティッカーシンボルのリスト（最大100）
+            - period (str): 取得期間（'1mo','1y','5y','max' など）
+            - interval (str): 足の間隔（'1d','1wk','1mo' など）
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: JSON は {dates, tickers, close[日付][銘柄], volume[日付][銘柄]} の行列、
+             Markdown は銘柄ごとの要約表
+    """
+    try:
+        tickers = list(dict.fromkeys(t.upper() for t in params.tickers))
+        hist, cached = await _batch_history(tickers, params.period.value, params.interval.value)
+        closes = _field_matrix(hist, "Close", tickers)
+        volumes = _field_matrix(hist, "Volume", tickers)
+        if closes is None or closes.dropna(how="all").empty:
+            return f"Error: {', '.join(tickers)} の価格ヒストリーが見つかりません。"
+        closes = closes.dropna(how="all")
+        volumes = volumes.reindex(closes.index) if volumes is not None else None
+
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps({
+                "tickers": tickers,
+                "period": params.period.value,
+                "interval": params.interval.value,
+                "cached": cached,
+                "dates": _index_labels(closes.index),
+                "close": _df_to_matrix(closes),
+                "volume": _df_to_matrix(volumes) if volumes is not None else None,
+            }, params.response_format)
+
+        lines = [
+            f"# 価格ヒストリー一括取得 ({params.period.value} / {params.interval.value})",
+            f"{len(tickers)} 銘柄 × {len(closes)} 本",
+            "",
+            "| ティッカー | 件数 | 開始日 | 始点終値 | 最新終値 | 騰落率 | 平均出来高 |",
+            "| --- | ---: | --- | ---: | ---: | ---: | ---: |",
+        ]
+        for sym in tickers:
+            series = closes[sym].dropna()
+            if series.empty:
+                lines.append(f"| {sym} | 0 | N/A | N/A | N/A | N/A | N/A |")
+                continue
+            first, last = float(series.iloc[0]), float(series.iloc[-1])
+            ret_s = f"{(last - first) / first:+.2%}" if first else "N/A"
+            avg_vol = _safe_val(volumes[sym].mean()) if volumes is not None else None
+            vol_s = f"{avg_vol:,.0f}" if avg_vol is not None else "N/A"
+            lines.append(f"| {sym} | {len(series)} | {str(series.index[0])[:10]} | {first:.2f} | {last:.2f} | {ret_s} | {vol_s} |")
+        return "\n".join(lines + _cache_note(cached))
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
 
+@mcp.tool(
+    name="yfinance_compute_indicators",
+)
+@_instrumented
+async def yfinance_compute_indicators(params: IndicatorInput) -> str:
+    """
+    価格ヒストリーからテクニカル指標をサーバー側で計算し、直近の値だけを返す。
+
+    SMA/EMA、RSI、MACD、ボリンジャーバンド、ATR、年率ボラティリティ、ドローダウンに
+    対応。OHLCV 全件をクライアントに送らずに済むため、応答は数百バイト程度になる。
+    価格データは yfinance_get_price_history と同じローカルストア/キャッシュを使う。
+
+    Args:
+        params (IndicatorInput):
+            - ticker (str): ティッカーシンボル
+            - period (str): 計算に使う期間（'1y','5y' など）
+            - interval (str): 足の間隔（'1d','1wk' など）
+            - indicators (List[str]): 計算する指標（省略時は全て）
+            - window / rsi_window / atr_window / macd_fast / macd_slow / macd_signal / bollinger_std: 各指標のパラメータ
+            - tail (int): 返す直近の本数（1 で最新値のみ）
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: 指標の最新値（tail > 1 の場合は直近 tail 本の系列）と最大ドローダウン
+
+    Examples:
+        - AAPL の RSI と MACD の現在値 → ticker='AAPL', indicators=['rsi','macd']
+        - 直近20日の20日移動平均 → indicators=['sma'], window=20, tail=20
+    """
+    try:
+        ticker = params.ticker.upper()
+        hist, cached = await _get_history(ticker, params.period.value, params.interval.value)
+        if hist is None or hist.empty:
+            return f"Error: '{ticker}' の価格ヒストリーが見つかりません。"
+
+        series = _compute_indicators(hist, params)
+        table = pd.DataFrame(series, index=hist.index).tail(params.tail).round(6)
+        last_close = _safe_val(hist["Close"].iloc[-1])
+        max_dd = _safe_val((hist["Close"] / hist["Close"].cummax() - 1).min()) if IndicatorEnum.DRAWDOWN in params.indicators else None
+        as_of = _index_labels(hist.index[-1:])[0]
+
+        if params.response_format != ResponseFormat.MARKDOWN:
+            result = {
+                "ticker": ticker, "period": params.period.value, "interval": params.interval.value,
+                "bars": len(hist), "as_of": as_of, "close": last_close, "cached": cached,
+            }
+            if params.tail == 1:
+                result["latest"] = {k: v[0] for k, v in _df_to_columns(table).items() if k != "date"}
+            else:
+                result["series"] = _df_to_columns(table)
+            if max_dd is not None:
+                result["max_drawdown"] = round(max_dd, 6)
+            return _dumps(result, params.response_format)
+
+        lines = [
+            f"# {ticker} テクニカル指標 ({params.period.value} / {params.interval.value})",
+            f"基準日: {as_of}　終値: {last_close:.2f}　計算対象: {len(hist)} 本" if last_close is not None else f"基準日: {as_of}",
+            "",
+        ]
+        columns = _df_to_columns(table)
+        names = [k for k in columns if k != "date"]
+        if params.tail == 1:
+            lines += ["| 指標 | 値 |", "| --- | ---: |"]
+            for name in names:
+                v = columns[name][0]
+                lines.append(f"| {name} | {v:.4f} |" if v is not None else f"| {name} | N/A |")
+        else:
+            lines += ["| 日付 | " + " | ".join(names) + " |", "| --- | " + " | ".join(["---:"] * len(names)) + " |"]
+            for i, date in enumerate(columns["date"]):
+                vals = [f"{columns[n][i]:.4f}" if columns[n][i] is not None else "N/A" for n in names]
+                lines.append(f"| {date[:16]} | " + " | ".join(vals) + " |")
+        if max_dd is not None:
+            lines += ["", f"- **最大ドローダウン**: {max_dd:.2%}"]
+        return "\n".join(lines + _cache_note(cached))
+    except Exception as e:
+        return f"Error: 指標の計算に失敗しました: {type(e).__name__}: {e}"
+
+
+@mcp.tool(
+    name="yfinance_correlation_matrix",
+)
+@_instrumented
+async def yfinance_correlation_matrix(params: CorrelationInput) -> str:
+    """
+    複数銘柄のリターンの相関行列・共分散行列と、基準指数に対するベータを計算する。
+
+    最大200銘柄の終値を一括ダウンロードで取得し、日付を揃えたリターン行列から
+    1回の行列演算でまとめて計算する。Ledoit-Wolf の縮小推定にも対応。
+    JSON は丸めた行列をインデントなしで返す。
+
+    Args:
+        params (CorrelationInput):
+            - tickers (List[str]): ティッカーシンボルのリスト（2〜200）
+            - benchmark (str): ベータの基準指数（デフォルト '^GSPC'、空文字で省略）
+            - period (str): 取得期間
+            - interval (str): リターンの間隔
+            - shrinkage (str): 'none' または 'ledoit_wolf'
+            - include_covariance (bool): 共分散行列も返すか
+            - decimals (int): 小数点以下桁数
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: JSON は {tickers, corr[i][j], beta, vol, cov?}。Markdown は相関表（15銘柄まで）
+             または相関の高い/低いペア上位とベータ一覧
+    """
+    try:
+        tickers = list(dict.fromkeys(t.upper() for t in params.tickers))
+        benchmark = (params.benchmark or "").upper() or None
+        symbols = tickers + ([benchmark] if benchmark and benchmark not in tickers else [])
+        returns, dropped, cached = await _aligned_returns(symbols, params.period.value, params.interval.value)
+        if benchmark and benchmark in dropped:
+            return f"Error: 基準指数 '{benchmark}' の価格ヒストリーが見つかりません。"
+        used = [t for t in tickers if t in returns.columns]
+        if len(used) < 2 or len(returns) < 3:
+            return f"Error: 相関を計算できるデータが不足しています（有効銘柄 {len(used)}、共通期間 {len(returns)} 本）。"
+
+        stats = _covariance_stats(returns[used], returns[benchmark] if benchmark else None, params.shrinkage)
+        vol_annual = stats["vol"] * np.sqrt(_BARS_PER_YEAR[params.interval.value])
+        betas = dict(zip(used, _round_matrix(stats["beta"], params.decimals))) if benchmark else None
+
+        if params.response_format != ResponseFormat.MARKDOWN:
+            result = {
+                "tickers": used,
+                "dropped": [t for t in dropped if t != benchmark],
+                "period": params.period.value,
+                "interval": params.interval.value,
+                "observations": stats["observations"],
+                "shrinkage": params.shrinkage.value,
+                "shrinkage_intensity": round(stats["shrinkage_intensity"], 6) if stats["shrinkage_intensity"] is not None else None,
+                "cached": cached,
+                "vol_annualized": _round_matrix(vol_annual, params.decimals),
+                "corr": _round_matrix(stats["corr"], params.decimals),
+            }
+            if benchmark:
+                result["benchmark"] = benchmark
+                result["beta"] = betas
+            if params.include_covariance:
+                result["cov"] = _round_matrix(stats["cov"], max(params.decimals, 8))
+            return _dumps(result, params.response_format, indent=None)
+
+        corr = stats["corr"]
+        lines = [
+            f"# 相関分析 ({params.period.value} / {params.interval.value})",
+            f"{len(used)} 銘柄 × 共通期間 {stats['observations']} 本"
+            + (f"　Ledoit-Wolf 縮小強度: {stats['shrinkage_intensity']:.3f}" if stats["shrinkage_intensity"] is not None else ""),
+            "",
+        ]
+        if len(used) <= 15:
+            lines += [
+                "## 相関行列",
+                "| | " + " | ".join(used) + " |",
+                "| --- | " + " | ".join(["---:"] * len(used)) + " |",
+            ]
+            for i, sym in enumerate(used):
+                lines.append(f"| {sym} | " + " | ".join(f"{v:.2f}" for v in corr[i]) + " |")
+        else:
+            iu = np.triu_indices(len(used), k=1)
+            pairs = corr[iu]
+            order = np.argsort(pairs)
+            for title, picks in [("相関の高いペア（上位10）", order[::-1][:10]), ("相関の低いペア（上位10）", order[:10])]:
+                lines += ([""] if lines[-1] else []) + [f"## {title}", "| 銘柄A | 銘柄B | 相関 |", "| --- | --- | ---: |"]
+                lines += [f"| {used[iu[0][k]]} | {used[iu[1][k]]} | {pairs[k]:.3f} |" for k in picks]
+        lines += ["", "## 年率ボラティリティ" + (f" / ベータ（対 {benchmark}）" if benchmark else "")]
+        lines += ["| 銘柄 | ボラティリティ |" + (" ベータ |" if benchmark else ""), "| --- | ---: |" + (" ---: |" if benchmark else "")]
+        for i, sym in enumerate(used):
+            beta_s = ""
+            if benchmark:
+                beta_s = f" {betas[sym]:.2f} |" if betas[sym] is not None else " N/A |"
+            lines.append(f"| {sym} | {vol_annual[i]:.2%} |{beta_s}")
+        if dropped:
+            lines += ["", f"_データ不足で除外: {', '.join(t for t in dropped if t != benchmark)}_"]
+        return "\n".join(lines + _cache_note(cached))
+    except Exception as e:
+        return f"Error: 相関の計算に失敗しました: {type(e).__name__}: {e}"
+
+
+@mcp.tool(
+    name="yfinance_portfolio_risk",
+)
+@_instrumented
+async def yfinance_portfolio_risk(params: PortfolioRiskInput) -> str:
+    """
+    保有銘柄と比率からポートフォリオの VaR / CVaR（期待ショートフォール）を計算する。
+
+    価格ヒストリーを一括取得し、ヒストリカル法・分散共分散法（正規分布）・
+    モンテカルロ法（多変量正規、numpy でバッチ生成）を1回の呼び出しで計算する。
+    大量パスのモンテカルロはプロセスプールで並列化し、seed で再現できる。
+    あわせて年率ボラティリティと銘柄ごとのリスク寄与率を返す。
+
+    Args:
+        params (PortfolioRiskInput):
+            - holdings (List[dict]): [{'ticker': 'AAPL', 'weight': 0.6}, ...]（合計で正規化）
+            - portfolio_value (float): 評価額（指定時は金額も返す）
+            - confidence (float): 信頼水準（デフォルト 0.99）
+            - horizon (int): 保有期間（足の本数、デフォルト 1）
+            - period (str): 推定期間（デフォルト '2y'）
+            - interval (str): リターンの間隔（デフォルト '1d'）
+            - methods (List[str]): 'historical','parametric','monte_carlo'
+            - n_paths (int): モンテカルロのパス数
+            - seed (int): 乱数シード
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: 手法ごとの VaR/CVaR（損失率、正の値）とリスク寄与（Markdown or JSON）
+    """
+    try:
+        weights_by_ticker: dict = {}
+        for h in params.holdings:
+            sym = h.ticker.upper()
+            weights_by_ticker[sym] = weights_by_ticker.get(sym, 0.0) + h.weight
+        total = sum(weights_by_ticker.values())
+        if total <= 0:
+            return "Error: 保有比率の合計が正になるように指定してください。"
+        tickers = list(weights_by_ticker)
+
+        returns, dropped, cached = await _aligned_returns(tickers, params.period.value, params.interval.value)
+        if dropped:
+            return f"Error: 価格ヒストリーが不足している銘柄があります: {', '.join(dropped)}"
+        if len(returns) < max(30, params.horizon + 10):
+            return f"Error: リスク計算に十分な共通期間がありません（{len(returns)} 本）。period を長くしてください。"
+
+        returns = returns[tickers]
+        w = np.array([weights_by_ticker[t] / total for t in tickers])
+        alpha = 1 - params.confidence
+        h = params.horizon
+        port = returns.to_numpy() @ w
+        log_returns = np.log1p(returns)
+        seed = params.seed if params.seed is not None else int(np.random.SeedSequence().entropy % (2 ** 63))
+
+        results: dict = {}
+        for method in dict.fromkeys(params.methods):
+            if method == VarMethodEnum.HISTORICAL:
+                # 重なりのある h 本累積リターン（対数リターンの移動和）
+                log_port = np.log1p(port)
+                cum = np.expm1(np.convolve(log_port, np.ones(h), mode="valid")) if h > 1 else port
+                k = max(1, int(np.ceil(len(cum) * alpha)))
+                var, cvar = _tail_stats(np.sort(cum)[:k])
+                results["historical"] = {"var": var, "cvar": cvar, "samples": len(cum)}
+            elif method == VarMethodEnum.PARAMETRIC:
+                mu, sigma = port.mean() * h, port.std(ddof=1) * np.sqrt(h)
+                z = NormalDist().inv_cdf(alpha)
+                var = -(mu + z * sigma)
+                cvar = -(mu - sigma * NormalDist().pdf(z) / alpha)
+                results["parametric"] = {"var": float(var), "cvar": float(cvar)}
+            elif method == VarMethodEnum.MONTE_CARLO:
+                var, cvar = await _monte_carlo_var(log_returns, w, h, params.confidence, params.n_paths, seed)
+                results["monte_carlo"] = {"var": var, "cvar": cvar, "paths": params.n_paths, "seed": seed}
+
+        cov = np.cov(returns.to_numpy(), rowvar=False).reshape(len(w), len(w))
+        port_var = float(w @ cov @ w)
+        contrib = w * (cov @ w) / port_var if port_var > 0 else np.full(len(w), np.nan)
+        vol_annual = np.sqrt(port_var * _BARS_PER_YEAR[params.interval.value])
+        if params.portfolio_value:
+            for r in results.values():
+                r["var_amount"] = r["var"] * params.portfolio_value
+                r["cvar_amount"] = r["cvar"] * params.portfolio_value
+
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps({
+                "tickers": tickers,
+                "weights": [round(float(x), 6) for x in w],
+                "confidence": params.confidence,
+                "horizon": h,
+                "interval": params.interval.value,
+                "observations": len(returns),
+                "portfolio_value": params.portfolio_value,
+                "vol_annualized": round(float(vol_annual), 6),
+                "risk_contribution": dict(zip(tickers, _round_matrix(contrib, 6))),
+                "cached": cached,
+                "results": {m: {k: (round(v, 8) if isinstance(v, float) else v) for k, v in r.items()} for m, r in results.items()},
+            }, params.response_format)
+
+        labels = {"historical": "ヒストリカル", "parametric": "分散共分散（正規）", "monte_carlo": "モンテカルロ"}
+        lines = [
+            f"# ポートフォリオリスク（信頼水準 {params.confidence:.1%} / 保有期間 {h} × {params.interval.value}）",
+            f"{len(tickers)} 銘柄 / 推定期間 {params.period.value}（共通 {len(returns)} 本）/ 年率ボラティリティ {vol_annual:.2%}",
+            "",
+            "| 手法 | VaR | CVaR |" + (" VaR（金額） | CVaR（金額） |" if params.portfolio_value else ""),
+            "| --- | ---: | ---: |" + (" ---: | ---: |" if params.portfolio_value else ""),
+        ]
+        for m, r in results.items():
+            amounts = f" {r['var_amount']:,.0f} | {r['cvar_amount']:,.0f} |" if params.portfolio_value else ""
+            lines.append(f"| {labels[m]} | {r['var']:.2%} | {r['cvar']:.2%} |{amounts}")
+        if "monte_carlo" in results:
+            lines += ["", f"_モンテカルロ: {params.n_paths:,} パス、seed={seed}_"]
+        lines += ["", "## リスク寄与", "| 銘柄 | 比率 | リスク寄与率 |", "| --- | ---: | ---: |"]
+        for t, wi, ci in zip(tickers, w, contrib):
+            lines.append(f"| {t} | {wi:.2%} | {f'{ci:.2%}' if np.isfinite(ci) else 'N/A'} |")
+        return "\n".join(lines + _cache_note(cached))
+    except Exception as e:
+        return f"Error: リスク計算に失敗しました: {type(e).__name__}: {e}"
+
+
 @mcp.tool(
     name="yfinance_get_income_statement",
 )
+@_instrumented
 async def yfinance_get_income_statement(params: FinancialsInput) -> str:
     """
     指定したティッカーの損益計算書（P/L）を取得する。
@@ -366,42 +3915,13 @@ async def yfinance_get_income_statement(params: FinancialsInput) -> str:
         params (FinancialsInput):
             - ticker (str): ティッカーシンボル
             - quarterly (bool): True で四半期データ、False で年次データ（デフォルト）
-            - response_format (str): 'markdown' または 'json'
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: 損益計算書データ（Markdown or JSON）
     """
     try:
-        ticker = params.ticker.upper()
-        t = yf.Ticker(ticker)
-        stmt = await asyncio.to_thread(lambda: t.quarterly_income_stmt if params.quarterly else t.income_stmt)
-        if stmt is None or stmt.empty:
-            return f"Error: '{ticker}' の損益計算書データが見つかりません。"
-
-        period_label = "四半期" if params.quarterly else "年次"
-        if params.response_format == ResponseFormat.JSON:
-            data = {}
-            for col in stmt.columns:
-                data[str(col)[:10]] = {str(idx): _safe_val(stmt.loc[idx, col]) for idx in stmt.index}
-            return json.dumps({"ticker": ticker, "type": "income_statement", "period": period_label, "data": data}, ensure_ascii=False, indent=2)
-
-        lines = [f"# {ticker} 損益計算書 ({period_label})", ""]
-        cols = [str(c)[:10] for c in stmt.columns]
-        header = "| 項目 | " + " | ".join(cols) + " |"
-        sep = "| --- | " + " | ".join(["---:"] * len(cols)) + " |"
-        lines += [header, sep]
-        for idx in stmt.index:
-            vals = []
-            for col in stmt.columns:
-                v = _safe_val(stmt.loc[idx, col])
-                if v is None:
-                    vals.append("N/A")
-                elif isinstance(v, (int, float)):
-                    vals.append(f"{v/1e6:,.1f}M" if abs(v) >= 1e6 else f"{v:,.0f}")
-                else:
-                    vals.append(str(v))
-            lines.append(f"| {idx} | " + " | ".join(vals) + " |")
-        return "\n".join(lines)
+        return await _statement_tool(params.ticker.upper(), [StatementEnum.INCOME], params.quarterly, params.response_format)
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
@@ -409,6 +3929,7 @@ async def yfinance_get_income_statement(params: FinancialsInput) -> str:
 @mcp.tool(
     name="yfinance_get_balance_sheet",
 )
+@_instrumented
 async def yfinance_get_balance_sheet(params: FinancialsInput) -> str:
     """
     指定したティッカーの貸借対照表（B/S）を取得する。
@@ -420,42 +3941,13 @@ async def yfinance_get_balance_sheet(params: FinancialsInput) -> str:
         params (FinancialsInput):
             - ticker (str): ティッカーシンボル
             - quarterly (bool): True で四半期データ、False で年次データ
-            - response_format (str): 'markdown' または 'json'
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: 貸借対照表データ（Markdown or JSON）
     """
     try:
-        ticker = params.ticker.upper()
-        t = yf.Ticker(ticker)
-        stmt = await asyncio.to_thread(lambda: t.quarterly_balance_sheet if params.quarterly else t.balance_sheet)
-        if stmt is None or stmt.empty:
-            return f"Error: '{ticker}' の貸借対照表データが見つかりません。"
-
-        period_label = "四半期" if params.quarterly else "年次"
-        if params.response_format == ResponseFormat.JSON:
-            data = {}
-            for col in stmt.columns:
-                data[str(col)[:10]] = {str(idx): _safe_val(stmt.loc[idx, col]) for idx in stmt.index}
-            return json.dumps({"ticker": ticker, "type": "balance_sheet", "period": period_label, "data": data}, ensure_ascii=False, indent=2)
-
-        lines = [f"# {ticker} 貸借対照表 ({period_label})", ""]
-        cols = [str(c)[:10] for c in stmt.columns]
-        header = "| 項目 | " + " | ".join(cols) + " |"
-        sep = "| --- | " + " | ".join(["---:"] * len(cols)) + " |"
-        lines += [header, sep]
-        for idx in stmt.index:
-            vals = []
-            for col in stmt.columns:
-                v = _safe_val(stmt.loc[idx, col])
-                if v is None:
-                    vals.append("N/A")
-                elif isinstance(v, (int, float)):
-                    vals.append(f"{v/1e6:,.1f}M" if abs(v) >= 1e6 else f"{v:,.0f}")
-                else:
-                    vals.append(str(v))
-            lines.append(f"| {idx} | " + " | ".join(vals) + " |")
-        return "\n".join(lines)
+        return await _statement_tool(params.ticker.upper(), [StatementEnum.BALANCE_SHEET], params.quarterly, params.response_format)
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
@@ -463,6 +3955,7 @@ async def yfinance_get_balance_sheet(params: FinancialsInput) -> str:
 @mcp.tool(
     name="yfinance_get_cash_flow",
 )
+@_instrumented
 async def yfinance_get_cash_flow(params: FinancialsInput) -> str:
     """
     指定したティッカーのキャッシュフロー計算書（C/F）を取得する。
@@ -474,42 +3967,40 @@ async def yfinance_get_cash_flow(params: FinancialsInput) -> str:
         params (FinancialsInput):
             - ticker (str): ティッカーシンボル
             - quarterly (bool): True で四半期データ、False で年次データ
-            - response_format (str): 'markdown' または 'json'
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: キャッシュフロー計算書データ（Markdown or JSON）
     """
     try:
-        ticker = params.ticker.upper()
-        t = yf.Ticker(ticker)
-        stmt = await asyncio.to_thread(lambda: t.quarterly_cashflow if params.quarterly else t.cashflow)
-        if stmt is None or stmt.empty:
-            return f"Error: '{ticker}' のキャッシュフローデータが見つかりません。"
-
-        period_label = "四半期" if params.quarterly else "年次"
-        if params.response_format == ResponseFormat.JSON:
-            data = {}
-            for col in stmt.columns:
-                data[str(col)[:10]] = {str(idx): _safe_val(stmt.loc[idx, col]) for idx in stmt.index}
-            return json.dumps({"ticker": ticker, "type": "cash_flow", "period": period_label, "data": data}, ensure_ascii=False, indent=2)
-
-        lines = [f"# {ticker} キャッシュフロー計算書 ({period_label})", ""]
-        cols = [str(c)[:10] for c in stmt.columns]
-        header = "| 項目 | " + " | ".join(cols) + " |"
-        sep = "| --- | " + " | ".join(["---:"] * len(cols)) + " |"
-        lines += [header, sep]
-        for idx in stmt.index:
-            vals = []
-            for col in stmt.columns:
-                v = _safe_val(stmt.loc[idx, col])
-                if v is None:
-                    vals.append("N/A")
-                elif isinstance(v, (int, float)):
-                    vals.append(f"{v/1e6:,.1f}M" if abs(v) >= 1e6 else f"{v:,.0f}")
-                else:
-                    vals.append(str(v))
-            lines.append(f"| {idx} | " + " | ".join(vals) + " |")
-        return "\n".join(lines)
+        return await _statement_tool(params.ticker.upper(), [StatementEnum.CASH_FLOW], params.quarterly, params.response_format)
+    except Exception as e:
+        return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
+
+
+@mcp.tool(
+    name="yfinance_get_financials",
+)
+@_instrumented
+async def yfinance_get_financials(params: CombinedFinancialsInput) -> str:
+    """
+    指定したティッカーの損益計算書・貸借対照表・キャッシュフロー計算書をまとめて取得する。
+
+    3 表（年次・四半期の両方）を 1 回の上流ジョブで取得して銘柄単位でキャッシュするため、
+    個別ツールを 3 回呼ぶより速く、その後の個別ツール呼び出しもキャッシュから返る。
+
+    Args:
+        params (CombinedFinancialsInput):
+            - ticker (str): ティッカーシンボル
+            - quarterly (bool): True で四半期データ、False で年次データ（デフォルト）
+            - statements (List[str]): 'income','balance_sheet','cash_flow'（省略時は全て）
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: 指定した財務諸表データ（Markdown or JSON）
+    """
+    try:
+        return await _statement_tool(params.ticker.upper(), list(dict.fromkeys(params.statements)), params.quarterly, params.response_format)
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
@@ -517,6 +4008,7 @@ async def yfinance_get_cash_flow(params: FinancialsInput) -> str:
 @mcp.tool(
     name="yfinance_get_analyst_consensus",
 )
+@_instrumented
 async def yfinance_get_analyst_consensus(params: TickerInput) -> str:
     """
     指定したティッカーのアナリストコンセンサス情報を取得する。
@@ -527,15 +4019,14 @@ async def yfinance_get_analyst_consensus(params: TickerInput) -> str:
     Args:
         params (TickerInput):
             - ticker (str): ティッカーシンボル
-            - response_format (str): 'markdown' または 'json'
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: アナリストコンセンサスと推定リターン（Markdown or JSON）
     """
     try:
         ticker = params.ticker.upper()
-        t = yf.Ticker(ticker)
-        info = await asyncio.to_thread(lambda: t.info)
+        info, cached = await _get_info(ticker)
         if not info:
             return f"Error: '{ticker}' のデータが見つかりません。"
 
@@ -556,9 +4047,9 @@ async def yfinance_get_analyst_consensus(params: TickerInput) -> str:
                     returns[scenario] = round((target - current) / current, 4)
         data["estimated_returns"] = returns
 
-        if params.response_format == ResponseFormat.JSON:
-            return json.dumps({"ticker": ticker, **data}, ensure_ascii=False, indent=2)
-        return _format_analyst_md(info, ticker)
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps({"ticker": ticker, **data, "cached": cached}, params.response_format)
+        return "\n".join([_format_analyst_md(info, ticker)] + _cache_note(cached))
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
@@ -566,49 +4057,118 @@ async def yfinance_get_analyst_consensus(params: TickerInput) -> str:
 @mcp.tool(
     name="yfinance_get_news",
 )
+@_instrumented
 async def yfinance_get_news(params: NewsInput) -> str:
     """
     指定したティッカーの最新ニュースを取得する。
 
     各記事のタイトル、URL、公開日時、要約（利用可能な場合）を返す。
     定性的な情報収集やセンチメント分析の入力として活用できる。
+    記事は ID で重複排除して銘柄ごとにキャッシュされ、since（公開日時）や
+    cursor（前回応答の next_cursor）を指定すると新着記事だけを返す。cursor 指定時に
+    新着が count を超える場合は取得順に count 件返し（has_more=true）、残りは次の cursor で返す。
+    サーバーの再起動などで無効になった cursor は cursor_expired=true として最新記事から返し直す。
 
     Args:
         params (NewsInput):
             - ticker (str): ティッカーシンボル
             - count (int): 取得するニュース件数（1〜50、デフォルト10）
+            - since (str): この日時より後に公開された記事のみ（ISO 8601 または UNIX 秒）
+            - cursor (str): 前回応答の next_cursor（それ以降に新たに取得した記事のみ）
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
-        str: ニュース記事一覧（Markdown フォーマット）
+        str: ニュース記事一覧（Markdown or JSON）と次回用の next_cursor
     """
     try:
         ticker = params.ticker.upper()
-        t = yf.Ticker(ticker)
-        news = await asyncio.to_thread(lambda: t.news)
-        if not news:
+        since = _parse_time(params.since)
+        if params.since and since is None:
+            return f"Error: since を日時として解釈できません: {params.since}"
+        try:
+            cursor, expired = _parse_cursor(params.cursor)
+        except ValueError as e:
+            return f"Error: {e}"
+        feed, cached = await _get_news_feed(ticker)
+        if not feed:
             return f"'{ticker}' のニュースが見つかりません。"
 
-        articles = news[: params.count]
-        lines = [f"# {ticker} 最新ニュース ({len(articles)} 件)", ""]
-        for i, article in enumerate(articles, 1):
-            content = article.get("content", {})
-            title = content.get("title") or article.get("title", "タイトル不明")
-            url = content.get("canonicalUrl", {}).get("url") or article.get("link", "")
-            pub = content.get("pubDate") or article.get("providerPublishTime", "")
-            summary = content.get("summary") or ""
-            provider = content.get("provider", {}).get("displayName") or article.get("publisher", "")
-
-            lines.append(f"## {i}. {title}")
-            if provider:
-                lines.append(f"- **媒体**: {provider}")
-            if pub:
-                lines.append(f"- **公開日時**: {str(pub)[:19]}")
-            if url:
-                lines.append(f"- **URL**: {url}")
-            if summary:
-                lines.append(f"- **要約**: {summary[:300]}{'...' if len(summary) > 300 else ''}")
-            lines.append("")
-        return "\n".join(lines)
+        selected, next_seq, more = _select_news(feed.values(), since, cursor, params.count)
+        articles = [_article_out(a) for a in selected]
+        next_cursor = _news_cursor(next_seq)
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps({
+                "ticker": ticker, "count": len(articles), "next_cursor": next_cursor, "has_more": more,
+                "cursor_expired": expired, "cached": cached, "articles": articles,
+            }, params.response_format)
+        notes = _news_notes(next_cursor, more, expired)
+        if not articles:
+            return "\n".join([f"'{ticker}' の新着ニュースはありません。", ""] + notes)
+        lines = _format_news_md(f"# {ticker} 最新ニュース ({len(articles)} 件)", articles)
+        return "\n".join(lines + notes + _cache_note(cached))
+    except Exception as e:
+        return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
+
+
+@mcp.tool(
+    name="yfinance_get_news_multi",
+)
+@_instrumented
+async def yfinance_get_news_multi(params: MultiNewsInput) -> str:
+    """
+    複数ティッカーのニュースを並行取得し、公開日時の新しい順に統合して返す。
+
+    同じ記事が複数の銘柄に紐づく場合は 1 件にまとめ、関連銘柄を tickers に列挙する。
+    since / cursor は yfinance_get_news と同じで、ウォッチリストの新着ポーリングに使える
+    （キャッシュ有効期間内は上流へのリクエストも発生しない）。
+
+    Args:
+        params (MultiNewsInput):
+            - tickers (List[str]): ティッカーシンボルのリスト（最大50）
+            - count (int): 返す記事の総数（1〜200、デフォルト20）
+            - since (str): この日時より後に公開された記事のみ
+            - cursor (str): 前回応答の next_cursor
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: 統合したニュース記事一覧（Markdown or JSON）、取得に失敗した銘柄と next_cursor
+    """
+    try:
+        tickers = list(dict.fromkeys(t.upper() for t in params.tickers))
+        since = _parse_time(params.since)
+        if params.since and since is None:
+            return f"Error: since を日時として解釈できません: {params.since}"
+        try:
+            cursor, expired = _parse_cursor(params.cursor)
+        except ValueError as e:
+            return f"Error: {e}"
+        results = await asyncio.gather(*[_get_news_feed(t) for t in tickers], return_exceptions=True)
+
+        merged: dict = {}
+        errors = {}
+        for ticker, result in zip(tickers, results):
+            if isinstance(result, BaseException):
+                errors[ticker] = f"{type(result).__name__}: {result}"
+                continue
+            for article in result[0].values():
+                entry = merged.setdefault(article["id"], {**article, "tickers": []})
+                entry["tickers"].append(ticker)
+                entry["seq"] = min(entry["seq"], article["seq"])
+        cached = all(not isinstance(r, BaseException) and r[1] for r in results)
+
+        selected, next_seq, more = _select_news(merged.values(), since, cursor, params.count)
+        articles = [_article_out(a) for a in selected]
+        next_cursor = _news_cursor(next_seq)
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps({
+                "tickers": tickers, "count": len(articles), "next_cursor": next_cursor, "has_more": more,
+                "cursor_expired": expired, "cached": cached, "errors": errors, "articles": articles,
+            }, params.response_format)
+        title = f"# ニュース: {', '.join(tickers)} ({len(articles)} 件)"
+        lines = _format_news_md(title, articles) if articles else [title, "", "新着ニュースはありません。", ""]
+        if errors:
+            lines += [f"- **{t}**: 取得失敗（{e}）" for t, e in errors.items()] + [""]
+        return "\n".join(lines + _news_notes(next_cursor, more, expired) + _cache_note(cached))
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
@@ -616,10 +4176,14 @@ async def yfinance_get_news(params: NewsInput) -> str:
 @mcp.tool(
     name="yfinance_screen_stocks",
 )
+@_instrumented
 async def yfinance_screen_stocks(params: ScreenerInput) -> str:
     """
     Yahoo Finance のプリセットクエリで銘柄をスクリーニングする。
 
+    結果は query_type ごとに最大 100 件をキャッシュし（YFINANCE_MCP_SCREENER_TTL 秒）、
+    count はそこから切り出す。most_actives などよく使うクエリはバックグラウンドで更新される。
+
     60以上の取引所に対応。主要なクエリ種別:
     - most_actives: 売買高上位
     - day_gainers: 本日の値上がり上位
@@ -635,48 +4199,29 @@ async def yfinance_screen_stocks(params: ScreenerInput) -> str:
         params (ScreenerInput):
             - query_type (str): スクリーニングクエリ種別
             - count (int): 取得銘柄数 (1〜100、デフォルト25)
-            - response_format (str): 'markdown' または 'json'
+            - fields (List[str]): 返すクォート項目名（省略時は主要 7 項目）
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: スクリーニング結果の銘柄一覧（Markdown or JSON）
     """
     try:
-        screener = yf.Screener()
-        body = {
-            "offset": 0,
-            "size": params.count,
-            "sortField": "percentchange",
-            "sortType": "DESC",
-            "quoteType": "EQUITY",
-            "query": {"operator": "and", "operands": []},
-            "userId": "",
-            "userIdType": "guid",
-        }
+        result, cached = await _get_screener(params.query_type)
 
-        def _run():
-            screener.set_predefined_body(params.query_type)
-            screener.size = params.count
-            return screener.response
-
-        result = await asyncio.to_thread(_run)
-
-        quotes = result.get("quotes", [])
+        quotes = (result or {}).get("quotes", [])[:params.count]
         if not quotes:
             return f"'{params.query_type}' のスクリーニング結果が見つかりません。"
 
-        if params.response_format == ResponseFormat.JSON:
-            simplified = []
-            for q in quotes:
-                simplified.append({
-                    "symbol": q.get("symbol"),
-                    "shortName": q.get("shortName"),
-                    "regularMarketPrice": _safe_val(q.get("regularMarketPrice")),
-                    "regularMarketChangePercent": _safe_val(q.get("regularMarketChangePercent")),
-                    "regularMarketVolume": _safe_val(q.get("regularMarketVolume")),
-                    "marketCap": _safe_val(q.get("marketCap")),
-                    "trailingPE": _safe_val(q.get("trailingPE")),
-                })
-            return json.dumps({"query_type": params.query_type, "count": len(simplified), "quotes": simplified}, ensure_ascii=False, indent=2)
+        fields = params.fields or _SCREENER_FIELDS
+        unknown = [f for f in fields if not any(f in q for q in quotes)]
+        if params.fields and unknown:
+            available = sorted({k for q in quotes for k in q})
+            return f"Error: 未知の項目: {', '.join(unknown)}（この結果で指定可能: {', '.join(available)}）"
+        if params.response_format != ResponseFormat.MARKDOWN:
+            simplified = [{f: _safe_val(q.get(f)) for f in fields} for q in quotes]
+            return _dumps({"query_type": params.query_type, "count": len(simplified), "cached": cached, "quotes": simplified}, params.response_format)
+        if params.fields:
+            return "\n".join(_format_fields_md(f"スクリーニング結果: {params.query_type} ({len(quotes)} 銘柄)", quotes, fields) + _cache_note(cached))
 
         lines = [
             f"# スクリーニング結果: {params.query_type} ({len(quotes)} 銘柄)",
@@ -696,6 +4241,55 @@ async def yfinance_screen_stocks(params: ScreenerInput) -> str:
             mcap_s = f"{mcap/1e9:.1f}B" if mcap and mcap >= 1e9 else (f"{mcap/1e6:.1f}M" if mcap else "N/A")
             pe_s = f"{pe:.1f}" if pe is not None else "N/A"
             lines.append(f"| {sym} | {name} | {price_s} | {chg_s} | {mcap_s} | {pe_s} |")
+        return "\n".join(lines + _cache_note(cached))
+    except Exception as e:
+        return f"Error: スクリーニングに失敗しました: {type(e).__name__}: {e}"
+
+
+@mcp.tool(
+    name="yfinance_screen_universe",
+)
+@_instrumented
+async def yfinance_screen_universe(params: UniverseScreenInput) -> str:
+    """
+    設定したユニバース（YFINANCE_MCP_UNIVERSE）のスナップショットを任意の式でスクリーニングする。
+
+    スナップショットはバックグラウンドで定期更新される列指向データ（株価・時価総額・PER・PBR・
+    配当利回り・ROE・セクターなど）で、絞り込みと並べ替えはサーバー内のベクトル演算で行うため
+    上流へのリクエストは発生しない。使える列は yfinance://universe リソースで確認できる。
+
+    Args:
+        params (UniverseScreenInput):
+            - filter (str): 絞り込み式（例: "pe < 15 and roe > 0.15 and sector == 'Technology'"）
+            - sort (str): 並べ替えの列または式（デフォルト 'market_cap'）
+            - descending (bool): 降順か（デフォルト True）
+            - limit (int): 返す銘柄数（デフォルト 25）
+            - columns (List[str]): 返す列
+            - response_format (str): 'markdown'、'json'、'compact'
+
+    Returns:
+        str: 条件に合う銘柄一覧（Markdown or JSON）
+    """
+    try:
+        if not UNIVERSE:
+            return "Error: ユニバースが設定されていません。YFINANCE_MCP_UNIVERSE または YFINANCE_MCP_UNIVERSE_FILE を設定してください。"
+        snapshot = _SNAPSHOT or await _refresh_universe(fundamentals=False)
+        try:
+            rows, matched, fields = _screen_snapshot(snapshot, params)
+        except (SyntaxError, ValueError, TypeError) as e:
+            return f"Error: 式を評価できません: {type(e).__name__}: {e}"
+
+        age = int(time.time() - snapshot.built_at)
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps({
+                "universe": len(snapshot), "matched": matched, "as_of": snapshot.built_at, "age_sec": age,
+                "fundamentals_pending": snapshot.pending, "results": rows,
+            }, params.response_format)
+
+        lines = _format_fields_md(f"ユニバーススクリーニング: {matched}/{len(snapshot)} 銘柄が一致（上位 {len(rows)} 件）", rows, fields)
+        lines += ["", f"_スナップショット: {age} 秒前に更新_"]
+        if snapshot.pending:
+            lines.append(f"_ROE・セクターなど未取得の銘柄: {snapshot.pending}（バックグラウンドで取得中）_")
         return "\n".join(lines)
     except Exception as e:
         return f"Error: スクリーニングに失敗しました: {type(e).__name__}: {e}"
@@ -704,66 +4298,281 @@ async def yfinance_screen_stocks(params: ScreenerInput) -> str:
 @mcp.tool(
     name="yfinance_compare_tickers",
 )
+@_instrumented
 async def yfinance_compare_tickers(params: MultiTickerInput) -> str:
     """
     複数のティッカーを並べてバリュエーション指標を比較する。
 
     最大20銘柄のPER, PBR, 配当利回り, 時価総額, ROE などを一覧表示する。
 
+    use_batch=True では info キャッシュに無い銘柄を一括クォートでまとめて取得するため、
+    銘柄数が多くても上流リクエストは数回で済む（ROE・セクターなど一部指標は N/A になる）。
+    銘柄ごとの取得には期限（timeout_per_ticker）があり、遅い銘柄には 2 本目の
+    リクエストを並行して出す（hedge）。全体の期限（total_timeout）を過ぎた場合は
+    取得できた銘柄だけで表を返し、各銘柄の status（ok / timeout / error）と
+    所要時間 elapsed_ms を付ける。
+
     Args:
         params (MultiTickerInput):
             - tickers (List[str]): ティッカーシンボルのリスト（例: ['AAPL','MSFT','GOOG']）
-            - response_format (str): 'markdown' または 'json'
+            - use_batch (bool): 一括クォート取得を使うか
+            - timeout_per_ticker (float): 1銘柄あたりの期限（秒）
+            - total_timeout (float): 全体の期限（秒）
+            - hedge (bool): 遅い銘柄にヘッジリクエストを出すか
+            - fields (List[str]): 返す項目名（省略時は全項目。ticker/status は常に含む）
+            - response_format (str): 'markdown'、'json'、'compact'
 
     Returns:
         str: 銘柄比較表（Markdown or JSON）
     """
     try:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + params.total_timeout
         tickers = [t.upper() for t in params.tickers]
+        unique = list(dict.fromkeys(tickers))
+
+        def elapsed_ms() -> int:
+            return int((loop.time() - started) * 1000)
 
         async def fetch_one(sym: str) -> dict:
-            info = await asyncio.to_thread(lambda: yf.Ticker(sym).info)
-            return {"ticker": sym, **_info_to_valuation(info)}
+            try:
+                info, cached = await asyncio.wait_for(_get_info_hedged(sym, params.hedge), timeout=params.timeout_per_ticker)
+            except asyncio.TimeoutError:
+                return {"ticker": sym, "status": "timeout", "error": f"銘柄ごとの期限 {params.timeout_per_ticker:g}s 超過", "elapsed_ms": elapsed_ms()}
+            except Exception as e:
+                return {"ticker": sym, "status": "error", "error": f"{type(e).__name__}: {e}", "elapsed_ms": elapsed_ms()}
+            return {"ticker": sym, **_info_to_valuation(info, params.fields), "cached": cached, "source": "info", "status": "ok", "elapsed_ms": elapsed_ms()}
 
-        results = await asyncio.gather(*[fetch_one(sym) for sym in tickers], return_exceptions=True)
+        rows: dict = {}
+        if params.use_batch:
+            # info キャッシュにある銘柄はそれを使い、残りは一括クォートで取得
+            pending = []
+            infos = await _cache_get_many(_INFO_CACHE, unique)
+            for sym in unique:
+                if sym in infos:
+                    info = infos[sym][0]
+                    rows[sym] = {"ticker": sym, **_info_to_valuation(info, params.fields), "cached": True, "source": "info", "status": "ok", "elapsed_ms": 0}
+                else:
+                    pending.append(sym)
+            if pending:
+                try:
+                    quotes, quote_cached = await asyncio.wait_for(
+                        _batch_quotes(pending), timeout=min(params.timeout_per_ticker, max(deadline - loop.time(), 0))
+                    )
+                except Exception:
+                    quotes, quote_cached = {}, set()  # 一括取得が失敗・期限切れの場合は銘柄ごとの info 取得に切り替える
+                for sym in pending:
+                    if sym in quotes:
+                        rows[sym] = {
+                            "ticker": sym, **_quote_to_valuation(quotes[sym], params.fields), "cached": sym in quote_cached,
+                            "source": "quote", "status": "ok", "elapsed_ms": elapsed_ms(),
+                        }
 
-        data = []
-        for r in results:
-            if isinstance(r, Exception):
-                data.append({"ticker": "ERROR", "error": str(r)})
+        remaining = [sym for sym in unique if sym not in rows]
+        tasks = {sym: asyncio.ensure_future(fetch_one(sym)) for sym in remaining}
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=max(deadline - loop.time(), 0))
+        for sym, task in tasks.items():
+            if task.done():
+                rows[sym] = task.result()
             else:
-                data.append(r)
+                task.cancel()
+                rows[sym] = {"ticker": sym, "status": "timeout", "error": f"全体の期限 {params.total_timeout:g}s 超過", "elapsed_ms": elapsed_ms()}
 
-        if params.response_format == ResponseFormat.JSON:
-            return json.dumps(data, ensure_ascii=False, indent=2)
+        data = [rows[sym] for sym in tickers]
 
-        lines = [
-            "# 銘柄比較",
-            "",
-            "| ティッカー | 社名 | 現在値 | PER | PBR | 配当利回り | 時価総額 | ROE |",
-            "| --- | --- | ---: | ---: | ---: | ---: | ---: | ---: |",
-        ]
-        for d in data:
-            sym = d.get("ticker", "")
-            name = (d.get("shortName") or "")[:20]
-            price = d.get("currentPrice")
-            pe = d.get("trailingPE")
-            pb = d.get("priceToBook")
-            dy = d.get("dividendYield")
-            mcap = d.get("marketCap")
-            roe = d.get("returnOnEquity")
-            price_s = f"{price:.2f}" if price is not None else "N/A"
-            pe_s = f"{pe:.1f}" if pe is not None else "N/A"
-            pb_s = f"{pb:.2f}" if pb is not None else "N/A"
-            dy_s = f"{dy:.2%}" if dy is not None else "N/A"
-            mcap_s = f"{mcap/1e9:.1f}B" if mcap and mcap >= 1e9 else (f"{mcap/1e6:.1f}M" if mcap else "N/A")
-            roe_s = f"{roe:.2%}" if roe is not None else "N/A"
-            lines.append(f"| {sym} | {name} | {price_s} | {pe_s} | {pb_s} | {dy_s} | {mcap_s} | {roe_s} |")
+        if params.response_format != ResponseFormat.MARKDOWN:
+            return _dumps(data, params.response_format)
+
+        if params.fields:
+            lines = _format_fields_md("銘柄比較", data, ["ticker"] + params.fields + ["status"])
+        else:
+            lines = _format_compare_md(data)
+        n_cached = sum(1 for d in data if d.get("cached"))
+        if n_cached:
+            lines += ["", f"_（{n_cached}/{len(data)} 銘柄はキャッシュ済みデータ）_"]
+        if any(d.get("source") == "quote" for d in data) and (not params.fields or "returnOnEquity" in params.fields):
+            lines += ["", "_一括クォート取得の銘柄は ROE・配当利回りを含まないため N/A と表示されます（use_batch=False で個別取得）_"]
+        failed = [d for d in dict((d["ticker"], d) for d in data).values() if d.get("status") != "ok"]
+        if failed:
+            lines += ["", f"## 取得できなかった銘柄 ({len(failed)}/{len(unique)})"]
+            lines += [f"- **{d['ticker']}**: {d.get('error')}（{d.get('elapsed_ms')} ms）" for d in failed]
         return "\n".join(lines)
     except Exception as e:
         return f"Error: データ取得に失敗しました: {type(e).__name__}: {e}"
 
 
+# ---------------------------------------------------------------------------
+# Resources
+# ---------------------------------------------------------------------------
+
+@mcp.resource("yfinance://upstream")
+def upstream_status() -> str:
+    """上流呼び出しの待機数・実行数・レート制限の状態（JSON）。"""
+    return json.dumps({**_UPSTREAM.stats(), "inflight_keys": len(_INFLIGHT)}, ensure_ascii=False, indent=2)
+
+
+@mcp.resource("yfinance://universe")
+def universe_status() -> str:
+    """ユニバーススナップショットの銘柄数・更新時刻・使える列とバックグラウンドジョブの状態（JSON）。"""
+    snapshot = _SNAPSHOT
+    return json.dumps({
+        "symbols": len(UNIVERSE),
+        "snapshot_rows": len(snapshot) if snapshot else 0,
+        "built_at": snapshot.built_at if snapshot else None,
+        "fundamentals_pending": snapshot.pending if snapshot else None,
+        "columns": {name: ("number" if numeric else "text") for name, (_, _, numeric) in _UNIVERSE_COLUMNS.items()},
+        "functions": list(_EXPR_FUNCS),
+        "jobs": _JOB_STATUS,
+    }, ensure_ascii=False, indent=2)
+
+
+@mcp.resource("yfinance://watchlist")
+def watchlist_status() -> str:
+    """ウォッチリストの銘柄・種別ごとの更新間隔と鮮度・直近の失敗（JSON）。"""
+    now = time.time()
+    kinds = {}
+    for kind, (interval, _, _) in _WATCH_KINDS.items():
+        ages = [now - _WATCH_REFRESHED[(kind, sym)] for sym in WATCHLIST if (kind, sym) in _WATCH_REFRESHED]
+        kinds[kind] = {
+            "interval_sec": interval if interval > 0 else None,
+            "warmed": len(ages),
+            "oldest_age_sec": round(max(ages), 1) if ages else None,
+            "failed": {sym: error for (k, sym), error in _WATCH_FAILED.items() if k == kind},
+        }
+    return json.dumps({
+        "symbols": WATCHLIST,
+        "history": [f"{period}:{interval}" for period, interval in WATCH_HISTORY],
+        "rate_per_sec": WATCH_RATE,
+        "jitter": WATCH_JITTER,
+        "queued": len(_WATCH_QUEUE),
+        "kinds": kinds,
+        "job": _JOB_STATUS.get("watchlist"),
+    }, ensure_ascii=False, indent=2)
+
+
+@mcp.resource("yfinance://metrics")
+def metrics() -> str:
+    """ツールごとの所要時間（上流待ち・変換・整形の内訳）、上流呼び出し数とエラー・待ち時間、キャッシュのヒット率（JSON）。"""
+    return json.dumps(_metrics_snapshot(), ensure_ascii=False, indent=2)
+
+
+@mcp.resource("yfinance://short-keys")
+def short_keys() -> str:
+    """response_format='compact' で使う短縮キーの対応表（JSON、元の名前 → 短縮キー）。"""
+    return json.dumps(_SHORT_KEYS, ensure_ascii=False, indent=2)
+
+
+# ---------------------------------------------------------------------------
+# Transports
+# ---------------------------------------------------------------------------
+
+_LOCAL_HOSTS = {"127.0.0.1", "localhost", "::1"}
+_WILDCARD_HOSTS = {"0.0.0.0", "::", ""}
+
+
+def _close_resources() -> None:
+    """プロセス終了前の後始末（共有キャッシュへの書き込みを流しきり、スレッド・プロセスプールを閉じる）。"""
+    global _METRICS_SERVER, _RISK_POOL
+    if _SHARED is not None:
+        _SHARED.close()
+    _UPSTREAM.close()
+    if _ARCHIVE is not None:
+        _ARCHIVE.close()
+    if _RISK_POOL is not None:
+        _RISK_POOL.shutdown(wait=False, cancel_futures=True)
+        _RISK_POOL = None
+    if _METRICS_SERVER is not None:
+        _METRICS_SERVER.shutdown()
+        _METRICS_SERVER = None
+
+
+def _http_app(transport: str):
+    """HTTP トランスポートの ASGI アプリ。
+
+    FastMCP のアプリの lifespan を包み、バックグラウンドジョブ・重いモジュールの先読みをセッションの
+    有無にかかわらずサーバーの起動中ずっと動かす（セッションごとの _lifespan は参照数を増減するだけ）。
+    """
+    app = mcp.streamable_http_app() if transport == "streamable-http" else mcp.sse_app()
+    inner = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app):
+        _on_startup()
+        try:
+            async with inner(app) as state:
+                yield state
+        finally:
+            await _stop_background_jobs()
+            _close_resources()
+
+    app.router.lifespan_context = lifespan
+    return app
+
+
+def _serve_http(transport: str, host: str, port: int) -> None:
+    """1 プロセスで複数の MCP セッションを受ける HTTP サーバーを起動する（SIGINT/SIGTERM で穏やかに停止）。
+
+    停止時は新しい接続の受け付けをやめ、実行中の応答を SHUTDOWN_TIMEOUT 秒まで待ってから
+    ジョブを止めて共有資源を片付ける。
+    """
+    import uvicorn  # HTTP トランスポートのときだけ読み込む
+    from mcp.server.transport_security import TransportSecuritySettings
+
+    mcp.settings.host, mcp.settings.port = host, port
+    if ALLOWED_HOSTS == ["*"]:
+        # 明示的に検査を外す（Host を検査するリバースプロキシの内側で使う場合など）
+        mcp.settings.transport_security = None
+        print(f"warning: Host / Origin checks are disabled (YFINANCE_MCP_ALLOWED_HOSTS=*) on {host}:{port}", file=sys.stderr)
+    elif ALLOWED_HOSTS:
+        mcp.settings.transport_security = TransportSecuritySettings(
+            enable_dns_rebinding_protection=True,
+            allowed_hosts=ALLOWED_HOSTS,
+            allowed_origins=[f"{scheme}://{h}" for h in ALLOWED_HOSTS for scheme in ("http", "https")],
+        )
+    elif host in _WILDCARD_HOSTS:
+        # すべてのインターフェースで待ち受けるなら、受け付ける名前を明示させる
+        raise SystemExit(
+            f"--host {host or '(all)'} listens on every interface; set YFINANCE_MCP_ALLOWED_HOSTS to the names clients use"
+            " (e.g. mcp.example.com,10.0.0.5:*), or to * to disable Host / Origin checks"
+        )
+    elif host not in _LOCAL_HOSTS:
+        # FastMCP の既定（localhost のみ許可）のままではこのアドレス宛ての Host が弾かれるので検査を外す
+        mcp.settings.transport_security = None
+        print(
+            f"warning: listening on {host}:{port} without YFINANCE_MCP_ALLOWED_HOSTS; DNS rebinding"
+            " (Host / Origin) protection is disabled",
+            file=sys.stderr,
+        )
+    config = uvicorn.Config(
+        _http_app(transport), host=host, port=port,
+        timeout_graceful_shutdown=SHUTDOWN_TIMEOUT if SHUTDOWN_TIMEOUT > 0 else None,
+        log_level=mcp.settings.log_level.lower(),
+    )
+    uvicorn.Server(config).run()
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="yfinance MCP Server")
+    parser.add_argument("--transport", choices=["stdio", "streamable-http", "sse"],
+                        default=os.environ.get("YFINANCE_MCP_TRANSPORT", "stdio"),
+                        help="stdio（既定、クライアントごとに 1 プロセス）または HTTP（1 プロセスで複数セッション）")
+    parser.add_argument("--host", default=os.environ.get("YFINANCE_MCP_HOST", "127.0.0.1"), help="HTTP の待ち受けアドレス")
+    parser.add_argument("--port", type=int, default=_env_int("YFINANCE_MCP_PORT", 8000), help="HTTP の待ち受けポート")
+    args = parser.parse_args()
+
+    if args.transport == "stdio":
+        try:
+            mcp.run()
+        finally:
+            _close_resources()
+    else:
+        _serve_http(args.transport, args.host, args.port)
+
+
 if __name__ == "__main__":
-    mcp.run()
+    main()
 
@@ -0,0 +1,1226 @@
+"""
+server.py の純粋関数（上流にアクセスしない部分）のテスト
+
+    python -m pytest -q
+"""
+
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from statistics import NormalDist
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import server
+
+
+def call_tool_text(name: str, params: dict) -> str:
+    content, _ = asyncio.run(server.mcp.call_tool(name, {"params": params}))
+    return content[0].text
+
+
+def call_tool(name: str, params: dict) -> dict:
+    return json.loads(call_tool_text(name, {**params, "response_format": "json"}))
+
+
+# ---------------------------------------------------------------------------
+# インメモリキャッシュ（stale-while-revalidate）
+# ---------------------------------------------------------------------------
+
+class FakeClock:
+    """server.time の代わり。monotonic だけを手で進め、それ以外は本物の time に任せる。"""
+
+    def __init__(self):
+        import time
+
+        self._time = time
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(self._time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server, "time", fake)
+    monkeypatch.setattr(server, "_REFRESHING", {})
+    return fake
+
+
+class CountingFetch:
+    def __init__(self, *values):
+        self.values = list(values)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        value = self.values[min(self.calls, len(self.values)) - 1]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def test_ttl_cache_fresh_stale_expired(clock):
+    cache = server._TTLCache(4, ttl=10.0, stale=20.0)
+    cache.set("k", 1)
+    clock.now += 9.9
+    assert cache.get("k") == (1, "fresh")
+    clock.now += 0.2
+    assert cache.get("k") == (1, "stale")
+    clock.now += 20.0
+    assert cache.get("k") == (None, None)
+    assert len(cache) == 0
+    assert (cache.hits, cache.stale_hits, cache.misses) == (1, 1, 1)
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = server._TTLCache(2, ttl=10.0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # a を最近使った側に移す
+    cache.set("c", 3)
+    assert cache.get("b") == (None, None)
+    assert cache.get("a") == (1, "fresh") and cache.get("c") == (3, "fresh")
+
+
+def test_cached_serves_stale_while_refreshing(clock):
+    cache = server._TTLCache(4, ttl=10.0, stale=20.0)
+    fetch = CountingFetch({"v": 1}, {"v": 2})
+
+    async def scenario():
+        assert await server._cached(cache, "k", fetch) == ({"v": 1}, False)
+        assert await server._cached(cache, "k", fetch) == ({"v": 1}, True)
+        assert fetch.calls == 1
+        clock.now += 15.0
+        first = await server._cached(cache, "k", fetch)
+        second = await server._cached(cache, "k", fetch)  # 再取得中の 2 回目は新たに取りに行かない
+        assert first == second == ({"v": 1}, True)
+        await asyncio.gather(*server._REFRESHING.values())
+        assert fetch.calls == 2 and not server._REFRESHING
+        assert await server._cached(cache, "k", fetch) == ({"v": 2}, True)
+
+    asyncio.run(scenario())
+
+
+def test_cached_keeps_stale_value_when_refresh_fails(clock):
+    cache = server._TTLCache(4, ttl=10.0, stale=20.0)
+    fetch = CountingFetch({"v": 1}, RuntimeError("upstream down"), {"v": 3})
+
+    async def scenario():
+        await server._cached(cache, "k", fetch)
+        clock.now += 15.0
+        assert await server._cached(cache, "k", fetch) == ({"v": 1}, True)
+        await asyncio.gather(*server._REFRESHING.values())
+        assert await server._cached(cache, "k", fetch) == ({"v": 1}, True)  # 失敗した再取得は次回に持ち越す
+        await asyncio.gather(*server._REFRESHING.values())
+        assert fetch.calls == 3
+        assert cache.get("k") == ({"v": 3}, "fresh")
+
+    asyncio.run(scenario())
+
+
+def test_cached_does_not_store_rejected_values(clock):
+    cache = server._TTLCache(4, ttl=10.0, stale=20.0)
+    fetch = CountingFetch({}, {}, {"v": 1})
+
+    async def scenario():
+        assert await server._cached(cache, "k", fetch) == ({}, False)
+        assert await server._cached(cache, "k", fetch) == ({}, False)
+        assert len(cache) == 0
+        assert await server._cached(cache, "k", fetch, cacheable=lambda v: "v" in v) == ({"v": 1}, False)
+        assert await server._cached(cache, "k", fetch) == ({"v": 1}, True)
+        assert fetch.calls == 3
+
+    asyncio.run(scenario())
+
+
+# ---------------------------------------------------------------------------
+# 上流取得の single-flight
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def gate(monkeypatch):
+    """レート制限なしの新しい上流ゲートと、空の実行中テーブル・呼び出し統計。"""
+    fresh = server._UpstreamGate(workers=4, rate=0.0, burst=10, per_host=4)
+    monkeypatch.setattr(server, "_UPSTREAM", fresh)
+    monkeypatch.setattr(server, "_INFLIGHT", {})
+    monkeypatch.setattr(server, "_UPSTREAM_CALLS", {})
+    monkeypatch.setattr(server, "_UPSTREAM_ERRORS", {})
+    yield fresh
+    fresh.close()
+
+
+class BlockingFetch:
+    """release() されるまでワーカースレッドで止まる上流取得。"""
+
+    def __init__(self, result=None, error: Optional[Exception] = None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self._release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self._release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    async def wait_started(self) -> None:
+        while not self.started.is_set():
+            await asyncio.sleep(0.001)
+
+    def release(self) -> None:
+        self._release.set()
+
+
+def test_single_flight_shares_one_upstream_call(gate):
+    fetch = BlockingFetch({"p": 1})
+
+    async def scenario():
+        tasks = [asyncio.ensure_future(server._fetch_upstream(fetch, "info", "AAA")) for _ in range(10)]
+        await fetch.wait_started()
+        await asyncio.sleep(0)
+        fetch.release()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(scenario()) == [{"p": 1}] * 10
+    assert fetch.calls == 1
+    assert server._UPSTREAM_CALLS["info"] == {"calls": 1, "errors": 0, "joined": 9}
+    assert not server._INFLIGHT
+
+
+def test_single_flight_failure_reaches_every_waiter_and_is_not_kept(gate):
+    fetch = BlockingFetch(error=RuntimeError("boom"))
+
+    async def scenario():
+        tasks = [asyncio.ensure_future(server._fetch_upstream(fetch, "info", "AAA")) for _ in range(5)]
+        await fetch.wait_started()
+        fetch.release()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) and str(r) == "boom" for r in results)
+        assert not server._INFLIGHT
+        retry = BlockingFetch({"p": 2})
+        retry.release()
+        assert await server._fetch_upstream(retry, "info", "AAA") == {"p": 2}  # 失敗した結果を使い回さない
+        assert retry.calls == 1
+
+    asyncio.run(scenario())
+    assert fetch.calls == 1
+
+
+def test_single_flight_survives_a_cancelled_waiter(gate):
+    fetch = BlockingFetch({"p": 1})
+
+    async def scenario():
+        tasks = [asyncio.ensure_future(server._fetch_upstream(fetch, "info", "AAA")) for _ in range(3)]
+        await fetch.wait_started()
+        tasks[0].cancel()
+        await asyncio.sleep(0)
+        assert tasks[0].cancelled()
+        fetch.release()
+        return await asyncio.gather(*tasks[1:])
+
+    assert asyncio.run(scenario()) == [{"p": 1}] * 2
+    assert fetch.calls == 1
+
+
+# ---------------------------------------------------------------------------
+# 一括クォート・一括ヒストリー
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def fake_yahoo(monkeypatch, gate):
+    """bench_tools の FakeYahoo を yfinance の入口に差し込み、プロセス内キャッシュを空にする。"""
+    import bench_tools
+
+    server._load_heavy_modules()
+    fake = bench_tools.FakeYahoo(rows=260, statement_items=5, news_items=5, latency=0.0, jitter=0.0)
+    bench_tools.install(fake, patch=monkeypatch.setattr)
+    for name in ("_INFO_CACHE", "_QUOTE_CACHE", "_BATCH_HISTORY_CACHE"):
+        cache = getattr(server, name)
+        monkeypatch.setattr(server, name, server._TTLCache(cache.maxsize, cache.ttl, cache.stale))
+    return fake
+
+
+def test_batch_quotes_split_into_chunks(fake_yahoo, monkeypatch):
+    monkeypatch.setattr(server, "BATCH_CHUNK_SIZE", 2)
+    symbols = ["AAA", "BBB", "CCC", "DDD", "EEE", "AAA"]
+    quotes, cached = asyncio.run(server._batch_quotes(symbols))
+    assert sorted(quotes) == ["AAA", "BBB", "CCC", "DDD", "EEE"] and not cached
+    assert fake_yahoo.calls == 3
+    quotes, cached = asyncio.run(server._batch_quotes(["AAA", "FFF"]))
+    assert cached == {"AAA"} and sorted(quotes) == ["AAA", "FFF"]
+    assert fake_yahoo.calls == 4
+
+
+def test_compare_batch_isolates_failing_symbols(fake_yahoo, monkeypatch):
+    download_quotes = server._download_quotes
+    info = fake_yahoo.info
+
+    def without_bad(symbols):
+        return download_quotes([s for s in symbols if s != "BAD"])  # 上場廃止などで応答に含まれない銘柄
+
+    def failing_info(symbol):
+        if symbol == "BAD":
+            raise KeyError("regularMarketPrice")
+        return info(symbol)
+
+    monkeypatch.setattr(server, "_download_quotes", without_bad)
+    monkeypatch.setattr(fake_yahoo, "info", failing_info)
+    rows = call_tool("yfinance_compare_tickers", {"tickers": ["AAA", "BAD", "CCC"], "use_batch": True, "hedge": False})
+    assert [r["ticker"] for r in rows] == ["AAA", "BAD", "CCC"]
+    assert [r["status"] for r in rows] == ["ok", "error", "ok"]
+    assert rows[0]["source"] == rows[2]["source"] == "quote"
+    assert "KeyError" in rows[1]["error"]
+
+
+def test_compare_batch_falls_back_to_info_when_quotes_fail(fake_yahoo, monkeypatch):
+    def down(symbols):
+        raise RuntimeError("quote endpoint down")
+
+    monkeypatch.setattr(server, "_download_quotes", down)
+    rows = call_tool("yfinance_compare_tickers", {"tickers": ["AAA", "BBB"], "use_batch": True, "hedge": False})
+    assert [(r["status"], r["source"]) for r in rows] == [("ok", "info"), ("ok", "info")]
+
+
+def test_quote_to_valuation_keeps_yields_apart():
+    quote = {
+        "symbol": "AAA", "regularMarketPrice": 10.0, "trailingAnnualDividendRate": 0.4,
+        "trailingAnnualDividendYield": 0.04, "dividendYield": 4.1,  # quote の dividendYield はパーセント表記
+    }
+    out = server._quote_to_valuation(quote)
+    assert out["currentPrice"] == 10.0 and out["dividendRate"] == 0.4
+    assert out["dividendYield"] is None
+    assert out["trailingAnnualDividendYield"] == 0.04
+    assert server._quote_to_valuation(quote, ["currentPrice", "dividendYield"]) == {"currentPrice": 10.0, "dividendYield": None}
+
+
+def test_field_matrix_orders_columns_and_handles_single_symbol():
+    index = pd.date_range("2024-01-01", periods=3)
+    wide = pd.concat({"Close": pd.DataFrame({"BBB": [1.0, 2.0, 3.0], "AAA": [4.0, 5.0, 6.0]}, index=index)}, axis=1)
+    assert server._field_matrix(wide, "Close", ["AAA", "BBB", "CCC"]).columns.tolist() == ["AAA", "BBB", "CCC"]
+    flat = pd.DataFrame({"Close": [1.0, 2.0, 3.0], "Volume": [10.0, 20.0, 30.0]}, index=index)  # 単一銘柄で列が潰れた形
+    closes = server._field_matrix(flat, "Close", ["AAA"])
+    assert closes.columns.tolist() == ["AAA"] and closes["AAA"].tolist() == [1.0, 2.0, 3.0]
+    assert server._field_matrix(flat, "Dividends", ["AAA"]) is None
+    assert server._field_matrix(pd.DataFrame(), "Close", ["AAA"]) is None
+
+
+def test_price_history_batch_aligns_symbols(fake_yahoo):
+    out = call_tool("yfinance_get_price_history_batch", {"tickers": ["aaa", "BBB", "AAA"], "period": "1y"})
+    assert out["tickers"] == ["AAA", "BBB"]
+    assert len(out["close"]) == len(out["dates"]) == 260
+    assert all(len(row) == 2 for row in out["close"] + out["volume"])
+    assert fake_yahoo.calls == 1
+    assert call_tool("yfinance_get_price_history_batch", {"tickers": ["BBB", "AAA"], "period": "1y"})["cached"]
+    assert fake_yahoo.calls == 1
+
+
+# ---------------------------------------------------------------------------
+# ローカルストアの追記
+# ---------------------------------------------------------------------------
+
+def make_bars(n: int, start: str = "2024-01-01", freq: str = "D") -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    close = 100 + np.cumsum(rng.normal(0, 1, n))
+    index = pd.date_range(start, periods=n, freq=freq, tz="America/New_York")
+    return pd.DataFrame({
+        "Open": close + 0.1, "High": close + 1, "Low": close - 1, "Close": close,
+        "Volume": rng.integers(1, 100, n).astype(float), "Dividends": np.zeros(n), "Stock Splits": np.zeros(n),
+    }, index=index)
+
+
+def test_merge_bars_tail_replaces_overlap():
+    stored = make_bars(10)
+    tail = make_bars(4, start=str(stored.index[8].date())) + 1000
+    tail["Dividends"] = np.nan
+    merged = server._merge_bars(stored, tail)
+    assert len(merged) == 12
+    assert merged.index.is_monotonic_increasing
+    assert merged["Close"].iloc[8] == tail["Close"].iloc[0]
+    assert merged["Close"].iloc[7] == stored["Close"].iloc[7]
+    assert merged["Dividends"].isna().sum() == 0
+    assert server._merge_bars(stored, tail.iloc[:0]) is stored
+
+
+def test_has_new_actions():
+    stored = make_bars(10)
+    tail = make_bars(3, start=str(stored.index[9].date()))
+    assert not server._has_new_actions(stored, tail)
+    stored.loc[stored.index[9], "Dividends"] = 0.5
+    tail.loc[tail.index[0], "Dividends"] = 0.5
+    assert not server._has_new_actions(stored, tail)  # 保存済みの配当は新しいイベントではない
+    tail.loc[tail.index[2], "Dividends"] = 0.5
+    assert server._has_new_actions(stored, tail)
+
+
+# ---------------------------------------------------------------------------
+# 上流ゲート（トークンバケット・ホスト別セマフォ）
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def gate_clock(clock, monkeypatch):
+    """FakeClock に加え、asyncio.sleep を待たずに時計だけ進めるものに差し替える。"""
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, result=None):
+        clock.now += delay
+        return await real_sleep(0, result)
+
+    monkeypatch.setattr(server.asyncio, "sleep", sleep)
+    return clock
+
+
+def test_gate_bulk_cost_does_not_overdraw_bucket(gate_clock):
+    gate = server._UpstreamGate(workers=2, rate=5.0, burst=10, per_host=4)
+
+    async def scenario():
+        await gate.run(lambda: "bulk", cost=200)
+        assert gate._tokens == 0
+        start = gate_clock.now
+        assert await gate.run(lambda: "info") == "info"
+        return gate_clock.now - start
+
+    assert asyncio.run(scenario()) == pytest.approx(0.2)  # 1 トークン分だけ待つ（前借りの返済を待たない）
+    gate.close()
+
+
+def test_batch_history_is_charged_per_chunk_and_lets_info_through(fake_yahoo, gate_clock, monkeypatch):
+    gate = server._UpstreamGate(workers=4, rate=5.0, burst=10, per_host=4)
+    monkeypatch.setattr(server, "_UPSTREAM", gate)
+    fake_yahoo.latency = 0.05
+    order = []
+    download = server.yf.download
+
+    def recording_download(symbols, **kwargs):
+        order.append(("download", len(symbols)))
+        return download(symbols, **kwargs)
+
+    monkeypatch.setattr(server.yf, "download", recording_download)
+    symbols = [f"S{i:02d}" for i in range(25)]
+
+    async def scenario():
+        batch = asyncio.ensure_future(server._batch_history(symbols, "1y", "1d"))
+        await asyncio.sleep(0)
+        await server._fetch_upstream(lambda: order.append(("info", 1)), "info", "ZZZ")
+        return await batch
+
+    df, cached = asyncio.run(scenario())
+    gate.close()
+    assert not cached
+    assert server._field_matrix(df, "Close", symbols).notna().all().all()
+    assert sorted(n for kind, n in order if kind == "download") == [5, 10, 10]
+    assert order.index(("info", 1)) < len(order) - 1  # 一括取得の途中で割り込める
+
+
+def test_gate_rebinds_to_each_event_loop():
+    gate = server._UpstreamGate(workers=2, rate=1000.0, burst=1, per_host=1)
+
+    async def contend():
+        return await asyncio.gather(*(gate.run(lambda i=i: i) for i in range(4)))
+
+    for _ in range(2):  # asyncio.run ごとに別のループ（ロック・セマフォの待ちが必ず起きる）
+        assert asyncio.run(contend()) == [0, 1, 2, 3]
+    gate.close()
+
+
+def test_gate_limits_concurrency_per_host():
+    gate = server._UpstreamGate(workers=8, rate=0.0, burst=1, per_host=2)
+    lock = threading.Lock()
+    active = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+
+    def work(host: str) -> None:
+        with lock:
+            active[host] += 1
+            peak[host] = max(peak[host], active[host])
+        time.sleep(0.02)
+        with lock:
+            active[host] -= 1
+
+    async def scenario():
+        await asyncio.gather(*(gate.run(lambda h=h: work(h), host=h) for h in ["a"] * 6 + ["b"] * 2))
+
+    asyncio.run(scenario())
+    gate.close()
+    assert peak == {"a": 2, "b": 2}
+    assert gate.stats()["hosts"]["a"] == {"limit": 2, "active": 0, "waiting": 0}
+    assert gate.completed == 8
+
+
+# ---------------------------------------------------------------------------
+# ヘッジ付きの info 取得
+# ---------------------------------------------------------------------------
+
+class ScriptedTicker:
+    """_ticker の代わり。info を読むたびに script の次の動作をする（"block" は release() まで止まってから動作する）。"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self.released = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, symbol: str):
+        return self
+
+    @property
+    def info(self):
+        with self._lock:
+            step = self.script[min(self.calls, len(self.script) - 1)]
+            self.calls += 1
+        if step[0] == "block":
+            assert self.released.wait(5)
+            step = step[1:]
+        if isinstance(step[0], Exception):
+            raise step[0]
+        return step[0]
+
+
+@pytest.fixture
+def hedged(gate, monkeypatch):
+    """ヘッジの待ち時間を短くし、info キャッシュを空にして、1 本目の取得タスクを記録する。"""
+    monkeypatch.setattr(server, "_INFO_CACHE", server._TTLCache(16, 60.0, 60.0))
+    monkeypatch.setattr(server, "_hedge_delay", lambda kind: 0.05)
+    primaries = []
+    get_info = server._get_info
+
+    async def recording_get_info(ticker):
+        primaries.append(asyncio.current_task())
+        return await get_info(ticker)
+
+    monkeypatch.setattr(server, "_get_info", recording_get_info)
+    tickers = []
+    yield primaries, tickers
+    for ticker in tickers:
+        ticker.released.set()
+
+
+def use_ticker(monkeypatch, hedged, *script) -> ScriptedTicker:
+    ticker = ScriptedTicker(*script)
+    monkeypatch.setattr(server, "_ticker", ticker)
+    hedged[1].append(ticker)
+    return ticker
+
+
+def test_hedge_not_sent_when_primary_is_fast(hedged, monkeypatch):
+    ticker = use_ticker(monkeypatch, hedged, ({"p": 1},))
+    assert asyncio.run(server._get_info_hedged("AAA")) == ({"p": 1}, False)
+    assert ticker.calls == 1
+
+
+def test_hedge_wins_and_cancels_primary(hedged, monkeypatch):
+    ticker = use_ticker(monkeypatch, hedged, ("block", {"p": "primary"}), ({"p": "hedge"},))
+
+    async def scenario():
+        result = await server._get_info_hedged("AAA")
+        await asyncio.sleep(0)
+        return result, hedged[0][0].cancelled()
+
+    assert asyncio.run(scenario()) == (({"p": "hedge"}, False), True)
+    assert ticker.calls == 2
+    assert server._INFO_CACHE.get("AAA") == ({"p": "hedge"}, "fresh")
+
+
+def test_hedge_raises_primary_error_when_both_fail(hedged, monkeypatch):
+    use_ticker(monkeypatch, hedged, ("block", RuntimeError("primary")), (RuntimeError("hedge"),))
+
+    async def scenario():
+        task = asyncio.ensure_future(server._get_info_hedged("AAA"))
+        await asyncio.sleep(0.2)  # ヘッジが先に失敗しても 1 本目を待つ
+        assert not task.done()
+        hedged[1][0].released.set()
+        return await task
+
+    with pytest.raises(RuntimeError, match="primary"):
+        asyncio.run(scenario())
+
+
+def test_hedge_cancels_primary_when_deadline_hits_before_hedge(hedged, monkeypatch):
+    use_ticker(monkeypatch, hedged, ("block", {"p": 1}))
+    monkeypatch.setattr(server, "_hedge_delay", lambda kind: 1.0)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(server._get_info_hedged("AAA"), timeout=0.05)
+        await asyncio.sleep(0)
+        return hedged[0][0].cancelled()
+
+    assert asyncio.run(scenario())
+
+
+def test_compare_reports_slow_ticker_as_timeout(hedged, monkeypatch):
+    server._load_heavy_modules()
+    slow = ScriptedTicker(("block", {"currentPrice": 1.0}))
+    fast = ScriptedTicker(({"currentPrice": 2.0},))
+    hedged[1].append(slow)
+    monkeypatch.setattr(server, "_ticker", lambda symbol: slow if symbol == "SLOW" else fast)
+    rows = call_tool("yfinance_compare_tickers", {"tickers": ["FAST", "SLOW"], "timeout_per_ticker": 0.5, "hedge": False})
+    assert [(r["ticker"], r["status"]) for r in rows] == [("FAST", "ok"), ("SLOW", "timeout")]
+    assert rows[0]["currentPrice"] == 2.0
+    assert rows[1]["elapsed_ms"] >= 500
+
+
+# ---------------------------------------------------------------------------
+# テクニカル指標
+# ---------------------------------------------------------------------------
+
+def ewm_reference(values, alpha, min_periods=1):
+    """adjust=False の指数移動平均を素朴に書いたもの（先頭の NaN は飛ばし、最初の値から始める）。"""
+    out, avg, seen = [], None, 0
+    for v in values:
+        if v is not None and not np.isnan(v):
+            avg = v if avg is None else (1 - alpha) * avg + alpha * v
+            seen += 1
+        out.append(avg if avg is not None and seen >= min_periods else np.nan)
+    return np.array(out)
+
+
+def test_indicators_match_hand_computation():
+    close = np.array([10.0, 11.0, 10.5, 12.0, 11.5, 13.0, 12.5, 14.0])
+    high, low = close + 0.5, close - 0.5
+    high[3], low[3] = 12.2, 11.8  # 前日終値（10.5）からのギャップが値幅を超える足
+    hist = pd.DataFrame({"Close": close, "High": high, "Low": low})
+    params = server.IndicatorInput(
+        ticker="AAA", indicators=["rsi", "macd", "bollinger", "atr"],
+        window=3, rsi_window=3, atr_window=3, macd_fast=2, macd_slow=4, macd_signal=2,
+    )
+    out = {k: v.to_numpy() for k, v in server._compute_indicators(hist, params).items()}
+
+    # ボリンジャー（母標準偏差）: 先頭 3 本は平均 10.5、標準偏差 sqrt(1/6)
+    assert np.isnan(out["bb_middle_3"][:2]).all()
+    assert out["bb_middle_3"][2] == pytest.approx(10.5)
+    assert out["bb_upper_3"][2] == pytest.approx(10.5 + 2 * np.sqrt(1 / 6))
+    assert out["bb_lower_3"][7] == pytest.approx(13.166667 - 2 * np.std(close[5:8]), rel=1e-6)
+
+    # RSI（Wilder の平滑化）: 上昇幅と下落幅をそれぞれ alpha = 1/3 で平滑化する
+    delta = np.r_[np.nan, np.diff(close)]
+    gain = ewm_reference(np.where(np.isnan(delta), np.nan, np.maximum(delta, 0)), 1 / 3, 3)
+    loss = ewm_reference(np.where(np.isnan(delta), np.nan, np.maximum(-delta, 0)), 1 / 3, 3)
+    np.testing.assert_allclose(out["rsi_3"], 100 - 100 / (1 + gain / loss), equal_nan=True)
+    assert np.isnan(out["rsi_3"][:3]).all() and out["rsi_3"][3] == pytest.approx(100 - 100 / (1 + (17 / 18) / (1 / 9)))
+
+    # MACD: EMA(2) - EMA(4)。4 本そろうまでは NaN、シグナルは MACD の EMA(2)
+    macd = ewm_reference(close, 2 / 3) - ewm_reference(close, 2 / 5)
+    macd[:3] = np.nan
+    signal = ewm_reference(macd, 2 / 3, 2)
+    np.testing.assert_allclose(out["macd"], macd, equal_nan=True)
+    np.testing.assert_allclose(out["macd_signal"], signal, equal_nan=True)
+    np.testing.assert_allclose(out["macd_hist"], macd - signal, equal_nan=True)
+
+    # ATR: 真の値幅（前日終値とのギャップ込み）を alpha = 1/3 で平滑化
+    prev = np.r_[np.nan, close[:-1]]
+    tr = np.array([max([h - l] + [abs(x) for x in (h - p, l - p) if not np.isnan(x)]) for h, l, p in zip(high, low, prev)])
+    assert tr[3] == pytest.approx(1.7)
+    np.testing.assert_allclose(out["atr_3"], ewm_reference(tr, 1 / 3, 3), equal_nan=True)
+
+
+@pytest.mark.parametrize("fast, slow", [(50, 20), (26, 26)])
+def test_indicator_input_rejects_inverted_macd(fast, slow):
+    with pytest.raises(ValueError, match="macd_fast"):
+        server.IndicatorInput(ticker="AAA", macd_fast=fast, macd_slow=slow)
+
+
+# ---------------------------------------------------------------------------
+# 縮小共分散
+# ---------------------------------------------------------------------------
+
+def test_ledoit_wolf_matches_reference():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(60, 8)) @ rng.normal(size=(8, 8))
+    centered = x - x.mean(axis=0)
+    cov, intensity = server._ledoit_wolf(centered)
+    assert 0.0 <= intensity <= 1.0
+    assert np.allclose(cov, cov.T)
+    assert np.all(np.linalg.eigvalsh(cov) > 0)
+    sklearn = pytest.importorskip("sklearn.covariance")
+    ref = sklearn.LedoitWolf(assume_centered=True).fit(centered)
+    np.testing.assert_allclose(cov, ref.covariance_, rtol=1e-10)
+    assert intensity == pytest.approx(ref.shrinkage_)
+
+
+def test_ledoit_wolf_identity_scale_needs_no_shrinkage():
+    centered = np.array([[1.0, 0.0], [-1.0, 0.0], [0.0, 1.0], [0.0, -1.0]])
+    cov, intensity = server._ledoit_wolf(centered)
+    np.testing.assert_allclose(cov, np.eye(2) * 0.5)
+    assert intensity == 0.0
+
+
+# ---------------------------------------------------------------------------
+# モンテカルロ VaR
+# ---------------------------------------------------------------------------
+
+def synthetic_log_returns(n: int = 500, seed: int = 3) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    cov = np.array([[1.0, 0.6, 0.2], [0.6, 1.5, 0.3], [0.2, 0.3, 0.8]]) * 1e-4
+    x = rng.multivariate_normal([3e-4, 2e-4, 1e-4], cov, size=n)
+    return pd.DataFrame(x, columns=["AAA", "BBB", "CCC"])
+
+
+def test_monte_carlo_var_is_deterministic_across_process_threshold(monkeypatch, tmp_path):
+    # ワーカーはモジュールを読み込み直す。記録先が壊れた zip でもワーカーは開かない
+    broken = tmp_path / "broken.zip"
+    broken.write_bytes(b"not a zip")
+    monkeypatch.setenv("YFINANCE_MCP_RECORD", str(broken))
+    monkeypatch.setattr(server, "RISK_MC_CHUNK", 5_000)
+    monkeypatch.setattr(server, "RISK_PROCESSES", 2)
+    monkeypatch.setattr(server, "_RISK_POOL", None)
+    log_returns, weights = synthetic_log_returns(), np.array([0.5, 0.3, 0.2])
+
+    def run(threshold: int):
+        monkeypatch.setattr(server, "RISK_PROCESS_THRESHOLD", threshold)
+        return asyncio.run(server._monte_carlo_var(log_returns, weights, 5, 0.99, 20_000, seed=42))
+
+    try:
+        threaded = run(10 ** 9)
+        pooled = run(0)
+    finally:
+        if server._RISK_POOL is not None:
+            server._RISK_POOL.shutdown()
+    assert threaded == pooled
+    assert run(10 ** 9) == threaded
+    assert asyncio.run(server._monte_carlo_var(log_returns, weights, 5, 0.99, 20_000, seed=43)) != threaded
+
+
+def test_monte_carlo_var_agrees_with_parametric():
+    log_returns, weights = synthetic_log_returns(), np.array([0.5, 0.3, 0.2])
+    horizon, confidence = 5, 0.99
+    var, cvar = asyncio.run(server._monte_carlo_var(log_returns, weights, horizon, confidence, 200_000, seed=1))
+
+    port = np.expm1(log_returns.to_numpy()) @ weights
+    mu, sigma = port.mean() * horizon, port.std(ddof=1) * np.sqrt(horizon)
+    z = NormalDist().inv_cdf(1 - confidence)
+    assert var == pytest.approx(-(mu + z * sigma), rel=0.05)
+    assert cvar == pytest.approx(-(mu - sigma * NormalDist().pdf(z) / (1 - confidence)), rel=0.05)
+    assert cvar > var > 0
+
+
+# ---------------------------------------------------------------------------
+# 出力フォーマット（compact・fields・columns・csv）
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def bar_store(tmp_path, monkeypatch):
+    """一時ディレクトリのローカルストア。"""
+    store = server._BarStore(str(tmp_path / "bars"))
+    monkeypatch.setattr(server, "_BAR_STORE", store)
+    monkeypatch.setattr(server, "STORE_ENABLED", True)
+    return store
+
+
+def expand_keys(obj, inverse: dict):
+    if isinstance(obj, dict):
+        return {inverse.get(k, k): expand_keys(v, inverse) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [expand_keys(v, inverse) for v in obj]
+    return obj
+
+
+def drop_volatile(obj):
+    """呼び出しごとに変わるキー（キャッシュ利用・所要時間）を除く。"""
+    if isinstance(obj, dict):
+        return {k: drop_volatile(v) for k, v in obj.items() if k not in ("cached", "elapsed_ms")}
+    if isinstance(obj, list):
+        return [drop_volatile(v) for v in obj]
+    return obj
+
+
+def test_short_keys_are_one_to_one():
+    short = list(server._SHORT_KEYS.values())
+    assert len(set(short)) == len(short)
+    assert not set(short) & set(server._SHORT_KEYS)  # 短縮キーが別の元の名前と紛れない
+    assert json.loads(server.short_keys()) == server._SHORT_KEYS
+
+
+@pytest.mark.parametrize("tool, params", [
+    ("yfinance_get_valuation", {"ticker": "AAA"}),
+    ("yfinance_compare_tickers", {"tickers": ["AAA", "BBB"], "use_batch": True, "hedge": False}),
+    ("yfinance_get_price_history", {"ticker": "AAA", "period": "1mo"}),
+    ("yfinance_screen_stocks", {"query_type": "most_actives", "count": 3}),
+])
+def test_compact_round_trips_to_json(fake_yahoo, bar_store, tool, params):
+    inverse = {v: k for k, v in json.loads(server.short_keys()).items()}
+    call_tool(tool, params)  # 2 回とも同じ経路（キャッシュ・ローカルストア）から応答させる
+    compact = json.loads(call_tool_text(tool, {**params, "response_format": "compact"}))
+    full = call_tool(tool, params)
+    assert drop_volatile(expand_keys(compact, inverse)) == drop_volatile(full)
+
+
+def test_unknown_fields_are_rejected(fake_yahoo):
+    from mcp.server.fastmcp.exceptions import ToolError
+
+    with pytest.raises(ToolError, match="未知の項目: nope"):
+        call_tool("yfinance_get_valuation", {"ticker": "AAA", "fields": ["currentPrice", "nope"]})
+    text = call_tool_text("yfinance_screen_stocks", {"query_type": "most_actives", "fields": ["symbol", "nope"], "response_format": "json"})
+    assert text.startswith("Error: 未知の項目: nope") and "regularMarketPrice" in text
+    out = call_tool("yfinance_get_valuation", {"ticker": "AAA", "fields": ["trailingPE", "currentPrice", "trailingPE"]})
+    assert list(out) == ["trailingPE", "currentPrice", "cached"]
+
+
+def test_csv_matches_columns_format(fake_yahoo, bar_store):
+    params = {"ticker": "AAA", "period": "3mo"}
+    call_tool("yfinance_get_price_history", params)  # ローカルストアに載せてから比べる
+    columns = json.loads(call_tool_text("yfinance_get_price_history", {**params, "response_format": "columns"}))["columns"]
+    lines = call_tool_text("yfinance_get_price_history", {**params, "response_format": "csv"}).splitlines()
+    assert lines[0].split(",") == list(columns)
+    assert len(lines) - 1 == len(columns["date"])
+    for i in (0, len(lines) - 2):
+        row = lines[i + 1].split(",")
+        assert row[0] == columns["date"][i]
+        for name, cell in zip(list(columns)[1:], row[1:]):
+            assert float(cell) == pytest.approx(columns[name][i], rel=1e-9)
+
+
+# ---------------------------------------------------------------------------
+# 間引き（LTTB / OHLC バケット）
+# ---------------------------------------------------------------------------
+
+def test_lttb_keeps_endpoints_and_extremes():
+    y = np.sin(np.linspace(0, 6 * np.pi, 1000))
+    y[437] = 5.0  # 孤立した山は必ず残る
+    keep = server._lttb_indices(y, 50)
+    assert len(keep) == 50
+    assert keep[0] == 0 and keep[-1] == 999
+    assert np.all(np.diff(keep) > 0)
+    assert 437 in keep
+
+
+def test_lttb_short_input_is_identity():
+    assert server._lttb_indices(np.arange(5.0), 10).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_ohlc_buckets_aggregates():
+    df = make_bars(10)
+    df.loc[df.index[3], "Stock Splits"] = 2.0
+    df.loc[df.index[4], "Stock Splits"] = 3.0
+    out = server._ohlc_buckets(df, 2)
+    assert len(out) == 2
+    assert out.index.tolist() == [df.index[0], df.index[5]]
+    first = df.iloc[:5]
+    assert out["Open"].iloc[0] == first["Open"].iloc[0]
+    assert out["Close"].iloc[0] == first["Close"].iloc[-1]
+    assert out["High"].iloc[0] == first["High"].max()
+    assert out["Low"].iloc[0] == first["Low"].min()
+    assert out["Volume"].iloc[0] == first["Volume"].sum()
+    assert out["Stock Splits"].tolist() == [6.0, 0.0]
+
+
+def test_markdown_volume_is_integer(fake_yahoo, bar_store, monkeypatch):
+    history = fake_yahoo.history
+
+    def with_missing_volume(*args, **kwargs):
+        df = history(*args, **kwargs)
+        df["Volume"] = df["Volume"].astype("f8")
+        df.loc[df.index[len(df) // 2], "Volume"] = np.nan  # 欠けた足があるとストアの出来高は float のまま
+        return df
+
+    monkeypatch.setattr(fake_yahoo, "history", with_missing_volume)
+    params = {"ticker": "AAA", "period": "1y", "max_points": 20, "response_format": "markdown"}
+    call_tool_text("yfinance_get_price_history", params)
+    text = call_tool_text("yfinance_get_price_history", params)  # 2 回目は float のローカルストアから
+    rows = [line for line in text.splitlines() if line.startswith("| 20")]
+    assert len(rows) == 20
+    for line in rows:
+        volume = line.strip("| ").split(" | ")[-1]
+        assert re.fullmatch(r"\d{1,3}(,\d{3})*", volume), volume
+
+
+# ---------------------------------------------------------------------------
+# 日中足の集約
+# ---------------------------------------------------------------------------
+
+def test_resample_intraday_anchors_each_session():
+    day1 = pd.date_range("2024-03-08 09:30", periods=12, freq="5min", tz="America/New_York")
+    day2 = pd.date_range("2024-03-11 09:30", periods=12, freq="5min", tz="America/New_York")  # 夏時間の切り替え後
+    df = make_bars(24).set_axis(day1.append(day2))
+    out = server._resample_intraday(df, 15)
+    assert len(out) == 8
+    assert out.index[0] == day1[0] and out.index[4] == day2[0]
+    assert out.index.tz == df.index.tz
+    assert out["Open"].iloc[0] == df["Open"].iloc[0]
+    assert out["Close"].iloc[0] == df["Close"].iloc[2]
+    assert out["Volume"].iloc[0] == df["Volume"].iloc[:3].sum()
+    assert out["High"].iloc[1] == df["High"].iloc[3:6].max()
+
+
+# ---------------------------------------------------------------------------
+# ユニバーススクリーニングの式
+# ---------------------------------------------------------------------------
+
+COLUMNS = {
+    "pe": np.array([10.0, 20.0, np.nan, 5.0]),
+    "roe": np.array([0.2, 0.1, 0.3, np.nan]),
+    "sector": np.array(["Technology", "Energy", "Technology", None], dtype=object),
+}
+
+
+def evaluate(text: str):
+    return np.asarray(server._eval_expr(server._parse_expr(text), COLUMNS))
+
+
+@pytest.mark.parametrize("text", [
+    "pe.__class__",
+    "pe.real > 0",
+    "__import__('os')",
+    "().__class__.__bases__",
+    "pe[0] > 1",
+    "(lambda: 1)()",
+    "[x for x in pe]",
+    "pe if roe else roe",
+    "pe ** 2",
+    "open('x')",
+    "abs",
+    "pe < log",
+    "abs(pe, base=2)",
+    "pe(1)",
+    "abs(pe)(1)",
+    "unknown > 1",
+])
+def test_parse_expr_rejects(text):
+    with pytest.raises((ValueError, SyntaxError)):
+        server._parse_expr(text)
+
+
+def test_parse_expr_accepts_functions_only_as_calls():
+    server._parse_expr("abs(pe) > 1 and notnull(roe) and log(pe) < 3")
+
+
+def test_eval_expr_nan_comparisons_are_false():
+    assert evaluate("pe < 15").tolist() == [True, False, False, True]
+    assert evaluate("not (pe < 15)").tolist() == [False, True, True, False]
+
+
+def test_eval_expr_chained_compare_and_membership():
+    assert evaluate("5 < pe <= 20").tolist() == [True, True, False, False]
+    assert evaluate("sector in ['Technology'] and roe > 0.15").tolist() == [True, False, True, False]
+    assert evaluate("isnull(pe) or isnull(roe)").tolist() == [False, False, True, True]
+
+
+def test_eval_expr_arithmetic():
+    np.testing.assert_allclose(evaluate("roe / pe * 100"), [2.0, 0.5, np.nan, np.nan])
+
+
+# ---------------------------------------------------------------------------
+# ニュースのカーソル
+# ---------------------------------------------------------------------------
+
+def article(i: int, published: int) -> dict:
+    return {"id": f"a{i}", "content": {"title": f"t{i}", "pubDate": published, "canonicalUrl": {"url": f"https://x/{i}"}}}
+
+
+@pytest.fixture
+def fake_news(monkeypatch):
+    feeds: dict = {}
+
+    async def fetch(fn, kind, ticker, **_):
+        assert kind == "news"
+        return feeds[ticker]
+
+    monkeypatch.setattr(server, "_fetch_upstream", fetch)
+    monkeypatch.setattr(server, "_NEWS_FEEDS", server._TTLCache(16, 60.0, 3600.0))
+    monkeypatch.setattr(server, "_NEWS_SEEN", server.OrderedDict())
+    return feeds
+
+
+def expire(ticker: str) -> None:
+    feed, _ = server._NEWS_FEEDS.get(ticker)
+    server._NEWS_FEEDS.set(ticker, feed, age=61.0)
+
+
+def test_normalize_article_old_and_new_formats():
+    new = server._normalize_article(article(1, 1_700_000_000))
+    old = server._normalize_article({"uuid": "u1", "title": "old", "link": "https://x/old", "providerPublishTime": 1_700_000_000})
+    assert new["id"] == "a1" and new["url"] == "https://x/1"
+    assert old["id"] == "u1" and old["title"] == "old"
+    assert new["published"] == old["published"] == 1_700_000_000
+    assert server._normalize_article({}) is None
+
+
+def test_news_feed_merges_by_id(fake_news):
+    fake_news["AAA"] = [article(1, 100), article(2, 200), article(1, 100)]
+    feed, cached = asyncio.run(server._get_news_feed("AAA"))
+    assert sorted(feed) == ["a1", "a2"] and not cached
+    seqs = {k: v["seq"] for k, v in feed.items()}
+
+    expire("AAA")
+    fake_news["AAA"] = [article(2, 200), article(3, 300)]
+    feed, _ = asyncio.run(server._get_news_feed("AAA"))
+    assert sorted(feed) == ["a1", "a2", "a3"]
+    assert {k: feed[k]["seq"] for k in seqs} == seqs  # 既知の記事の取得順は変わらない
+    assert feed["a3"]["seq"] > max(seqs.values())
+
+
+def test_news_cursor_pages_through_backlog(fake_news, monkeypatch):
+    monkeypatch.setattr(server, "_ensure_heavy_modules", lambda: asyncio.sleep(0))
+    fake_news["AAA"] = [article(i, 1000 + i) for i in range(5)]
+    first = call_tool("yfinance_get_news", {"ticker": "AAA", "count": 3})
+    assert first["count"] == 3 and not first["has_more"]
+
+    expire("AAA")
+    fake_news["AAA"] = [article(i, 1000 + i) for i in range(35)]  # 30 件の新着
+    seen, cursor = [], first["next_cursor"]
+    for _ in range(5):
+        page = call_tool("yfinance_get_news", {"ticker": "AAA", "count": 10, "cursor": cursor})
+        seen += [a["id"] for a in page["articles"]]
+        cursor = page["next_cursor"]
+        if not page["has_more"]:
+            break
+    assert sorted(seen) == sorted(f"a{i}" for i in range(5, 35))
+    assert call_tool("yfinance_get_news", {"ticker": "AAA", "cursor": cursor})["count"] == 0
+
+
+def test_news_cursor_from_another_process_is_expired(fake_news, monkeypatch):
+    monkeypatch.setattr(server, "_ensure_heavy_modules", lambda: asyncio.sleep(0))
+    fake_news["AAA"] = [article(i, 1000 + i) for i in range(3)]
+    page = call_tool("yfinance_get_news", {"ticker": "AAA", "cursor": "0123abcd-999"})
+    assert page["cursor_expired"] and page["count"] == 3
+    assert page["next_cursor"].startswith(server._NEWS_EPOCH)
+    with pytest.raises(ValueError):
+        server._parse_cursor("garbage")
+
+
+def test_news_seq_survives_feed_eviction(fake_news):
+    fake_news["AAA"] = [article(1, 100), article(2, 200)]
+    feed, _ = asyncio.run(server._get_news_feed("AAA"))
+    seqs = {k: v["seq"] for k, v in feed.items()}
+    server._NEWS_FEEDS._data.clear()  # LRU から追い出された状態
+    feed, _ = asyncio.run(server._get_news_feed("AAA"))
+    assert {k: v["seq"] for k, v in feed.items()} == seqs
+
+
+# ---------------------------------------------------------------------------
+# ウォッチリストの先読み
+# ---------------------------------------------------------------------------
+
+def test_watch_history_specs_are_validated(capsys):
+    specs = server._parse_watch_history("1y:1d, 1y:1x 5d:5m bogus 1y:1d")
+    assert specs == [("1y", "1d"), ("5d", "5m")]
+    err = capsys.readouterr().err
+    assert "'1y:1x'" in err and "'bogus'" in err and "'5d:5m'" not in err
+    assert server._parse_watch_history("") == []
+
+
+@pytest.mark.parametrize("value, kinds", [
+    ("1y:1d", ["info", "history", "statements"]),
+    ("", ["info", "statements"]),
+    ("1y:1x", ["info", "statements"]),
+])
+def test_watch_kinds_skip_empty_history(value, kinds):
+    env = {**os.environ, "YFINANCE_MCP_WATCH_HISTORY": value}
+    code = "import server; print(list(server._WATCH_KINDS))"
+    out = subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(server.__file__),
+                         capture_output=True, text=True, check=True)
+    assert json.loads(out.stdout.replace("'", '"')) == kinds
+
+
+@pytest.fixture
+def watch(clock, monkeypatch):
+    """種別ごとに呼ばれた銘柄を記録する偽の更新処理で _watchlist_job を回す。"""
+    calls: list = []
+    failing: set = set()
+
+    def refresh(kind):
+        async def run(sym):
+            calls.append((kind, sym))
+            if (kind, sym) in failing:
+                raise RuntimeError("upstream down")
+        return run
+
+    monkeypatch.setattr(server, "_WATCH_KINDS", {"info": (100.0, 1, refresh("info")), "history": (50.0, 3, refresh("history"))})
+    monkeypatch.setattr(server, "WATCHLIST", ["AAA", "BBB", "CCC"])
+    monkeypatch.setattr(server, "WATCH_RATE", 2.0)
+    monkeypatch.setattr(server, "WATCH_JITTER", 0.1)
+    monkeypatch.setattr(server, "_WATCH_QUEUE", [])
+    monkeypatch.setattr(server, "_WATCH_REFRESHED", {})
+    monkeypatch.setattr(server, "_WATCH_FAILED", {})
+    monkeypatch.setattr(server, "_ensure_heavy_modules", lambda: asyncio.sleep(0))
+    return calls, failing
+
+
+def test_watchlist_runs_in_heap_order_paced_by_cost(clock, watch):
+    calls, _ = watch
+    start = clock.now
+    delays = []
+    for _ in range(3):
+        clock.now += delays[-1] if delays else 0.0
+        delays.append(asyncio.run(server._watchlist_job()))
+    # 初回は種別の順・銘柄の順に積み、1 回に _WATCH_BATCH 件ずつ取る
+    assert calls == [("info", "AAA"), ("info", "BBB"), ("info", "CCC"),
+                     ("history", "AAA"), ("history", "BBB"), ("history", "CCC")]
+    # 使ったリクエスト数 / WATCH_RATE 秒は次を始めない（待ちがなくなったら次の予定まで）
+    assert delays[:2] == [pytest.approx((1 + 1) / 2.0), pytest.approx((1 + 3) / 2.0)]
+    assert delays[2] == pytest.approx(max((3 + 3) / 2.0, server._WATCH_QUEUE[0][0] - clock.now))
+
+    # 次回の予定は各種別の間隔 ±WATCH_JITTER に収まり、ヒープの先頭が最も早い
+    due = {(kind, sym): at for at, _, kind, sym in server._WATCH_QUEUE}
+    assert len(due) == 6
+    assert server._WATCH_QUEUE[0][0] == min(due.values())
+    for (kind, sym), at in due.items():
+        ran = start + sum(delays[:calls.index((kind, sym)) // 2])
+        interval = {"info": 100.0, "history": 50.0}[kind]
+        assert interval * 0.9 <= at - ran <= interval * 1.1
+
+    # 予定時刻まで何もなければ、先頭の予定までの残りを返して上流は呼ばない
+    assert asyncio.run(server._watchlist_job()) == pytest.approx(server._WATCH_QUEUE[0][0] - clock.now)
+    assert len(calls) == 6
+
+
+def test_watchlist_retries_failures_sooner(clock, watch, monkeypatch):
+    calls, failing = watch
+    monkeypatch.setattr(server, "_WATCH_KINDS", {"info": (1000.0, 1, server._WATCH_KINDS["info"][2])})
+    failing.add(("info", "BBB"))
+    asyncio.run(server._watchlist_job())
+    assert server._WATCH_FAILED == {("info", "BBB"): "RuntimeError: upstream down"}
+    assert set(server._WATCH_REFRESHED) == {("info", "AAA")}
+    due = {sym: at - clock.now for at, _, _, sym in server._WATCH_QUEUE}
+    assert due["BBB"] == server._JOB_RETRY_DELAY
+    assert 900.0 <= due["AAA"] <= 1100.0 and due["CCC"] == 0.0
+
+
+# ---------------------------------------------------------------------------
+# 上流エラーの分類
+# ---------------------------------------------------------------------------
+
+class YFRateLimitError(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.response = type("Response", (), {"status_code": status})()
+
+
+@pytest.mark.parametrize("error, reason", [
+    (YFRateLimitError("Too Many Requests. Rate limited. Try after a while."), "rate_limited"),
+    (HTTPError(429), "rate_limited"),
+    (HTTPError(403), "auth"),
+    (Exception("Invalid Crumb"), "auth"),
+    (HTTPError(500), "other"),
+    (KeyError("regularMarketPrice"), "other"),
+])
+def test_error_reason(error, reason):
+    assert server._error_reason(error) == reason
+
+
+def test_upstream_failures_are_counted_by_reason(monkeypatch):
+    monkeypatch.setattr(server, "_UPSTREAM_CALLS", {})
+    monkeypatch.setattr(server, "_UPSTREAM_ERRORS", {})
+
+    def rate_limited():
+        raise HTTPError(429)
+
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            asyncio.run(server._timed_upstream(rate_limited, "quote"))
+    assert server._UPSTREAM_CALLS["quote"]["errors"] == 2
+    snapshot = server._metrics_snapshot()["upstream"]["kinds"]["quote"]["errors_by_reason"]
+    assert snapshot == {"rate_limited": 2, "auth": 0, "other": 0}
+    text = server._prometheus_text()
+    assert 'yfinance_mcp_upstream_failures_total{kind="quote",reason="rate_limited"} 2' in text
+
+
+# ---------------------------------------------------------------------------
+# 共有キャッシュ
+# ---------------------------------------------------------------------------
+
+def test_shared_cache_file_is_private(tmp_path):
+    import os
+    import stat
+
+    cache = server._SharedCache(str(tmp_path / "sub" / "cache.db"), 1 << 20)
+    cache._conn().execute("INSERT INTO cache VALUES ('k', 'x', 0, 0, 0, x'00')")
+    for name in ("cache.db", "cache.db-wal", "cache.db-shm"):
+        path = tmp_path / "sub" / name
+        if path.exists():
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600, name
+    cache._writer.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# 記録と再生
+# ---------------------------------------------------------------------------
+
+def test_archive_record_file_is_private_and_replays(tmp_path):
+    import os
+    import stat
+
+    path = str(tmp_path / "session.zip")
+    recorder = server._UpstreamArchive(path, replay=False)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    server._UpstreamArchive(path, replay=False)  # まだ何も記録していないファイルにも追記できる
+    assert recorder.call("quote", ("AAA",), lambda: {"p": 1.0}) == {"p": 1.0}
+    player = server._UpstreamArchive(path, replay=True, latency_scale=0.0)
+    assert player.call("quote", ("AAA",), lambda: pytest.fail("再生では上流を呼ばない")) == {"p": 1.0}
+
+
+# ---------------------------------------------------------------------------
+# HTTP トランスポート
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("host", ["0.0.0.0", "::"])
+def test_serve_http_requires_allowed_hosts_on_wildcard(monkeypatch, host):
+    monkeypatch.setattr(server, "ALLOWED_HOSTS", [])
+    monkeypatch.setattr(server.mcp.settings, "host", server.mcp.settings.host)
+    monkeypatch.setattr(server.mcp.settings, "port", server.mcp.settings.port)
+    with pytest.raises(SystemExit, match="YFINANCE_MCP_ALLOWED_HOSTS"):
+        server._serve_http("streamable-http", host, 0)
+
+
+# ---------------------------------------------------------------------------
+# 共有 HTTP セッションの crumb 取り直し
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def fresh_session(monkeypatch):
+    from yfinance import cache
+
+    monkeypatch.setattr(server, "_HTTP_SESSION", None)
+    monkeypatch.setattr(server, "_COUNTERS", {})
+    stored = []
+    monkeypatch.setattr(cache, "get_cookie_cache", lambda: type("Cache", (), {"store": lambda self, *a: stored.append(a)})())
+    return server._http_session()
+
+
+def test_reset_crumb_clears_cookie_and_crumb(fresh_session):
+    from yfinance.data import YfData
+
+    data = YfData(session=fresh_session)
+    data._cookie, data._crumb = "cookie", "crumb"
+    fresh_session.cookies.set("A3", "x")
+    generation = server._crumb_generation
+    server._reset_crumb(generation)
+    server._reset_crumb(generation)  # 同じ期限切れの 2 回目は何もしない
+    assert data._cookie is None and data._crumb is None and not fresh_session.cookies
+    assert server._HTTP_SESSION is fresh_session
+    assert server._COUNTERS["crumb_resets"] == 1
+
+
+def test_reset_crumb_rebuilds_session_without_private_attributes(fresh_session, monkeypatch):
+    import yfinance.data
+
+    registered = []
+
+    class YfData:  # 内部属性の構成が違う yfinance の代わり
+        def __init__(self, session=None):
+            registered.append(session)
+
+    monkeypatch.setattr(yfinance.data, "YfData", YfData)
+    server._reset_crumb(server._crumb_generation)
+    assert server._HTTP_SESSION is not None and server._HTTP_SESSION is not fresh_session
+    assert registered[-1] is server._HTTP_SESSION